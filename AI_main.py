@@ -1,78 +1,28 @@
 import logging
-import asyncio
-import aiohttp
-from bs4 import BeautifulSoup
-from openai import AsyncOpenAI
-from CONFIG import OPENAI_API, CHECK_INTERVAL, POST_LIMIT, OPENAI_MODEL, OPENAI_MAX_TOKENS
-from database import add_post, get_last_post_number, is_post_processed, create_user_tables, get_user_channels, mark_channel_as_old, get_channel_description
-from ai_analyzer import generate_summary_of_best_posts
+from CONFIG import CHECK_INTERVAL, POST_LIMIT, BATCH_MODE
+from database import (
+    add_post, get_last_post_number, create_user_tables, get_user_channels, mark_channel_as_old,
+    get_channel_description, get_channel_cursor, set_channel_cursor
+)
+from ai_analyzer import summarize_posts, SUMMARY_VERSION
+from embeddings import classify_channel_posts
+from channel_poller import get_poller, get_post_number
+from prefilter import is_media_only, check_heuristics
+from batch_jobs import get_batch_processor, RELEVANCE
+from llm_telemetry import llm_context, llm_stage
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Настройки OpenAI
-client = AsyncOpenAI(api_key=OPENAI_API)
-
-def truncate_text(text, max_tokens):
-    """
-    Обрезает текст до указанного количества токенов.
-    """
-    tokens = text.split()
-    if len(tokens) > max_tokens:
-        return " ".join(tokens[:max_tokens])
-    return text
-
-async def fetch_channel_page(channel_username):
-    """
-    Асинхронно получает HTML-страницу канала.
+@llm_stage("check_new_posts")
+async def check_new_posts(user_id, feed):
     """
-    url = f"https://t.me/s/{channel_username}"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status != 200:
-                raise Exception(f"Ошибка при запросе к каналу: {response.status}")
-            return await response.text()
-
-async def get_last_posts(channel_username, limit=POST_LIMIT):
-    """
-    Получает последние посты из публичного Telegram-канала.
-    """
-    try:
-        html = await fetch_channel_page(channel_username)
-        soup = BeautifulSoup(html, 'html.parser')
-        posts = []
-        for message in soup.find_all('div', class_='tgme_widget_message', limit=limit):
-            post_id = message.get('data-post')
-            post_content = {'id': post_id}
-
-            # Проверяем наличие текста
-            text = message.find('div', class_='tgme_widget_message_text')
-            if text:
-                post_content['text'] = text.get_text(strip=True)
-            else:
-                # Если текста нет, проверяем наличие медиа
-                media_types = {
-                    'photo': "[Картинка]",
-                    'video': "[Видео]",
-                    'gif': "[GIF]",
-                    'document': "[Файл]"
-                }
-                post_content['text'] = "[Медиа]"
-                for media_type, label in media_types.items():
-                    if message.find('div', class_=f'tgme_widget_message_{media_type}'):
-                        post_content['text'] = label
-                        break
-
-            posts.append(post_content)
-        return posts
-    except Exception as e:
-        logging.error(f"Ошибка при получении постов из канала @{channel_username}: {e}")
-        return []
-
-async def check_new_posts(user_id):
-    """
-    Проверяет новые посты в каналах и возвращает список выжимок и флаг наличия новых постов.
-    Для новых каналов анализирует только 5 последних постов.
+    Обрабатывает новые посты из общей ленты и возвращает список выжимок и флаг наличия новых постов.
+    feed - посты, которые центральный опрос каналов раздал пользователю: {channel_username: [posts]}.
+    Для новых каналов анализирует только 5 последних постов, для остальных -
+    все посты после сохраненного курсора (номера последнего обработанного поста).
+    В пакетном режиме (BATCH_MODE) посты сохраняются без выжимки, а проверка релевантности
+    и выжимка ставятся в очередь batch_jobs.
     """
     summaries = []
     new_posts_found = False
@@ -86,45 +36,84 @@ async def check_new_posts(user_id):
     for channel in user_channels:
         channel_username = channel["username"]
         is_new_channel = channel["is_new_channel"]
+        if channel_username not in feed:
+            # Канал еще не опрашивался или в нем нет ничего нового
+            continue
 
+        # У нового канала курсор есть, только если его первое сканирование прервалось на середине
+        cursor = get_channel_cursor(user_id, channel_username)
+        posts = [post for post in feed[channel_username] if get_post_number(post['id']) > cursor]
+        if is_new_channel:
+            posts = posts[-5:]
+        elif not cursor:
+            posts = posts[-POST_LIMIT:]
+
+        if BATCH_MODE:
+            relevant_ids = set()
+        else:
+            # Релевантность всех новых текстовых постов канала проверяем одним запросом
+            text_posts = [post for post in posts if not is_media_only(post['text'])]
+            verdicts = await classify_channel_posts(user_id, channel_username, text_posts)
+            relevant_ids = {post['id'] for post, relevant in zip(text_posts, verdicts) if relevant}
 
-        limit = 5 if is_new_channel else POST_LIMIT
-        posts = await get_last_posts(channel_username, limit=limit)
         for post in posts:
-            if not is_post_processed(user_id, post['id']):
-                new_posts_found = True
-                last_post_number = get_last_post_number(user_id) + 1
-                if post['text'] in ["[Картинка]", "[Видео]", "[GIF]", "[Файл]", "[Медиа]"]:
-                    summary = post['text']
-                else:
-                    summary = await generate_summary_of_best_posts([post], get_channel_description(user_id, channel_username))
-                summaries.append(f"📢 Канал: @{channel_username}\n\n{summary}")
-                add_post(user_id, post['id'], post['text'], summary, last_post_number, channel_username)
-                logging.info(f"Пост {post['id']} добавлен в базу данных для пользователя {user_id}.")
-
-        # Если канал был новым, после первого сканирования он больше не считается новым
-        if is_new_channel:
+            new_posts_found = True
+            last_post_number = get_last_post_number(user_id) + 1
+            summary_version = SUMMARY_VERSION
+            if is_media_only(post['text']):
+                summary = post['text']
+            elif BATCH_MODE and check_heuristics(post['text']) is None:
+                # Выжимка появится, когда будет готов пакет; до этого дайджест сделает ее сам
+                summary, summary_version = None, None
+            elif post['id'] in relevant_ids:
+                summary = await summarize_posts([post])
+            else:
+                summary = ""
+            summaries.append(f"📢 Канал: @{channel_username}\n\n{summary or ''}")
+            add_post(user_id, post['id'], post['text'], summary, last_post_number, channel_username,
+                     summary_version, post.get('embedding'))
+            if summary is None:
+                get_batch_processor().enqueue(RELEVANCE, user_id, post['id'], post['text'],
+                                              get_channel_description(user_id, channel_username))
+            logging.info(f"Пост {post['id']} добавлен в базу данных для пользователя {user_id}.")
+            # Сдвигаем курсор после каждого поста, чтобы при сбое не потерять и не повторить посты
+            set_channel_cursor(user_id, channel_username, get_post_number(post['id']))
+
+        # Если канал был новым, после первого сканирования он больше не считается новым.
+        # Без обработанных постов канал остается новым: первое сканирование еще впереди
+        if is_new_channel and posts:
             mark_channel_as_old(user_id, channel_username)
 
     return summaries, new_posts_found
 
 async def auto_update(user_id):
     """
-    Автоматически проверяет новые посты каждые N секунд.
+    Автоматически обрабатывает новые посты, которые центральный опрос раздает пользователю.
     """
     no_posts_message_shown = False
-
-    while True:
-        summaries, new_posts_found = await check_new_posts(user_id)
-        if new_posts_found:
-            for summary in summaries:
-                logging.info(summary)
-            no_posts_message_shown = False
-        elif not no_posts_message_shown:
-            logging.info("Новых постов нет :(")
-            no_posts_message_shown = True
-
-        await asyncio.sleep(CHECK_INTERVAL)
+    poller = get_poller()
+    if not poller.is_subscribed(user_id):
+        poller.subscribe(user_id)
+
+    # Цикл завершается, когда пользователь отписан от ленты (бот отключен)
+    with llm_context(user_id=user_id):
+        while poller.is_subscribed(user_id):
+            await poller.wait_for_posts(user_id, timeout=CHECK_INTERVAL)
+            feed = poller.drain(user_id)
+            try:
+                summaries, new_posts_found = await check_new_posts(user_id, feed)
+            except Exception:
+                # Возвращаем посты в ленту: после перезапуска обработчика они будут обработаны снова,
+                # а уже сохраненные отсеет курсор канала
+                poller.requeue(user_id, feed)
+                raise
+            if new_posts_found:
+                for summary in summaries:
+                    logging.info(summary)
+                no_posts_message_shown = False
+            elif not no_posts_message_shown:
+                logging.info("Новых постов нет :(")
+                no_posts_message_shown = True
 
 async def start_ai_main(user_id):
     """
@@ -11,3 +11,147 @@ POST_LIMIT = 8      # Максимальное количество постов
 # Настройки для OpenAI
 OPENAI_MODEL = "gpt-4o-mini"
 OPENAI_MAX_TOKENS = 500  # Максимальное количество токенов для ответа
+
+
+# Настройки HTTP-клиента для t.me
+HTTP_POOL_LIMIT = 100            # Максимальное количество соединений в пуле
+HTTP_POOL_LIMIT_PER_HOST = 20    # Максимальное количество соединений на один хост
+HTTP_DNS_CACHE_TTL = 300         # Время жизни кэша DNS в секундах
+HTTP_KEEPALIVE_TIMEOUT = 60      # Сколько секунд держать неиспользуемое соединение открытым
+HTTP_CONNECT_TIMEOUT = 5         # Таймаут установки соединения в секундах
+HTTP_READ_TIMEOUT = 15           # Таймаут чтения ответа в секундах
+HTTP_TOTAL_TIMEOUT = 30          # Общий таймаут запроса в секундах
+
+# Настройки постраничного чтения каналов
+TG_PAGE_SIZE = 20          # Сколько постов t.me отдает на одной странице /s/<channel>
+MAX_PAGES_PER_POLL = 5     # Максимум страниц, загружаемых для одного канала за одну проверку
+
+# Парсер HTML-страниц каналов: "auto", "selectolax", "lxml" или "bs4"
+# ("auto" выбирает самый быстрый из установленных)
+HTML_EXTRACTOR = "auto"
+POLLER_CONCURRENCY = 10    # Сколько каналов центральный опрос загружает одновременно
+
+# Настройки адаптивного расписания опроса каналов
+POLL_MIN_INTERVAL = CHECK_INTERVAL  # Минимальный интервал опроса канала в секундах
+POLL_MAX_INTERVAL = 1800            # Максимальный интервал опроса молчащего канала в секундах
+POLL_BACKOFF_FACTOR = 2             # Во сколько раз растет интервал, если новых постов нет
+POLL_GAP_FACTOR = 0.5               # Интервал = средний промежуток между постами * этот множитель
+POLL_JITTER = 0.1                   # Случайный разброс интервала (доля от интервала)
+
+# Защита от ограничений t.me
+SCRAPE_MAX_RPS = 5                  # Общий лимит запросов к t.me в секунду
+SCRAPE_DEFAULT_RETRY_AFTER = 60     # Пауза после 429, если t.me не прислал Retry-After (секунды)
+BREAKER_FAILURE_THRESHOLD = 5       # Сколько ошибок подряд открывает предохранитель канала
+BREAKER_COOLDOWN = 300              # Начальная пауза открытого предохранителя в секундах
+BREAKER_MAX_COOLDOWN = 6 * 3600     # Максимальная пауза (удваивается после неудачной пробы)
+
+# Настройки кэша ответов LLM (общий для всех пользователей)
+LLM_CACHE_PATH = "llm_cache.db"     # Файл SQLite с кэшем
+LLM_CACHE_TTL = 7 * 24 * 3600       # Время жизни записи в секундах
+LLM_CACHE_MAX_ENTRIES = 100000      # Максимум записей, лишние вытесняются по LRU
+
+# Пакетная проверка релевантности: сколько постов отправлять в OpenAI одним запросом
+RELEVANCE_BATCH_SIZE = 20
+
+# Сколько запросов к OpenAI дайджест выполняет одновременно
+DIGEST_CONCURRENCY = 8
+
+# Упорядочивать выжимки канала в дайджесте по важности (один запрос к OpenAI на канал)
+DIGEST_RANK_SUMMARIES = True
+
+# Локальный предфильтр постов (prefilter.py)
+PREFILTER_MODEL_PATH = "prefilter_model.json"
+PREFILTER_LOG_PATH = "prefilter.db"
+PREFILTER_CONFIDENCE = 0.9     # Пост отбрасывается как мусор без OpenAI, если вероятность мусора не ниже порога
+PREFILTER_AUDIT_RATE = 0.05    # Доля отброшенных постов, которые все равно проверяются в OpenAI для оценки точности
+PREFILTER_LOG_MAX_ROWS = 50000
+PREFILTER_LOG_TEXT_CHARS = 500  # Сколько первых символов поста хранится в журнале (для дообучения модели)
+
+# Релевантность по векторам (embeddings.py): посты и описания каналов векторизуются один раз
+EMBEDDINGS_ENABLED = True
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = 100        # Сколько текстов векторизуется одним запросом
+EMBEDDING_MAX_CHARS = 8000        # Длинные посты обрезаются перед векторизацией
+RELEVANCE_THRESHOLD = 0.3         # Начальный порог косинусной близости поста к описанию канала
+RELEVANCE_TIEBREAK_MARGIN = 0.05  # В пределах этого расстояния от порога решает is_post_relevant
+RELEVANCE_THRESHOLD_STEP = 0.01   # Насколько ответ is_post_relevant сдвигает порог канала
+
+# Поиск почти одинаковых постов в дайджесте (dedup.py)
+DEDUP_NUM_PERM = 64       # Длина MinHash-сигнатуры
+DEDUP_BANDS = 16          # Полос LSH (DEDUP_NUM_PERM должно делиться на это число)
+DEDUP_THRESHOLD = 0.5     # Минимальное сходство Жаккара для дубликатов
+DEDUP_SHINGLE_SIZE = 3    # Слов в шингле
+
+# Бюджет токенов запросов (token_budget.py)
+LLM_CONTEXT_TOKENS = 128000  # Контекст OPENAI_MODEL
+LLM_CHUNK_TOKENS = 8000      # Максимум входных токенов одного запроса; больше - через map-reduce
+CHARS_PER_TOKEN = 3          # Оценка длины токена, если tiktoken не установлен
+
+# Максимальная длина одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Пакетный режим фоновой обработки постов (batch_jobs.py): выжимки и проверка релевантности
+# при опросе каналов идут через Batch API дешевле, но с задержкой до BATCH_COMPLETION_WINDOW
+BATCH_MODE = False
+BATCH_DB_PATH = "batch_jobs.db"
+BATCH_DIR = "batches"               # Куда сохраняются отправленные JSONL-файлы
+BATCH_API_BASE_URL = None           # None - OpenAI; "http://127.0.0.1:8089/v1" - mock_batch_api.py
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_MAX_REQUESTS = 5000           # Заданий в одном пакете
+BATCH_FLUSH_INTERVAL = 300          # Сколько секунд самое старое задание может ждать отправки
+BATCH_POLL_INTERVAL = 60            # Как часто проверять готовность пакетов, секунд
+BATCH_MAX_ATTEMPTS = 3              # Сколько раз отправлять задание, оставшееся без результата (пакет истек или отменен)
+BATCH_REQUEST_TIMEOUT = 120         # Таймаут одной попытки запроса к Batch API (загрузка и скачивание файлов), секунд
+BATCH_REQUEST_DEADLINE = 600        # Общее время на запрос к Batch API со всеми повторами, секунд
+BATCH_PRICE_FACTOR = 0.5            # Доля обычной цены (LLM_PRICES), которую стоит запрос в Batch API
+
+# Телеметрия запросов к OpenAI (llm_telemetry.py)
+METRICS_PORT = None                     # Порт для /metrics (Prometheus) и /report, например 9821; None - не запускать
+METRICS_HOST = "127.0.0.1"              # Адрес сервера метрик: /report показывает пользователей, наружу не открывать
+LLM_TELEMETRY_PATH = "llm_telemetry.db"
+# Цены в долларах за миллион токенов: (вход, вход из кэша промптов OpenAI, выход)
+LLM_PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "text-embedding-3-small": (0.02, 0.02, 0.0),
+}
+
+# Шлюз к OpenAI (llm_gateway.py): один клиент и общий лимит на весь процесс
+LLM_MAX_CONCURRENCY = 16        # Сколько запросов к OpenAI может выполняться одновременно
+LLM_REQUEST_TIMEOUT = 30        # Таймаут одной попытки в секундах
+LLM_DEADLINE = 90               # Общее время на запрос со всеми повторами в секундах
+LLM_MAX_RETRIES = 3             # Повторы при временных ошибках (таймаут, 429, 5xx, обрыв соединения)
+LLM_RETRY_BASE_DELAY = 0.5      # Пауза перед повтором: случайная от 0 до base * 2^попытка
+LLM_RETRY_MAX_DELAY = 10        # ... но не больше этого значения (секунды)
+# Задачи, для которых медленный запрос дублируется (hedging): если ответа нет дольше
+# LLM_HEDGE_PERCENTILE обычной задержки задачи, отправляется копия и берется первый ответ
+LLM_HEDGE_TASKS = {"is_post_relevant", "classify_posts_relevance", "rank_channel_summaries"}
+LLM_HEDGE_PERCENTILE = 0.95
+LLM_HEDGE_MIN_DELAY = 1.0       # Копия не отправляется раньше, чем через столько секунд
+LLM_HEDGE_MIN_SAMPLES = 20      # Сколько замеров задержки задачи нужно, прежде чем дублировать
+# Приоритеты: интерактивные запросы (дайджест, добавление канала) обслуживаются раньше фоновых,
+# а фоновые не занимают последние LLM_INTERACTIVE_RESERVED слотов из LLM_MAX_CONCURRENCY
+LLM_INTERACTIVE_RESERVED = 4
+LLM_USER_WEIGHTS = {}           # user_id -> вес при разделе слотов между пользователями (по умолчанию 1)
+
+# Маршрутизация запросов по моделям (llm.py): у каждого вида задачи свой уровень модели
+LLM_MODEL_TIERS = {
+    "fast": OPENAI_MODEL,
+    "strong": "gpt-4o",
+}
+LLM_TASK_TIERS = {
+    "relevance": "fast",            # Проверки релевантности постов и выжимок
+    "post_summary": "fast",         # Выжимки постов
+    "channel_description": "fast",    # Описание канала; неразборчивый профиль повторяется на "strong" (LLM_ESCALATION)
+    "dedup_merge": "fast",          # Сведение выжимок канала в дайджест (ранжирование)
+}
+LLM_DEFAULT_TIER = "fast"
+LLM_ESCALATION = {"fast": "strong"}  # Уровень, на котором повторяется неразборчивый или неуверенный ответ
+LLM_ESCALATE_CONFIDENCE = 0.7        # Ответ "Да"/"Нет" с вероятностью ниже этой считается неуверенным
+
+# Соединения с базами пользователей (database.py)
+DB_MAX_OPEN_CONNECTIONS = 64    # Сколько баз держать открытыми; давно не использованные закрываются
+DB_SYNCHRONOUS = "NORMAL"       # PRAGMA synchronous: в режиме WAL NORMAL не теряет данные при падении процесса
+DB_CACHE_SIZE_KB = 8192         # PRAGMA cache_size на одно соединение, КБ
+DB_CACHED_STATEMENTS = 128      # Сколько подготовленных запросов хранит каждое соединение
+DB_BUSY_TIMEOUT_MS = 5000       # Сколько ждать, если база занята другим процессом
@@ -1,15 +1,29 @@
+import asyncio
+import json
 import logging
-from openai import AsyncOpenAI
-from CONFIG import OPENAI_API, OPENAI_MODEL, OPENAI_MAX_TOKENS
-from database import get_unread_posts, mark_posts_as_read, get_channel_description
-from channel_analyzer import is_post_relevant
-import sqlite3
+import re
+from CONFIG import OPENAI_MAX_TOKENS, LLM_ESCALATE_CONFIDENCE, DIGEST_CONCURRENCY, DIGEST_RANK_SUMMARIES
+from llm import complete, LLMError, PROMPT_VERSIONS
+from prompts import IS_SUMMARY_RELEVANT, RANK_CHANNEL_SUMMARIES
+from database import (
+    get_unread_posts, mark_posts_as_read, get_channel_description, update_post_summary, update_post_embedding,
+    get_user_channels, connect_user_db, release_connection
+)
+from channel_analyzer import classify_posts_relevance, is_yes_no, parse_yes_no
+from prefilter import is_media_only
+from embeddings import classify_channel_posts
+from dedup import NearDuplicateIndex, cluster_texts
+from llm_telemetry import llm_context, llm_stage
 
 # Настройка логирования
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Настройки OpenAI
-client = AsyncOpenAI(api_key=OPENAI_API)
+# Текст выжимки, если ее не удалось сгенерировать
+SUMMARY_ERROR = "Не удалось сгенерировать выжимку."
+
+# Версия промпта выжимки, с которой сохраняются summary постов.
+# Сохраненная выжимка другой версии в дайджесте генерируется заново.
+SUMMARY_VERSION = PROMPT_VERSIONS["summarize_posts"]
 
 async def analyze_post_quality(post_text):
     """
@@ -20,21 +34,47 @@ async def analyze_post_quality(post_text):
         return "."
 
     try:
-        response = await client.chat.completions.create(
-            model=OPENAI_MODEL,
+        analysis = await complete(
+            "analyze_post_quality",
             messages=[
                 {"role": "system", "content": "Ты — эксперт, который анализирует тексты на качество и достоверность."},
                 {"role": "user", "content": f"Проанализируй этот текст и оцени его качество и достоверность. Если, по твоему мнению, информация в посте ненужная или же просто мусор, то напиши вместо анализа '.': \n\n{post_text}"}
             ],
             max_tokens=OPENAI_MAX_TOKENS
         )
-        analysis = response.choices[0].message.content
         logging.info(f"Анализ поста: {analysis}")
         return analysis
-    except Exception as e:
+    except LLMError as e:
         logging.error(f"Ошибка при анализе поста: {e}")
         return "."
 
+def summary_messages(posts):
+    """
+    Сообщения запроса summarize_posts (используются и в пакетном режиме, см. batch_jobs.py).
+    """
+    content = "\n\n".join([f"Пост {i+1}:\n{post['text']}" for i, post in enumerate(posts)])
+    return [
+        {"role": "system", "content": "Ты — секретарь, который делает краткие и конкретные выжимки. Пиши только самое важное, без лишних слов."},
+        {"role": "user", "content": f"Сделай краткую выжимку по этим постам. Пиши только самое важное, без повторов и лишних деталей:\n\n{content}"}
+    ]
+
+async def summarize_posts(posts):
+    """
+    Делает краткую выжимку по постам без проверки их релевантности.
+    """
+    try:
+        summary = await complete(
+            "summarize_posts",
+            messages=summary_messages(posts),
+            max_tokens=OPENAI_MAX_TOKENS
+        )
+        logging.info(f"Сгенерирована выжимка: {summary}")
+        return summary
+    except LLMError as e:
+        logging.error(f"Ошибка при генерации выжимки: {e}")
+        return SUMMARY_ERROR
+
+@llm_stage("generate_summary_of_best_posts")
 async def generate_summary_of_best_posts(posts, channel_description):
     """
     Генерирует краткую и конкретную выжимку по самым полезным постам.
@@ -45,70 +85,35 @@ async def generate_summary_of_best_posts(posts, channel_description):
         return ""
 
     # Фильтруем посты, оставляя только те, которые соответствуют тематике канала
-    relevant_posts = []
-    for post in posts:
-        if 'text' in post and post['text'].strip():
-            if await is_post_relevant(post['text'], channel_description):
-                relevant_posts.append(post)
+    # (все посты проверяются одним запросом)
+    text_posts = [post for post in posts if 'text' in post and post['text'].strip()]
+    verdicts = await classify_posts_relevance([post['text'] for post in text_posts], channel_description)
+    relevant_posts = [post for post, relevant in zip(text_posts, verdicts) if relevant]
 
     if not relevant_posts:
         logging.info("Нет постов с текстом, соответствующих тематике канала.")
         return ""
 
-    try:
-        content = "\n\n".join([f"Пост {i+1}:\n{post['text']}" for i, post in enumerate(relevant_posts)])
-        response = await client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": "Ты — секретарь, который делает краткие и конкретные выжимки. Пиши только самое важное, без лишних слов."},
-                {"role": "user", "content": f"Сделай краткую выжимку по этим постам. Пиши только самое важное, без повторов и лишних деталей:\n\n{content}"}
-            ],
-            max_tokens=OPENAI_MAX_TOKENS
-        )
-        summary = response.choices[0].message.content
-        logging.info(f"Сгенерирована выжимка: {summary}")
-        return summary
-    except Exception as e:
-        logging.error(f"Ошибка при генерации выжимки: {e}")
-        return "Не удалось сгенерировать выжимку."
+    return await summarize_posts(relevant_posts)
 
 async def remove_duplicate_summaries(summaries):
     """
-    Убирает повторяющиеся мысли из списка выжимок.
+    Убирает повторяющиеся выжимки: из каждой группы почти одинаковых выжимок остается первая.
+    Дубликаты ищутся локально (MinHash + LSH, см. dedup.py), без запросов к OpenAI.
     Если список пустой, возвращает пустой список.
     """
     if not summaries:
         logging.info("Список выжимок пуст. Пропускаем удаление дубликатов.")
         return []
 
-    try:
-        # Объединяем все выжимки в один текст
-        combined_summaries = "\n\n".join(summaries)
-
-        # Запрашиваем у OpenAI удаление дубликатов
-        response = await client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": "Ты — помощник, который анализирует тексты и удаляет повторяющиеся мысли."},
-                {"role": "user", "content": f"Проанализируй эти выжимки и оставь только уникальные мысли по темам из постов. "
-                                            f"Слишком мощно тоже не убирай все, оставляй многое. "
-                                            f"Ни в коем случае не добавляй разметку заголовков и подзаголовков:\n\n{combined_summaries}"}
-            ],
-            max_tokens=OPENAI_MAX_TOKENS
-        )
-        unique_summaries = response.choices[0].message.content
-        return unique_summaries.split("\n\n")  # Разделяем обратно на отдельные выжимки
-    except Exception as e:
-        logging.error(f"Ошибка при удалении дубликатов: {e}")
-        return summaries  # Возвращаем оригинальный список в случае ошибки
-
+    return [summaries[cluster[0]] for cluster in cluster_texts(summaries)]
 
 
 def get_channel_username_from_db(user_id, post_id):
     """
     Возвращает channel_username для поста по его ID.
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
         cursor.execute('SELECT channel_username FROM posts WHERE id = ?', (post_id,))
@@ -118,18 +123,178 @@ def get_channel_username_from_db(user_id, post_id):
         logging.error(f"Ошибка при получении channel_username для поста {post_id}: {e}")
         return None
     finally:
-        conn.close()
+        release_connection(conn)
 
 
-async def generate_digest(user_id):
+def get_stored_summary(post):
     """
-    Генерирует дайджест всех непрочитанных (is_read=0) постов, разбивая их по каналам.
-    Для каждого НЕпустого summary создаём скрытую ссылку [Ссылка].
-    Если summary пустое (мусор), пост не попадает в дайджест.
+    Возвращает сохраненную при опросе выжимку поста, если ее можно использовать в дайджесте,
+    иначе None (выжимки нет, она сделана старой версией промпта или с ошибкой).
+    Пустая строка означает, что пост уже признан мусором.
+    """
+    summary = post.get('summary')
+    if summary is None or summary == SUMMARY_ERROR or post.get('summary_version') != SUMMARY_VERSION:
+        return None
+    return summary
+
+def parse_summary_order(answer, count):
+    """
+    Строго разбирает ответ ранжирования выжимок.
+    Ожидается JSON {"order": [3, 1, 2]} - перестановка номеров 1..count.
+    Возвращает список индексов (с нуля) или None, если ответ не прошел проверку.
+    """
+    if not answer:
+        return None
+    # Модель иногда оборачивает JSON в блок кода
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", answer.strip())
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    order = data.get("order") if isinstance(data, dict) else None
+    if not isinstance(order, list) or len(order) != count:
+        return None
+    if any(isinstance(i, bool) or not isinstance(i, int) for i in order):
+        return None
+    if sorted(order) != list(range(1, count + 1)):
+        return None
+    return [i - 1 for i in order]
+
+async def rank_channel_summaries(summaries, channel_description):
+    """
+    Упорядочивает выжимки одного канала от самой важной к наименее важной одним запросом.
+    Возвращает список индексов; при ошибке или некорректном ответе - исходный порядок.
+    """
+    original_order = list(range(len(summaries)))
+    if len(summaries) < 2:
+        return original_order
+
+    numbered = "\n\n".join(f"{i + 1}. {summary}" for i, summary in enumerate(summaries))
+    try:
+        answer = await complete(
+            "rank_channel_summaries",
+            messages=RANK_CHANNEL_SUMMARIES.messages(channel_description, summaries=numbered, count=len(summaries)),
+            max_tokens=10 + 5 * len(summaries),
+            validate=lambda answer: parse_summary_order(answer, len(summaries)) is not None
+        )
+    except LLMError as e:
+        logging.error(f"Ошибка при ранжировании выжимок: {e}")
+        return original_order
+
+    order = parse_summary_order(answer, len(summaries))
+    if order is None:
+        logging.warning(f"Некорректный ответ при ранжировании выжимок, оставляем исходный порядок: {answer}")
+        return original_order
+    return order
+
+async def _digest_channel(user_id, channel_username, posts, semaphore):
+    """
+    Собирает выжимки для одного канала.
+    Выжимки, сохраненные при опросе каналов, используются повторно; заново (и с сохранением в базу)
+    выжимаются только посты без актуальной выжимки. Затем выжимки канала упорядочиваются
+    не более чем одним запросом к OpenAI.
+    Возвращает (список пар (пост, выжимка), успешно обработанные посты).
+    """
+    channel_description = get_channel_description(user_id, channel_username) or "Канал без описания."
+
+    summaries = [get_stored_summary(post) for post in posts]
+    stale = [i for i, summary in enumerate(summaries) if summary is None]
+
+    if stale:
+        # Релевантность всех устаревших постов канала проверяем за один проход
+        stale_posts = [posts[i] for i in stale]
+        had_embedding = [bool(post.get('embedding')) for post in stale_posts]
+        async with semaphore:
+            verdicts = await classify_channel_posts(user_id, channel_username, stale_posts, channel_description)
+        for post, had in zip(stale_posts, had_embedding):
+            if not had and post.get('embedding'):
+                update_post_embedding(user_id, post['id'], post['embedding'])
+
+        async def summarize_one(post, relevant):
+            # Нерелевантный пост считается мусором, выжимку для него не делаем
+            if not relevant:
+                return ""
+            async with semaphore:
+                return await summarize_posts([post])
+
+        fresh = await asyncio.gather(
+            *(summarize_one(posts[i], relevant) for i, relevant in zip(stale, verdicts)),
+            return_exceptions=True
+        )
+        for i, summary in zip(stale, fresh):
+            summaries[i] = summary
+            if not isinstance(summary, Exception) and summary != SUMMARY_ERROR:
+                update_post_summary(user_id, posts[i]['id'], summary, SUMMARY_VERSION)
+
+    channel_summaries = []
+    done_posts = []
+    for post, summary in zip(posts, summaries):
+        if isinstance(summary, Exception) or summary == SUMMARY_ERROR:
+            logging.error(f"Не удалось сделать выжимку поста {post['post_id']} для дайджеста: {summary}")
+            continue
+        done_posts.append(post)
+
+        # Если summary пустая или это метка медиа, пропускаем этот пост (он считается мусором)
+        if not summary or not summary.strip() or is_media_only(summary):
+            continue
+        channel_summaries.append((post, summary))
+
+    if DIGEST_RANK_SUMMARIES and len(channel_summaries) > 1:
+        async with semaphore:
+            order = await rank_channel_summaries([summary for _, summary in channel_summaries], channel_description)
+        channel_summaries = [channel_summaries[i] for i in order]
+
+    return channel_summaries, done_posts
+
+def escape_md(text):
+    """
+    Экранирует спецсимволы Markdown.
+    """
+    escape_chars = ['*', '_', '`', '[', ']']
+    for char in escape_chars:
+        text = text.replace(char, f'\\{char}')
+    return text
+
+def _format_digest_item(cluster):
+    """
+    Строка дайджеста для группы почти одинаковых постов: выжимка первого поста
+    и ссылки на все источники.
+    Дайджест отправляется с разметкой Markdown: текст выжимки экранируется, ссылки остаются разметкой.
+    """
+    # post_id уже имеет вид 'channel/123'
+    post, summary = cluster[0]
+    line = f"{escape_md(summary)}\n [Ссылка](https://t.me/{post['post_id']})"
+    duplicates = [f"[@{other['channel_username']}](https://t.me/{other['post_id']})" for other, _ in cluster[1:]]
+    if duplicates:
+        line += f"\n Также: {', '.join(duplicates)}"
+    return line
+
+def _format_digest_sections(items, index):
+    """
+    Разделы дайджеста по каналам: {канал: текст}. Группа почти одинаковых постов попадает
+    в раздел канала, где она встретилась первой, со ссылками на все источники.
+    """
+    sections = {}
+    for cluster in index.clusters():
+        channel_username = items[cluster[0]][0]['channel_username']
+        sections.setdefault(channel_username, []).append(_format_digest_item([items[i] for i in cluster]))
+    return {channel_username: f"Канал: @{escape_md(channel_username)}\n\n" + "\n\n".join(lines)
+            for channel_username, lines in sections.items()}
+
+async def iter_digest(user_id):
+    """
+    Асинхронный генератор дайджеста непрочитанных (is_read=0) постов.
+    Каналы обрабатываются параллельно, и раздел каждого канала выдается сразу, как только он готов,
+    в виде пары (канал, текст): разделы идут в порядке готовности, а не в порядке каналов пользователя
+    (упорядоченный дайджест целиком возвращает generate_digest). Если позже пришедший пост оказался дубликатом уже выданного,
+    раздел канала-представителя выдается повторно с тем же ключом и обновленным текстом
+    (пустой текст - раздел больше не нужен). Служебные сообщения выдаются с ключом None.
+    Обработанные посты канала помечаются как прочитанные сразу после его обработки.
     """
     unread_posts = get_unread_posts(user_id)
     if not unread_posts:
-        return "Нет новых постов для дайджеста."
+        yield None, "Нет новых постов для дайджеста."
+        return
 
     # Группируем посты по каналам
     posts_by_channel = {}
@@ -139,41 +304,69 @@ async def generate_digest(user_id):
             posts_by_channel[channel] = []
         posts_by_channel[channel].append(post)
 
-    digest_parts = []
-
-    for channel_username, posts in posts_by_channel.items():
-        channel_description = get_channel_description(user_id, channel_username) or "Канал без описания."
-
-        # Сюда будем складывать строки дайджеста для данного канала
-        channel_digest_lines = []
-
-        for post in posts:
-            # Генерируем выжимку для одного поста
-            summary = await generate_summary_of_best_posts([post], channel_description)
-
-            # Если summary пустая, пропускаем этот пост (он считается мусором)
-            if not summary or not summary.strip():
+    # Все запросы к OpenAI внутри дайджеста выполняются параллельно, но не больше DIGEST_CONCURRENCY одновременно
+    semaphore = asyncio.Semaphore(DIGEST_CONCURRENCY)
+
+    async def digest_channel(channel_username, posts):
+        try:
+            with llm_context(user_id=user_id, stage="generate_digest"):
+                return channel_username, await _digest_channel(user_id, channel_username, posts, semaphore)
+        except Exception as e:
+            logging.error(f"Ошибка при составлении дайджеста по каналу @{channel_username}: {e}")
+            return channel_username, None
+
+    tasks = [asyncio.create_task(digest_channel(channel_username, posts))
+             for channel_username, posts in posts_by_channel.items()]
+    items = []
+    index = NearDuplicateIndex()
+    sent = {}
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            channel_username, result = await next_done
+            if result is None:
                 continue
-
-            # Формируем ссылку
-            post_link = f"https://t.me/{channel_username}/{post['post_id']}"
-            line_text = f"{summary}\n [Ссылка]({post_link})"
-            channel_digest_lines.append(line_text)
-
-        if channel_digest_lines:
-            combined_text = "\n\n".join(channel_digest_lines)
-            digest_parts.append(f"Канал: @{channel_username}\n\n{combined_text}")
-
-    # Все непрочитанные посты (включая те, у которых summary оказалось пустым) помечаем как прочитанные,
-    # чтобы не предлагать их повторно в будущем.
-    for post in unread_posts:
-        mark_posts_as_read(user_id, post['id'])
+            channel_summaries, done_posts = result
+
+            # Обработанные посты (включая те, у которых summary оказалось пустым) помечаем как прочитанные,
+            # чтобы не предлагать их повторно в будущем. Посты, на которых произошла ошибка, остаются
+            # непрочитанными и попадут в следующий дайджест.
+            for post in done_posts:
+                mark_posts_as_read(user_id, post['id'])
+
+            for post, summary in channel_summaries:
+                index.add(len(items), post['text'])
+                index.add(len(items), summary)
+                items.append((post, summary))
+
+            sections = _format_digest_sections(items, index)
+            for section_channel in list(sent) + [ch for ch in sections if ch not in sent]:
+                text = sections.get(section_channel, "")
+                if sent.get(section_channel) != text:
+                    sent[section_channel] = text
+                    yield section_channel, text
+    finally:
+        for task in tasks:
+            task.cancel()
 
     # Если после фильтрации «мусора» ничего не осталось
-    if not digest_parts:
-        return "Нет полезных постов для дайджеста."
+    if not any(sent.values()):
+        yield None, "Нет полезных постов для дайджеста."
 
-    return "\n\n".join(digest_parts)
+async def generate_digest(user_id):
+    """
+    Генерирует дайджест всех непрочитанных (is_read=0) постов, разбивая их по каналам.
+    Для каждого НЕпустого summary создаём скрытую ссылку [Ссылка].
+    Если summary пустое (мусор), пост не попадает в дайджест.
+    Разделы идут в порядке каналов пользователя, независимо от того, какой канал обработан раньше.
+    """
+    sections = {}
+    async for channel_username, text in iter_digest(user_id):
+        if channel_username is None:
+            return text
+        sections[channel_username] = text
+    order = {channel["username"]: i for i, channel in enumerate(get_user_channels(user_id))}
+    ordered = sorted(sections.items(), key=lambda item: order.get(item[0], len(order)))
+    return "\n\n".join(text for _, text in ordered if text)
 
 async def is_summary_relevant(summary, channel_description):
     """
@@ -186,26 +379,17 @@ async def is_summary_relevant(summary, channel_description):
 
     try:
         # Формируем запрос к OpenAI
-        user_content = f"Описание канала: {channel_description}\n\nSummary: {summary}\n\nСоответствует ли summary описанию канала? Ответь только 'Да' или 'Нет'."
+        messages = IS_SUMMARY_RELEVANT.messages(channel_description, summary=summary)
         # Логируем запрос
-        logging.info(f"Запрос к OpenAI:\n{user_content}")
+        logging.info(f"Запрос к OpenAI:\n{messages[-1]['content']}")
         # Отправляем запрос к OpenAI
-        response = await client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": "Ты — помощник, который анализирует, соответствует ли summary описанию канала."},
-                {"role": "user", "content": user_content}
-            ],
-            max_tokens=10
-        )
-
-        # Получаем ответ от OpenAI
-        decision = response.choices[0].message.content.strip().lower()
+        response = await complete("is_summary_relevant", messages=messages, max_tokens=10,
+                                  validate=is_yes_no, min_confidence=LLM_ESCALATE_CONFIDENCE)
 
         # Логируем ответ
-        logging.info(f"Ответ от OpenAI: {decision}")
+        logging.info(f"Ответ от OpenAI: {response.strip()}")
 
-        return decision == "да"
-    except Exception as e:
+        return parse_yes_no(response) is True
+    except LLMError as e:
         logging.error(f"Ошибка при проверке summary: {e}")
         return False  # В случае ошибки считаем summary мусором
\ No newline at end of file
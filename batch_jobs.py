@@ -0,0 +1,331 @@
+"""
+Пакетный режим фоновой обработки постов (BATCH_MODE).
+
+Вместо синхронных запросов к OpenAI при опросе каналов задания на проверку релевантности
+и выжимку копятся в очереди (BATCH_DB_PATH), раз в BATCH_FLUSH_INTERVAL отправляются
+одним JSONL-файлом в Batch API, а готовые результаты записываются обратно в posts.summary
+и в кэш LLM. Пост, признанный релевантным, получает задание на выжимку в следующем пакете.
+
+Для проверки без OpenAI есть локальная заглушка Batch API (mock_batch_api.py):
+    python mock_batch_api.py --port 8089
+и BATCH_API_BASE_URL = "http://127.0.0.1:8089/v1" в CONFIG.py.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+import metrics
+from CONFIG import (
+    OPENAI_MAX_TOKENS, BATCH_DB_PATH, BATCH_DIR, BATCH_COMPLETION_WINDOW, BATCH_MAX_REQUESTS,
+    BATCH_FLUSH_INTERVAL, BATCH_POLL_INTERVAL, BATCH_MAX_ATTEMPTS, BATCH_PRICE_FACTOR
+)
+from llm import PROMPT_VERSIONS, route_model
+from llm_gateway import get_gateway
+from llm_telemetry import llm_context, record_call
+from llm_cache import get_cache, make_key
+from database import update_post_summary_by_post_id, connect_db, release_connection
+from ai_analyzer import summary_messages, SUMMARY_VERSION
+from channel_analyzer import post_relevance_messages, parse_yes_no
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Виды заданий
+RELEVANCE = "relevance"
+SUMMARY = "summary"
+
+# Статусы пакета в Batch API, после которых он больше не изменится
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def _request(kind, post_text, channel_description):
+    """
+    (задача, тело запроса chat completions) для задания - те же промпты, что и без пакетного режима.
+    """
+    if kind == RELEVANCE:
+        return "is_post_relevant", {
+            "model": route_model("is_post_relevant"),
+            "messages": post_relevance_messages(post_text, channel_description),
+            "max_tokens": 10
+        }
+    return "summarize_posts", {
+        "model": route_model("summarize_posts"),
+        "messages": summary_messages([{'text': post_text}]),
+        "max_tokens": OPENAI_MAX_TOKENS
+    }
+
+
+class BatchProcessor:
+    """
+    Очередь заданий в SQLite и цикл отправки пакетов и разбора их результатов.
+    """
+
+    def __init__(self, path=BATCH_DB_PATH, batch_dir=BATCH_DIR):
+        self.path = path
+        self.batch_dir = batch_dir
+        self._create_tables()
+
+    def _create_tables(self):
+        conn = connect_db(self.path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS batch_jobs (
+                    custom_id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    post_id TEXT NOT NULL,
+                    post_text TEXT NOT NULL,
+                    channel_description TEXT,
+                    batch_id TEXT,                    -- NULL, пока задание не отправлено
+                    status TEXT NOT NULL,             -- pending, submitted, done, failed
+                    attempts INTEGER NOT NULL DEFAULT 0,  -- сколько раз задание отправлялось
+                    created_at REAL NOT NULL
+                )
+            ''')
+            cursor.execute('PRAGMA table_info(batch_jobs)')
+            if 'attempts' not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute('ALTER TABLE batch_jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_batch_jobs_status ON batch_jobs (status, created_at)')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS batches (
+                    batch_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            conn.commit()
+        except Exception as e:
+            logging.error(f"Ошибка при создании таблиц пакетной обработки: {e}")
+        finally:
+            release_connection(conn)
+
+    def enqueue(self, kind, user_id, post_id, post_text, channel_description=None):
+        """
+        Ставит задание в очередь. Повторная постановка того же задания ничего не делает.
+        """
+        conn = connect_db(self.path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                INSERT OR IGNORE INTO batch_jobs
+                    (custom_id, kind, user_id, post_id, post_text, channel_description, status, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, 'pending', ?)
+            ''', (f"{kind}:{user_id}:{post_id}", kind, user_id, post_id, post_text, channel_description, time.time()))
+            conn.commit()
+        except Exception as e:
+            logging.error(f"Ошибка при постановке задания {kind} для поста {post_id} в очередь: {e}")
+        finally:
+            release_connection(conn)
+
+    def _pending_jobs(self, limit):
+        conn = connect_db(self.path)
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        try:
+            cursor.execute("SELECT * FROM batch_jobs WHERE status = 'pending' ORDER BY created_at LIMIT ?", (limit,))
+            return [dict(row) for row in cursor.fetchall()]
+        finally:
+            release_connection(conn)
+
+    def _should_flush(self):
+        """
+        Пакет отправляется, когда заданий набралось на целый пакет или самое старое ждет
+        дольше BATCH_FLUSH_INTERVAL.
+        """
+        conn = connect_db(self.path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT COUNT(*), MIN(created_at) FROM batch_jobs WHERE status = 'pending'")
+            count, oldest = cursor.fetchone()
+        finally:
+            release_connection(conn)
+        return count >= BATCH_MAX_REQUESTS or (count > 0 and time.time() - oldest >= BATCH_FLUSH_INTERVAL)
+
+    async def submit(self):
+        """
+        Отправляет накопившиеся задания одним пакетом. Возвращает id пакета или None.
+        """
+        jobs = self._pending_jobs(BATCH_MAX_REQUESTS)
+        if not jobs:
+            return None
+
+        os.makedirs(self.batch_dir, exist_ok=True)
+        path = os.path.join(self.batch_dir, f"batch_{int(time.time() * 1000)}.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            for job in jobs:
+                _, body = _request(job['kind'], job['post_text'], job['channel_description'])
+                line = {"custom_id": job['custom_id'], "method": "POST", "url": "/v1/chat/completions", "body": body}
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+        # Запросы к Batch API идут через общий шлюз: с его повторами, сроками и полосами
+        gateway = get_gateway()
+        with open(path, "rb") as f:
+            data = f.read()
+        input_file = await gateway.batch(
+            "batch_upload", lambda client: client.files.create(file=(os.path.basename(path), data), purpose="batch")
+        )
+        batch = await gateway.batch("batch_create", lambda client: client.batches.create(
+            input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window=BATCH_COMPLETION_WINDOW
+        ))
+
+        conn = connect_db(self.path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute('INSERT INTO batches (batch_id, status, created_at) VALUES (?, ?, ?)',
+                           (batch.id, batch.status, time.time()))
+            cursor.executemany("UPDATE batch_jobs SET status = 'submitted', batch_id = ?, attempts = attempts + 1 WHERE custom_id = ?",
+                               [(batch.id, job['custom_id']) for job in jobs])
+            conn.commit()
+        finally:
+            release_connection(conn)
+        for job in jobs:
+            metrics.inc("batch_jobs_submitted_total", kind=job['kind'])
+        logging.info(f"Отправлен пакет {batch.id}: {len(jobs)} заданий ({path}).")
+        return batch.id
+
+    def _open_batches(self):
+        conn = connect_db(self.path)
+        cursor = conn.cursor()
+        try:
+            placeholders = ", ".join("?" * len(FINAL_STATUSES))
+            cursor.execute(f'SELECT batch_id FROM batches WHERE status NOT IN ({placeholders})', tuple(FINAL_STATUSES))
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            release_connection(conn)
+
+    def _submitted_jobs(self, batch_id):
+        conn = connect_db(self.path)
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        try:
+            cursor.execute("SELECT * FROM batch_jobs WHERE batch_id = ? AND status = 'submitted'", (batch_id,))
+            return {row['custom_id']: dict(row) for row in cursor.fetchall()}
+        finally:
+            release_connection(conn)
+
+    def _finish_batch(self, batch_id, status, job_statuses):
+        conn = connect_db(self.path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute('UPDATE batches SET status = ? WHERE batch_id = ?', (status, batch_id))
+            cursor.executemany('UPDATE batch_jobs SET status = ? WHERE custom_id = ?',
+                               [(job_status, custom_id) for custom_id, job_status in job_statuses.items()])
+            # Задания без результата (пакет истек или отменен) возвращаются в очередь,
+            # пока не исчерпаны BATCH_MAX_ATTEMPTS попыток
+            cursor.execute('''
+                UPDATE batch_jobs
+                SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                    batch_id = CASE WHEN attempts < ? THEN NULL ELSE batch_id END
+                WHERE batch_id = ? AND status = 'submitted'
+            ''', (BATCH_MAX_ATTEMPTS, BATCH_MAX_ATTEMPTS, batch_id))
+            conn.commit()
+        finally:
+            release_connection(conn)
+
+    def _apply_result(self, job, content):
+        """
+        Записывает результат задания в базу пользователя и в кэш LLM.
+        """
+        task, body = _request(job['kind'], job['post_text'], job['channel_description'])
+        key = make_key(body["model"], task, PROMPT_VERSIONS.get(task, 1),
+                       {"messages": body["messages"], "max_tokens": body["max_tokens"]})
+        get_cache().set(key, task, content)
+
+        if job['kind'] == RELEVANCE:
+            if parse_yes_no(content) is True:
+                self.enqueue(SUMMARY, job['user_id'], job['post_id'], job['post_text'])
+            else:
+                # Нерелевантный пост считается мусором, выжимку для него не делаем
+                update_post_summary_by_post_id(job['user_id'], job['post_id'], "", SUMMARY_VERSION)
+        else:
+            update_post_summary_by_post_id(job['user_id'], job['post_id'], content, SUMMARY_VERSION)
+
+    @staticmethod
+    def _record_usage(job, body, latency):
+        """
+        Записывает выполненный запрос пакета в телеметрию LLM (токены и стоимость со скидкой Batch API).
+        Задача помечается суффиксом ':batch', чтобы задержка пакета не смешивалась с обычными запросами.
+        """
+        task, request = _request(job['kind'], job['post_text'], job['channel_description'])
+        usage = body.get("usage") or {}
+        details = usage.get("prompt_tokens_details") or {}
+        with llm_context(user_id=job['user_id'], stage="batch_jobs"):
+            record_call(
+                f"{task}:batch", body.get("model") or request["model"], latency,
+                prompt_tokens=usage.get("prompt_tokens") or 0,
+                completion_tokens=usage.get("completion_tokens") or 0,
+                cached_tokens=details.get("cached_tokens") or 0,
+                price_factor=BATCH_PRICE_FACTOR
+            )
+
+    async def poll(self):
+        """
+        Проверяет отправленные пакеты и разбирает результаты завершившихся.
+        """
+        gateway = get_gateway()
+        for batch_id in self._open_batches():
+            batch = await gateway.batch("batch_retrieve", lambda client: client.batches.retrieve(batch_id))
+            if batch.status not in FINAL_STATUSES:
+                continue
+
+            jobs = self._submitted_jobs(batch_id)
+            job_statuses = {}
+            # Успешные запросы приходят в output_file_id, запросы с ошибкой - в error_file_id
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if not file_id:
+                    continue
+                output = await gateway.batch("batch_download", lambda client: client.files.content(file_id))
+                for line in output.text.splitlines():
+                    if not line.strip():
+                        continue
+                    result = json.loads(line)
+                    job = jobs.get(result.get("custom_id"))
+                    if job is None:
+                        continue
+                    response = result.get("response") or {}
+                    try:
+                        if response.get("status_code") != 200:
+                            raise ValueError(result.get("error") or response)
+                        self._record_usage(job, response["body"], time.time() - batch.created_at)
+                        content = response["body"]["choices"][0]["message"]["content"]
+                        self._apply_result(job, content)
+                        job_statuses[job['custom_id']] = "done"
+                    except Exception as e:
+                        # Выжимка остается пустой (NULL), и дайджест сделает ее сам
+                        logging.error(f"Ошибка в результате задания {job['custom_id']}: {e}")
+                        job_statuses[job['custom_id']] = "failed"
+            for job_status in job_statuses.values():
+                metrics.inc("batch_jobs_completed_total", status=job_status)
+            self._finish_batch(batch_id, batch.status, job_statuses)
+            logging.info(f"Пакет {batch_id} завершен со статусом {batch.status}: обработано {len(job_statuses)} из {len(jobs)} заданий.")
+
+    async def run(self):
+        """
+        Фоновый цикл: отправляет накопившиеся задания и забирает готовые результаты.
+        """
+        while True:
+            try:
+                if self._should_flush():
+                    await self.submit()
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка пакетной обработки: {e}")
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+
+
+_processor = None
+
+
+def get_batch_processor():
+    """
+    Возвращает общий (единственный на процесс) экземпляр BatchProcessor.
+    """
+    global _processor
+    if _processor is None:
+        _processor = BatchProcessor()
+    return _processor
@@ -0,0 +1,139 @@
+"""
+Бенчмарк работы с базами пользователей (database.py).
+
+Воспроизводит запросы одного прохода check_new_posts (проверка поста, описание канала,
+сохранение поста и курсора, пометка прочитанным) и сравнивает прежний способ - новое
+соединение на каждую операцию в режиме журнала по умолчанию - с долгоживущими
+соединениями ConnectionManager (WAL, synchronous, cache_size, кэш подготовленных запросов).
+
+Запуск из корня репозитория:
+    python benchmarks/bench_database.py [пользователей] [постов на пользователя]
+Базы создаются во временном каталоге.
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from database import (
+    create_user_tables, add_user_channel, add_channel_description, is_post_processed, add_post,
+    get_channel_description, set_channel_cursor, mark_posts_as_read, close_all_connections
+)
+
+CHANNEL = "bench_channel"
+OPERATIONS_PER_POST = 5
+
+
+def legacy_pass(user_id, post_number):
+    """
+    Те же операции, что в managed_pass, но как раньше: соединение открывается и закрывается
+    для каждой операции.
+    """
+    post_id = f"{CHANNEL}/{post_number}"
+    path = f"user_{user_id}.db"
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('SELECT 1 FROM posts WHERE post_id = ?', (post_id,)).fetchone()
+    finally:
+        conn.close()
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('SELECT description FROM channel_descriptions WHERE username = ?', (CHANNEL,)).fetchone()
+    finally:
+        conn.close()
+
+    conn = sqlite3.connect(path)
+    try:
+        cursor = conn.execute('''
+            INSERT INTO posts (post_id, content, summary, post_number, channel_username, is_read, summary_version, embedding)
+            VALUES (?, ?, ?, ?, ?, 0, ?, ?)
+        ''', (post_id, "текст поста " * 20, "выжимка", post_number, CHANNEL, 1, None))
+        row_id = cursor.lastrowid
+        conn.commit()
+    finally:
+        conn.close()
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('''
+            INSERT INTO channel_cursors (username, last_post_id) VALUES (?, ?)
+            ON CONFLICT(username) DO UPDATE SET last_post_id = MAX(last_post_id, excluded.last_post_id)
+        ''', (CHANNEL, post_number))
+        conn.commit()
+    finally:
+        conn.close()
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('UPDATE posts SET is_read = 1 WHERE id = ?', (row_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def managed_pass(user_id, post_number):
+    post_id = f"{CHANNEL}/{post_number}"
+    is_post_processed(user_id, post_id)
+    get_channel_description(user_id, CHANNEL)
+    add_post(user_id, post_id, "текст поста " * 20, "выжимка", post_number, CHANNEL, 1)
+    set_channel_cursor(user_id, CHANNEL, post_number)
+    mark_posts_as_read(user_id, post_number)  # id строки совпадает с номером в пустой базе
+
+
+def prepare(directory, users, journal_mode):
+    os.chdir(directory)
+    for user_id in range(users):
+        create_user_tables(user_id)
+        add_user_channel(user_id, CHANNEL)
+        add_channel_description(user_id, CHANNEL, "Описание канала для бенчмарка")
+    close_all_connections()
+    # Режим журнала хранится в файле базы: для прежнего способа возвращаем режим по умолчанию
+    for user_id in range(users):
+        conn = sqlite3.connect(f"user_{user_id}.db")
+        conn.execute(f'PRAGMA journal_mode={journal_mode}')
+        conn.close()
+
+
+def measure(run_pass, users, posts):
+    started = time.perf_counter()
+    for post_number in range(1, posts + 1):
+        for user_id in range(users):
+            run_pass(user_id, post_number)
+    return users * posts * OPERATIONS_PER_POST / (time.perf_counter() - started)
+
+
+def main(argv):
+    users = int(argv[0]) if len(argv) > 0 else 20
+    posts = int(argv[1]) if len(argv) > 1 else 200
+    # Логи каждой операции искажают замер
+    database.logging.disable(database.logging.INFO)
+    cwd = os.getcwd()
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            prepare(directory, users, "DELETE")
+            results["connect на операцию"] = measure(legacy_pass, users, posts)
+        with tempfile.TemporaryDirectory() as directory:
+            prepare(directory, users, "WAL")
+            results["ConnectionManager"] = measure(managed_pass, users, posts)
+            close_all_connections()
+    finally:
+        os.chdir(cwd)
+
+    print(f"{users} пользователей x {posts} постов x {OPERATIONS_PER_POST} операций, "
+          f"открыто не больше {database.DB_MAX_OPEN_CONNECTIONS} баз\n")
+    baseline = results["connect на операцию"]
+    print(f"{'способ':<24}{'операций/с':>12}{'ускорение':>12}")
+    for name, rate in results.items():
+        print(f"{name:<24}{rate:>12.0f}{rate / baseline:>11.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
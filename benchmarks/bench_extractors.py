@@ -0,0 +1,92 @@
+"""
+Бенчмарк бэкендов разбора страниц каналов (extractors.py).
+
+Для каждой сохраненной страницы t.me сначала проверяет, что каждый бэкенд
+возвращает ровно то же, что эталонный BeautifulSoup (дифференциальная проверка),
+затем измеряет скорость в постах в секунду.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_extractors.py [страница.html ...]
+Без аргументов используются страницы из benchmarks/fixtures.
+"""
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extractors import EXTRACTORS, extract_posts_bs4
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+MIN_SECONDS = 1.0  # Минимальное время измерения одного бэкенда на одной странице
+
+
+def load_pages(paths):
+    pages = {}
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            pages[os.path.basename(path)] = f.read()
+    return pages
+
+
+def check_equal(pages):
+    """
+    Сравнивает вывод каждого бэкенда с BeautifulSoup. Возвращает список расхождений.
+    """
+    mismatches = []
+    for page_name, html in pages.items():
+        expected = extract_posts_bs4(html)
+        for name, extractor in EXTRACTORS.items():
+            actual = extractor(html)
+            if actual != expected:
+                mismatches.append((page_name, name, expected, actual))
+    return mismatches
+
+
+def measure(extractor, html):
+    """
+    Возвращает количество постов в секунду для одного бэкенда на одной странице.
+    """
+    posts_per_call = len(extractor(html))
+    calls = 0
+    started = time.perf_counter()
+    while True:
+        extractor(html)
+        calls += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= MIN_SECONDS:
+            return posts_per_call * calls / elapsed
+
+
+def main(argv):
+    paths = argv or sorted(glob.glob(os.path.join(FIXTURES_DIR, "*.html")))
+    if not paths:
+        print("Нет страниц для бенчмарка.")
+        return 1
+    pages = load_pages(paths)
+
+    mismatches = check_equal(pages)
+    for page_name, name, expected, actual in mismatches:
+        print(f"РАСХОЖДЕНИЕ: {name} на {page_name}")
+        for exp, act in zip(expected, actual):
+            if exp != act:
+                print(f"  bs4: {exp}\n  {name}: {act}")
+                break
+        else:
+            print(f"  bs4 нашел {len(expected)} постов, {name} - {len(actual)}")
+    if mismatches:
+        return 1
+    print(f"Вывод всех бэкендов ({', '.join(EXTRACTORS)}) совпадает с bs4.\n")
+
+    print(f"{'страница':<24}{'бэкенд':<12}{'постов/с':>12}{'ускорение':>12}")
+    for page_name, html in pages.items():
+        baseline = measure(extract_posts_bs4, html)
+        for name, extractor in EXTRACTORS.items():
+            rate = baseline if name == "bs4" else measure(extractor, html)
+            print(f"{page_name:<24}{name:<12}{rate:>12.0f}{rate / baseline:>11.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -13,13 +13,19 @@ import asyncio
 from database import (
     create_user_tables, get_unread_posts, mark_posts_as_read, add_user_channel, remove_user_channel,
     get_user_channels, is_active, activate_user, deactivate_user, get_channel_description,
-    add_channel_description, add_detailed_channel_description
+    add_channel_description, add_detailed_channel_description, close_all_connections
 )
-from CONFIG import TELEGRAM_BOT_API
+from CONFIG import TELEGRAM_BOT_API, TELEGRAM_MESSAGE_LIMIT, METRICS_PORT, METRICS_HOST
 # Важно, чтобы был импорт get_last_posts, если вы используете его при добавлении канала
-from AI_main import check_new_posts, auto_update, get_last_posts
-from ai_analyzer import generate_summary_of_best_posts, remove_duplicate_summaries, is_summary_relevant, generate_digest
-from channel_analyzer import create_detailed_channel_description, create_short_channel_description
+from AI_main import check_new_posts
+from channel_poller import get_poller, get_last_posts
+from scheduler import get_scheduler
+from ai_analyzer import iter_digest, escape_md
+from channel_analyzer import create_channel_profile
+from fetcher import close_fetcher, breakers_report
+from llm_gateway import close_gateway
+from llm_telemetry import llm_context, summary_report, INTERACTIVE
+import metrics
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -37,16 +43,6 @@ class AddChannel(StatesGroup):
     waiting_for_channel = State()
 
 
-def escape_md(text):
-    """
-    Экранирует спецсимволы Markdown.
-    """
-    escape_chars = ['*', '_', '`', '[', ']']
-    for char in escape_chars:
-        text = text.replace(char, f'\\{char}')
-    return text
-
-
 def get_main_keyboard(user_id):
     """
     Возвращает клавиатуру в зависимости от состояния активации.
@@ -94,6 +90,10 @@ async def send_welcome(message: Message):
 
 @dp.message(lambda message: message.text == "Включить бота")
 async def activate_ai_main(message: Message):
+    """
+    Обработчик нажатия на кнопку "Включить бота".
+    Сразу изучает новые посты и передает пользователя планировщику фоновой работы.
+    """
     user_id = message.from_user.id
 
     channels = get_user_channels(user_id)
@@ -105,9 +105,16 @@ async def activate_ai_main(message: Message):
         return
 
     activate_user(user_id)
+    create_user_tables(user_id)  # Обновляет схему таблиц, созданных старыми версиями бота
 
     waiting_msg = await message.answer("Идет изучение постов. Подождите...")
-    summaries, new_posts_found = await check_new_posts(user_id)
+    # Подписываем пользователя на общую ленту и сразу опрашиваем его каналы
+    poller = get_poller()
+    if not poller.is_subscribed(user_id):
+        poller.subscribe(user_id)
+    await poller.poll_user_now(user_id)
+    with llm_context(user_id=user_id):
+        summaries, new_posts_found = await check_new_posts(user_id, poller.drain(user_id))
     await waiting_msg.delete()
 
     await message.answer(
@@ -116,23 +123,8 @@ async def activate_ai_main(message: Message):
         reply_markup=get_main_keyboard(user_id)
     )
 
-
-    asyncio.create_task(auto_update(user_id))
-    """
-    Обработчик нажатия на кнопку "Включить бота".
-    Теперь не делает сразу выжимку из всех постов, а просто активирует бота.
-    """
-    user_id = message.from_user.id
-    channels = get_user_channels(user_id)
-    if not channels:
-        await message.answer(
-            escape_md("Вы не добавили ни одного канала. Сначала добавьте каналы, чтобы начать отслеживание."),
-            reply_markup=get_main_keyboard(user_id)
-        )
-        return
-
-    activate_user(user_id)
-
+    # Планировщик держит не больше одного обработчика на пользователя
+    get_scheduler().register(user_id)
 
 
 @dp.message(lambda message: message.text == "Отключить бота")
@@ -142,6 +134,7 @@ async def deactivate_ai_main(message: Message):
     """
     user_id = message.from_user.id
     deactivate_user(user_id)
+    get_scheduler().unregister(user_id)
     await message.answer(
         escape_md("Отслеживание постов деактивировано. Теперь вы можете изменять список каналов."),
         reply_markup=get_main_keyboard(user_id)
@@ -180,17 +173,21 @@ async def add_channel_finish(message: Message, state: FSMContext):
         # Получаем последние посты канала (максимум 30)
         posts = await get_last_posts(channel_username, limit=30)
 
-        # Создаем краткое и подробное описание канала
-        short_description = await create_short_channel_description(posts)
-        detailed_description = await create_detailed_channel_description(posts)
+        # Создаем краткое и подробное описание канала и ключевые слова одним запросом
+        with llm_context(user_id=user_id, stage="add_channel", lane=INTERACTIVE):
+            profile = await create_channel_profile(posts)
+        short_description = profile["short_description"]
 
         # Добавляем канал и его описания в базу данных
         add_user_channel(user_id, channel_username)
-        add_channel_description(user_id, channel_username, short_description)
-        add_detailed_channel_description(user_id, channel_username, detailed_description)
+        add_channel_description(user_id, channel_username, short_description, profile["keywords"])
+        add_detailed_channel_description(user_id, channel_username, profile["detailed_description"])
 
+        reply = f"Канал @{channel_username} добавлен в список отслеживаемых.\n\nКраткое описание: {short_description}"
+        if profile["keywords"]:
+            reply += f"\n\nТемы: {', '.join(profile['keywords'])}"
         await message.answer(
-            escape_md(f"Канал @{channel_username} добавлен в список отслеживаемых.\n\nКраткое описание: {short_description}"),
+            escape_md(reply),
             reply_markup=get_main_keyboard(user_id)
         )
     except Exception as e:
@@ -306,27 +303,47 @@ async def get_new_posts(message: Message):
         mark_posts_as_read(user_id, post['id'])
 
 
+def _safe_cut(text, limit):
+    """
+    Позиция разреза текста с разметкой Markdown не дальше limit: по границе абзаца, строки
+    или слова, а если их нет - так, чтобы не разорвать экранирование (\\x) и ссылку [текст](url).
+    """
+    for separator in ("\n\n", "\n", " "):
+        cut = text.rfind(separator, 0, limit)
+        if cut > 0:
+            return cut
+    cut = limit
+    while cut > 1 and text[cut - 1] == "\\":
+        cut -= 1
+    link_start = text.rfind("[", 0, cut)
+    if link_start > 0 and text[link_start - 1] != "\\" and text.find(")", link_start) >= cut:
+        cut = link_start
+    return cut
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Делит текст на части не длиннее limit символов, по возможности по границам абзацев.
+    Текст уже размечен (Markdown), поэтому разрез не попадает внутрь экранирования или ссылки.
+    """
+    parts = []
+    while len(text) > limit:
+        cut = _safe_cut(text, limit)
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n ")
+    if text:
+        parts.append(text)
+    return parts
+
+
 @dp.message(Command("digest"))
 @dp.message(lambda message: message.text == "Дайджест")
 async def send_digest(message: Message):
-    user_id = message.from_user.id
-    if not is_active(user_id):
-        await message.answer("❌ Отслеживание не активировано. Сначала включите бота, чтобы получать дайджест.")
-        return
-
-    # 1) Отправляем служебное сообщение о генерации
-    waiting_msg = await message.answer("Генерируется дайджест...")
-
-    # 2) Генерируем дайджест (может занять время)
-    digest_text = await generate_digest(user_id)
-
-    # 3) Удаляем сообщение "Генерируется дайджест..."
-    await waiting_msg.delete()
-
-    # 4) Отправляем сам дайджест
-    await message.answer(digest_text)
-
-
+    """
+    Обработчик команды /digest ИЛИ нажатия на кнопку "Дайджест".
+    Отправляет раздел каждого канала, как только он готов (разделы приходят в порядке готовности,
+    а не в порядке списка каналов); если раздел позже обновился
+    (нашелся дубликат из другого канала), редактирует уже отправленные сообщения.
+    """
     user_id = message.from_user.id
     if not is_active(user_id):
         await message.answer(
@@ -335,22 +352,72 @@ async def send_digest(message: Message):
         )
         return
 
-    # Сгенерировать дайджест (внутри generate_digest в конце вызывается mark_posts_as_read)
-    digest = await generate_digest(user_id)
-    await message.answer(escape_md(digest), reply_markup=get_main_keyboard(user_id))
-    # Здесь postы уже помечены как прочитанные => удалены из БД
-    # благодаря логике в generate_digest и mark_posts_as_read.
+    waiting_msg = await message.answer("Генерируется дайджест...")
+    sent_messages = {}  # канал -> {номер части раздела: (отправленное сообщение, его текст)}
+    # Дайджест ждет пользователь: его запросы к OpenAI идут впереди фоновой обработки постов
+    with llm_context(user_id=user_id, lane=INTERACTIVE):
+        # Внутри iter_digest обработанные посты помечаются как прочитанные
+        async for channel_username, text in iter_digest(user_id):
+            if waiting_msg is not None:
+                await waiting_msg.delete()
+                waiting_msg = None
+
+            if channel_username is None:
+                await message.answer(escape_md(text), reply_markup=get_main_keyboard(user_id))
+                continue
+
+            parts = split_message(text)
+            messages = sent_messages.setdefault(channel_username, {})
+            # Ошибка одной части не должна мешать отправке остальных: сообщения хранятся по номеру
+            # части, поэтому неотправленная часть не сдвигает следующие. Неизменившиеся части
+            # не редактируются (Telegram отвечает на это "message is not modified")
+            for i, part in enumerate(parts):
+                sent = messages.get(i)
+                try:
+                    if sent is None:
+                        messages[i] = (await message.answer(part), part)
+                    elif sent[1] != part:
+                        await sent[0].edit_text(part)
+                        messages[i] = (sent[0], part)
+                except Exception as e:
+                    logging.error(f"Ошибка при отправке раздела дайджеста по каналу @{channel_username}: {e}")
+            for i in [i for i in messages if i >= len(parts)]:
+                extra, _ = messages.pop(i)
+                try:
+                    await extra.delete()
+                except Exception as e:
+                    logging.error(f"Ошибка при удалении раздела дайджеста по каналу @{channel_username}: {e}")
+
+    if waiting_msg is not None:
+        await waiting_msg.delete()
 
 
 async def main():
     """
     Основная функция для запуска бота.
     """
+    # Планировщик запускает центральный опрос каналов и обработчики активных пользователей
+    scheduler = get_scheduler()
+    await scheduler.start()
+    # /metrics - метрики в формате Prometheus, /report - сводка по запросам к OpenAI,
+    # /breakers - предохранители каналов с ошибками
+    metrics_runner = None
+    if METRICS_PORT:
+        metrics_runner = await metrics.start_http_server(
+            METRICS_PORT, {"/report": summary_report, "/breakers": breakers_report}, host=METRICS_HOST
+        )
     try:
         await dp.start_polling(bot)
     except Exception as e:
         logging.error(f"Ошибка при запуске бота: {e}")
     finally:
+        await scheduler.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        logging.info(summary_report())
+        await close_fetcher()
+        await close_gateway()
+        close_all_connections()
         await bot.session.close()
 
 
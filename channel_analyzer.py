@@ -1,12 +1,59 @@
+import asyncio
+import json
 import logging
-from openai import AsyncOpenAI
-from CONFIG import OPENAI_API, OPENAI_MODEL, OPENAI_MAX_TOKENS
+import re
+import metrics
+from CONFIG import OPENAI_MAX_TOKENS, LLM_ESCALATE_CONFIDENCE, RELEVANCE_BATCH_SIZE, RELEVANCE_TIEBREAK_MARGIN
+from llm import complete, LLMError
+from prompts import IS_POST_RELEVANT, CLASSIFY_POSTS_RELEVANCE, FILTER_UNRELATED_POSTS
+from prefilter import get_prefilter, CHECK
+from token_budget import pack_texts, prompt_budget, count_tokens, truncate_to_tokens
 
 # Настройка логирования
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Настройки OpenAI
-client = AsyncOpenAI(api_key=OPENAI_API)
+async def _summarize_chunk(chunk):
+    """
+    Шаг map: сжимает часть постов канала до заметок о темах и ключевых идеях.
+    """
+    return await complete(
+        "summarize_channel_chunk",
+        messages=[
+            {"role": "system", "content": "Ты — эксперт, который анализирует контент каналов."},
+            {"role": "user", "content": f"Выпиши сжато основные темы, проекты, термины и ключевые идеи этих постов канала:\n\n{chunk}"}
+        ],
+        max_tokens=OPENAI_MAX_TOKENS
+    )
+
+async def _complete_over_posts(task, system_prompt, instruction, texts, max_tokens, validate=None):
+    """
+    Запрос к OpenAI вида "instruction + тексты постов" с учетом длины контекста.
+    Если посты не помещаются в один запрос, они раскладываются по кускам, каждый кусок
+    параллельно сжимается до заметок (map), и instruction выполняется уже по заметкам (reduce).
+    validate проверяет итоговый ответ (см. llm.complete).
+    """
+    def build_messages(content):
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"{instruction}\n\n{content}"}
+        ]
+
+    budget = prompt_budget(build_messages(""), max_tokens)
+    chunks = pack_texts(texts, budget)
+    while len(chunks) > 1:
+        logging.info(f"Посты для {task} не помещаются в один запрос, сжимаем {len(chunks)} частей.")
+        notes = await asyncio.gather(*(_summarize_chunk(chunk) for chunk in chunks))
+        packed = pack_texts(notes, budget)
+        if len(packed) >= len(chunks):
+            # Заметки не стали короче исходных кусков: обрезаем каждую до равной доли бюджета,
+            # чтобы описание строилось по всем постам, а не по первой части
+            share = max(1, budget // len(notes) - count_tokens("\n\n"))
+            logging.warning(f"Заметки для {task} не сократились, обрезаем каждую из {len(notes)} до {share} токенов.")
+            packed = pack_texts([truncate_to_tokens(note, share) for note in notes], budget)
+        chunks = packed
+
+    return await complete(task, messages=build_messages(chunks[0] if chunks else ""), max_tokens=max_tokens,
+                          validate=validate)
 
 async def analyze_channel_content(posts):
     """
@@ -16,22 +63,17 @@ async def analyze_channel_content(posts):
         return "Канал не содержит постов."
 
     try:
-        # Объединяем тексты постов в один текст для анализа
-        content = "\n\n".join([post['text'] for post in posts if 'text' in post and post['text'].strip()])
-
         # Запрашиваем у OpenAI краткое описание канала
-        response = await client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": "Ты — эксперт, который анализирует контент каналов и создает краткие описания."},
-                {"role": "user", "content": f"Проанализируй контент этого канала и составь список основных тем, которые канал затрагивает, самые упоминаемые проекты/термины. Всего уложись в 4-5 предложений.\n\n{content}"}
-            ],
+        description = await _complete_over_posts(
+            "analyze_channel_content",
+            "Ты — эксперт, который анализирует контент каналов и создает краткие описания.",
+            "Проанализируй контент этого канала и составь список основных тем, которые канал затрагивает, самые упоминаемые проекты/термины. Всего уложись в 4-5 предложений.",
+            [post['text'] for post in posts if 'text' in post and post['text'].strip()],
             max_tokens=OPENAI_MAX_TOKENS
         )
-        description = response.choices[0].message.content
         logging.info(f"Создано описание канала: {description}")
         return description
-    except Exception as e:
+    except LLMError as e:
         logging.error(f"Ошибка при анализе контента канала: {e}")
         return "Не удалось создать описание канала."
 
@@ -47,19 +89,16 @@ async def filter_unrelated_posts(posts, channel_description):
         content = "\n\n".join([post['text'] for post in posts if 'text' in post and post['text'].strip()])
 
         # Запрашиваем у OpenAI фильтрацию постов
-        response = await client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": "Ты — помощник, который фильтрует посты на основе тематики канала. Будь менее строг при отборе."},
-                {"role": "user", "content": f"Описание канала: {channel_description}\n\nОтфильтруй эти посты и оставь только те, которые хотя бы частично связаны с тематикой канала, без жёсткого отсечения:\n\n{content}"}
-            ],
+        response = await complete(
+            "filter_unrelated_posts",
+            messages=FILTER_UNRELATED_POSTS.messages(channel_description, posts=content),
             max_tokens=OPENAI_MAX_TOKENS
         )
         # Предположим, что модель возвращает в ответ список постов (или фрагменты)
-        filtered_posts = response.choices[0].message.content.split("\n\n")
+        filtered_posts = response.split("\n\n")
         logging.info(f"Отфильтровано постов: {len(filtered_posts)}")
         return [post for post in posts if post['text'] in filtered_posts]
-    except Exception as e:
+    except LLMError as e:
         logging.error(f"Ошибка при фильтрации постов: {e}")
         return posts  # В случае ошибки возвращаем оригинальный список
 
@@ -71,22 +110,17 @@ async def create_short_channel_description(posts):
         return "Канал не содержит постов."
 
     try:
-        # Объединяем тексты постов в один текст для анализа
-        content = "\n\n".join([post['text'] for post in posts if 'text' in post and post['text'].strip()])
-
         # Запрашиваем у OpenAI краткое описание канала
-        response = await client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": "Ты — эксперт, который анализирует контент каналов и создает краткие описания."},
-                {"role": "user", "content": f"Проанализируй контент этого канала и составь краткое описание его тематики. Описание должно быть коротким, максимум 2-3 предложения:\n\n{content}"}
-            ],
+        description = await _complete_over_posts(
+            "create_short_channel_description",
+            "Ты — эксперт, который анализирует контент каналов и создает краткие описания.",
+            "Проанализируй контент этого канала и составь краткое описание его тематики. Описание должно быть коротким, максимум 2-3 предложения:",
+            [post['text'] for post in posts if 'text' in post and post['text'].strip()],
             max_tokens=100  # Ограничиваем количество токенов для краткости
         )
-        description = response.choices[0].message.content
         logging.info(f"Создано краткое описание канала: {description}")
         return description
-    except Exception as e:
+    except LLMError as e:
         logging.error(f"Ошибка при создании краткого описания канала: {e}")
         return "Не удалось создать краткое описание канала."
 
@@ -98,25 +132,110 @@ async def create_detailed_channel_description(posts):
         return "Канал не содержит постов."
 
     try:
-        # Объединяем тексты постов в один текст для анализа
-        content = "\n\n".join([post['text'] for post in posts if 'text' in post and post['text'].strip()])
-
         # Запрашиваем у OpenAI подробное описание канала
-        response = await client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": "Ты — эксперт, который анализирует контент каналов и создает подробные описания."},
-                {"role": "user", "content": f"Проанализируй контент этого канала и создай подробное описание его тематики, основных тем и ключевых идей. Будь детальным, но не слишком строгим при описании границ тематики:\n\n{content}"}
-            ],
+        description = await _complete_over_posts(
+            "create_detailed_channel_description",
+            "Ты — эксперт, который анализирует контент каналов и создает подробные описания.",
+            "Проанализируй контент этого канала и создай подробное описание его тематики, основных тем и ключевых идей. Будь детальным, но не слишком строгим при описании границ тематики:",
+            [post['text'] for post in posts if 'text' in post and post['text'].strip()],
             max_tokens=OPENAI_MAX_TOKENS
         )
-        description = response.choices[0].message.content
         logging.info(f"Создано подробное описание канала: {description}")
         return description
-    except Exception as e:
+    except LLMError as e:
         logging.error(f"Ошибка при создании подробного описания канала: {e}")
         return "Не удалось создать подробное описание канала."
 
+def parse_channel_profile(answer):
+    """
+    Строго разбирает ответ create_channel_profile.
+    Ожидается JSON {"short_description": "...", "detailed_description": "...", "keywords": ["...", ...]}.
+    Возвращает словарь с этими ключами или None, если ответ не прошел проверку.
+    """
+    if not answer:
+        return None
+    # Модель иногда оборачивает JSON в блок кода
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", answer.strip())
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    short_description, detailed_description = data.get("short_description"), data.get("detailed_description")
+    keywords = data.get("keywords")
+    if not isinstance(short_description, str) or not short_description.strip():
+        return None
+    if not isinstance(detailed_description, str) or not detailed_description.strip():
+        return None
+    if not isinstance(keywords, list) or not all(isinstance(keyword, str) for keyword in keywords):
+        return None
+    return {
+        "short_description": short_description.strip(),
+        "detailed_description": detailed_description.strip(),
+        "keywords": [keyword.strip() for keyword in keywords if keyword.strip()],
+    }
+
+async def create_channel_profile(posts):
+    """
+    Создает краткое и подробное описание канала и ключевые слова его тематики одним запросом.
+    Если ответ не удалось разобрать, описания создаются двумя параллельными запросами
+    (ключевых слов при этом нет).
+    Возвращает {'short_description': ..., 'detailed_description': ..., 'keywords': [...]}.
+    """
+    if not posts:
+        return {"short_description": "Канал не содержит постов.", "detailed_description": "Канал не содержит постов.", "keywords": []}
+
+    try:
+        answer = await _complete_over_posts(
+            "create_channel_profile",
+            "Ты — эксперт, который анализирует контент каналов и создает их описания. Отвечай строго в формате JSON без пояснений.",
+            "Проанализируй контент этого канала и верни JSON с полями: "
+            "\"short_description\" - краткое описание тематики канала, максимум 2-3 предложения; "
+            "\"detailed_description\" - подробное описание тематики, основных тем и ключевых идей (будь детальным, "
+            "но не слишком строгим при описании границ тематики); "
+            "\"keywords\" - список из 5-10 ключевых слов или коротких фраз, описывающих темы канала:",
+            [post['text'] for post in posts if 'text' in post and post['text'].strip()],
+            max_tokens=OPENAI_MAX_TOKENS + 200,
+            validate=lambda answer: parse_channel_profile(answer) is not None
+        )
+        profile = parse_channel_profile(answer)
+        if profile is not None:
+            logging.info(f"Создан профиль канала: {profile}")
+            return profile
+        logging.warning(f"Некорректный ответ при создании профиля канала, создаем описания отдельно: {answer}")
+    except LLMError as e:
+        logging.error(f"Ошибка при создании профиля канала, создаем описания отдельно: {e}")
+
+    short_description, detailed_description = await asyncio.gather(
+        create_short_channel_description(posts), create_detailed_channel_description(posts)
+    )
+    return {"short_description": short_description, "detailed_description": detailed_description, "keywords": []}
+
+def post_relevance_messages(post_text, channel_description):
+    """
+    Сообщения запроса is_post_relevant (используются и в пакетном режиме, см. batch_jobs.py).
+    """
+    return IS_POST_RELEVANT.messages(channel_description, post=post_text)
+
+def parse_yes_no(answer):
+    """
+    Разбирает ответ на вопрос "Да"/"Нет": True, False или None, если ответ неразборчив.
+    Точка или восклицательный знак в конце ответа не мешают разбору.
+    """
+    decision = answer.strip().lower().rstrip(".!")
+    if decision == "да":
+        return True
+    if decision == "нет":
+        return False
+    return None
+
+def is_yes_no(answer):
+    """
+    Ответ на вопрос "Да"/"Нет" разборчив.
+    """
+    return parse_yes_no(answer) is not None
+
 async def is_post_relevant(post_text, channel_description):
     """
     Проверяет, соответствует ли пост тематике канала.
@@ -127,30 +246,130 @@ async def is_post_relevant(post_text, channel_description):
         return False
 
     try:
-        # Формируем запрос к OpenAI
-        user_content = (f"Описание канала: {channel_description}\n\nПост: {post_text}\n\nСоответствует ли пост тематике канала?"
-                        f"Ответь только 'Да' или 'Нет'."
-                        f"Если ты замечаешь, что пост - это реклама чего-либо (сервиса, приложения, другого канала), то"
-                        f"сразу пиши 'нет'."
-                        f"Ни в коем случае не добавляй разметку заголовков и подзаголовков.")
-
         # Отправляем запрос к OpenAI
-        response = await client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": "Ты — помощник, который анализирует, соответствует ли пост тематике канала."},
-                {"role": "user", "content": user_content}
-            ],
-            max_tokens=10
+        response = await complete(
+            "is_post_relevant",
+            messages=post_relevance_messages(post_text, channel_description),
+            max_tokens=10,
+            validate=is_yes_no,
+            min_confidence=LLM_ESCALATE_CONFIDENCE
         )
 
-        # Получаем ответ от OpenAI
-        decision = response.choices[0].message.content.strip().lower()
-
         # Логируем ответ нейросети
-        logging.info(f"Ответ нейросети на релевантность поста: {decision}")
+        logging.info(f"Ответ нейросети на релевантность поста: {response.strip()}")
 
-        return decision == "да"
-    except Exception as e:
+        return parse_yes_no(response) is True
+    except LLMError as e:
         logging.error(f"Ошибка при проверке соответствия поста тематике канала: {e}")
-        return False
\ No newline at end of file
+        return False
+
+def parse_relevance_verdicts(answer, count):
+    """
+    Строго разбирает ответ пакетной проверки релевантности.
+    Ожидается JSON {"verdicts": [{"id": 1, "relevant": true}, ...]} ровно с одним вердиктом
+    на каждый пост 1..count. Возвращает список bool или None, если ответ не прошел проверку.
+    """
+    if not answer:
+        return None
+    # Модель иногда оборачивает JSON в блок кода
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", answer.strip())
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    verdicts = data.get("verdicts") if isinstance(data, dict) else None
+    if not isinstance(verdicts, list) or len(verdicts) != count:
+        return None
+
+    result = {}
+    for verdict in verdicts:
+        if not isinstance(verdict, dict):
+            return None
+        post_id, relevant = verdict.get("id"), verdict.get("relevant")
+        if isinstance(post_id, bool) or not isinstance(post_id, int) or not isinstance(relevant, bool):
+            return None
+        if post_id < 1 or post_id > count or post_id in result:
+            return None
+        result[post_id] = relevant
+    return [result[i] for i in range(1, count + 1)]
+
+async def _classify_batch(post_texts, channel_description):
+    """
+    Проверяет пачку постов одним запросом. При неразборчивом ответе
+    проверяет каждый пост отдельно через is_post_relevant.
+    """
+    posts_block = "\n\n".join(f"Пост {i}:\n{text}" for i, text in enumerate(post_texts, start=1))
+    try:
+        answer = await complete(
+            "classify_posts_relevance",
+            messages=CLASSIFY_POSTS_RELEVANCE.messages(channel_description, posts=posts_block, count=len(post_texts)),
+            max_tokens=20 * len(post_texts) + 50,
+            validate=lambda answer: parse_relevance_verdicts(answer, len(post_texts)) is not None
+        )
+        verdicts = parse_relevance_verdicts(answer, len(post_texts))
+        if verdicts is not None:
+            logging.info(f"Пакетная проверка релевантности: {sum(verdicts)} из {len(verdicts)} постов по теме.")
+            return verdicts
+        logging.warning(f"Некорректный ответ пакетной проверки релевантности, проверяем посты по одному: {answer}")
+    except LLMError as e:
+        logging.error(f"Ошибка при пакетной проверке релевантности, проверяем посты по одному: {e}")
+
+    return list(await asyncio.gather(*(is_post_relevant(text, channel_description) for text in post_texts)))
+
+async def classify_posts_relevance(post_texts, channel_description, scores=None, threshold=None):
+    """
+    Проверяет релевантность многих постов за один запрос к OpenAI (по RELEVANCE_BATCH_SIZE постов).
+    Сначала посты проходят локальный предфильтр: уверенно отброшенные как мусор
+    в OpenAI не отправляются, остальные проверяются на релевантность.
+    scores - косинусная близость каждого поста к описанию канала (или None для поста без вектора).
+    Посты с близостью дальше RELEVANCE_TIEBREAK_MARGIN от threshold решаются без OpenAI,
+    пограничные проверяются по одному через is_post_relevant.
+    Возвращает список bool в том же порядке, что и post_texts.
+    """
+    if not post_texts:
+        return []
+    if not channel_description:
+        logging.info("Описание канала отсутствует. Считаем посты нерелевантными.")
+        return [False] * len(post_texts)
+
+    prefilter = get_prefilter()
+    decisions = prefilter.classify(post_texts)
+    verdicts = [False] * len(post_texts)
+
+    # Прошедшие предфильтр посты с вектором решаются по близости к описанию канала
+    tiebreaks = []
+    by_score = set()
+    for i, decision in enumerate(decisions):
+        score = scores[i] if scores is not None else None
+        if decision['decision'] != CHECK or score is None:
+            continue
+        by_score.add(i)
+        if score >= threshold + RELEVANCE_TIEBREAK_MARGIN:
+            verdicts[i] = True
+        elif score <= threshold - RELEVANCE_TIEBREAK_MARGIN:
+            verdicts[i] = False
+        else:
+            tiebreaks.append(i)
+    if by_score:
+        metrics.inc("relevance_decisions_total", len(by_score) - len(tiebreaks), stage="embedding")
+    if tiebreaks:
+        metrics.inc("relevance_decisions_total", len(tiebreaks), stage="tiebreak")
+
+    # В пакетную проверку идут прошедшие предфильтр посты без вектора и выборка отброшенных
+    # им постов для оценки его точности
+    indexes = [i for i, decision in enumerate(decisions)
+               if (decision['decision'] == CHECK and i not in by_score) or decision['audit']]
+    batches = [indexes[i:i + RELEVANCE_BATCH_SIZE] for i in range(0, len(indexes), RELEVANCE_BATCH_SIZE)]
+    results, tiebreak_verdicts = await asyncio.gather(
+        asyncio.gather(*(_classify_batch([post_texts[i] for i in batch], channel_description) for batch in batches)),
+        asyncio.gather(*(is_post_relevant(post_texts[i], channel_description) for i in tiebreaks))
+    )
+    for batch, batch_verdicts in zip(batches, results):
+        prefilter.record_llm_verdicts([decisions[i] for i in batch], batch_verdicts)
+        for i, relevant in zip(batch, batch_verdicts):
+            if decisions[i]['decision'] == CHECK:
+                verdicts[i] = relevant
+    prefilter.record_llm_verdicts([decisions[i] for i in tiebreaks], tiebreak_verdicts)
+    for i, relevant in zip(tiebreaks, tiebreak_verdicts):
+        verdicts[i] = relevant
+    return verdicts
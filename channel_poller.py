@@ -0,0 +1,373 @@
+import logging
+import asyncio
+import heapq
+import random
+import time
+from CONFIG import (
+    POST_LIMIT, TG_PAGE_SIZE, MAX_PAGES_PER_POLL, POLLER_CONCURRENCY, POLL_MIN_INTERVAL, POLL_MAX_INTERVAL,
+    POLL_BACKOFF_FACTOR, POLL_GAP_FACTOR, POLL_JITTER
+)
+from database import get_user_channels, get_channel_cursor
+from fetcher import get_fetcher, CircuitOpenError
+from extractors import get_extractor
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Функция разбора страниц каналов (bs4, lxml или selectolax)
+extract_posts = get_extractor()
+
+async def fetch_channel_page(channel_username, after=None, before=None, conditional_key=None):
+    """
+    Асинхронно получает HTML-страницу канала через общий пул соединений.
+    Если передан conditional_key, возвращает None, когда страница не изменилась с прошлой проверки.
+    """
+    return await get_fetcher().fetch_channel_page(
+        channel_username, after=after, before=before, conditional_key=conditional_key
+    )
+
+def get_post_number(post_id):
+    """
+    Возвращает числовой номер поста из data-post вида 'channel/123'.
+    Если номер не удается разобрать, возвращает 0.
+    """
+    try:
+        return int(str(post_id).rsplit('/', 1)[-1])
+    except (TypeError, ValueError):
+        return 0
+
+def parse_posts(html):
+    """
+    Разбирает HTML-страницу канала и возвращает посты в порядке публикации (от старых к новым).
+    Бэкенд разбора выбирается настройкой HTML_EXTRACTOR.
+    """
+    return extract_posts(html)
+
+async def get_last_posts(channel_username, limit=POST_LIMIT):
+    """
+    Получает последние посты из публичного Telegram-канала.
+    Если на одной странице постов меньше, чем limit, листает назад через ?before=.
+    """
+    try:
+        posts = parse_posts(await fetch_channel_page(channel_username))
+        for _ in range(MAX_PAGES_PER_POLL - 1):
+            if len(posts) >= limit or not posts:
+                break
+            oldest = get_post_number(posts[0]['id'])
+            if oldest <= 1:
+                break
+            older = [p for p in parse_posts(await fetch_channel_page(channel_username, before=oldest))
+                     if get_post_number(p['id']) < oldest]
+            if not older:
+                break
+            posts = older + posts
+        return posts[-limit:] if limit else posts
+    except CircuitOpenError as e:
+        logging.debug(str(e))
+        return []
+    except Exception as e:
+        logging.error(f"Ошибка при получении постов из канала @{channel_username}: {e}")
+        return []
+
+async def get_posts_after(channel_username, cursor, conditional_key=None):
+    """
+    Получает все посты канала с номером больше cursor, листая вперед через ?after=.
+    Загружает не больше MAX_PAGES_PER_POLL страниц за один вызов.
+    С conditional_key неизменившиеся с прошлой проверки страницы не разбираются.
+    """
+    posts = []
+    try:
+        for _ in range(MAX_PAGES_PER_POLL):
+            html = await fetch_channel_page(channel_username, after=cursor, conditional_key=conditional_key)
+            if html is None:
+                # Страница не изменилась - пропускаем разбор и работу с базой
+                break
+            page = [p for p in parse_posts(html) if get_post_number(p['id']) > cursor]
+            if not page:
+                break
+            posts.extend(page)
+            cursor = get_post_number(page[-1]['id'])
+            # Неполная страница означает, что мы дошли до самого нового поста
+            if len(page) < TG_PAGE_SIZE:
+                break
+        return posts
+    except CircuitOpenError as e:
+        logging.debug(str(e))
+        return posts
+    except Exception as e:
+        logging.error(f"Ошибка при получении новых постов из канала @{channel_username}: {e}")
+        return posts
+
+
+async def wait_event(event, timeout=None):
+    """
+    Ждет установки event не дольше timeout секунд.
+    В отличие от asyncio.wait_for не теряет отмену задачи, если событие наступило одновременно с ней.
+    """
+    waiter = asyncio.ensure_future(event.wait())
+    try:
+        await asyncio.wait({waiter}, timeout=timeout)
+    finally:
+        waiter.cancel()
+
+
+class ChannelPoller:
+    """
+    Центральный опрос каналов для всех пользователей.
+    Держит дедуплицированный набор каналов из подписок всех активных пользователей,
+    загружает каждый канал один раз и раздает новые посты всем подписчикам.
+
+    Каналы опрашиваются по расписанию (очередь с приоритетом по времени следующего опроса):
+    интервал канала подстраивается под частоту его публикаций, у молчащих каналов
+    растет экспоненциально, к нему добавляется случайный разброс, а общее число
+    запросов в секунду ограничено общим fetcher. Каналы с открытым предохранителем
+    не опрашиваются до окончания его паузы.
+    """
+
+    def __init__(self):
+        self._user_channels = {}   # user_id -> set(channel_username)
+        self._subscribers = {}     # channel_username -> set(user_id)
+        self._cursors = {}         # channel_username -> номер последнего загруженного поста
+        self._feeds = {}           # user_id -> {channel_username: [posts]}
+        self._events = {}          # user_id -> asyncio.Event (в ленте есть новые посты)
+        self._due = {}             # channel_username -> время следующего опроса (time.monotonic())
+        self._queue = []           # куча (время опроса, channel_username); устаревшие записи пропускаются
+        self._stats = {}           # channel_username -> {"interval", "gap", "last_new_at"}
+        self._locks = {}           # channel_username -> asyncio.Lock (канал не опрашивается дважды одновременно)
+        self._wakeup = asyncio.Event()
+
+    @property
+    def channels(self):
+        """
+        Дедуплицированный набор каналов, которые сейчас опрашиваются.
+        """
+        return set(self._subscribers)
+
+    def is_subscribed(self, user_id):
+        """
+        Проверяет, подписан ли пользователь на общую ленту.
+        """
+        return user_id in self._user_channels
+
+    def subscribe(self, user_id):
+        """
+        Подписывает пользователя на общую ленту: добавляет его каналы в опрос.
+        Для каждого канала курсор опроса опускается до курсора пользователя,
+        чтобы новый подписчик не пропустил посты.
+        """
+        self.unsubscribe(user_id)
+        self._feeds[user_id] = {}
+        self._events[user_id] = asyncio.Event()
+
+        channels = set()
+        for channel in get_user_channels(user_id):
+            channel_username = channel["username"]
+            channels.add(channel_username)
+            user_cursor = 0 if channel["is_new_channel"] else get_channel_cursor(user_id, channel_username)
+            if channel_username in self._cursors:
+                self._cursors[channel_username] = min(self._cursors[channel_username], user_cursor)
+            else:
+                self._cursors[channel_username] = user_cursor
+            self._subscribers.setdefault(channel_username, set()).add(user_id)
+            # У канала новый подписчик - опрашиваем его как можно скорее
+            self._schedule(channel_username, time.monotonic())
+        self._user_channels[user_id] = channels
+        logging.info(f"Пользователь {user_id} подписан на общую ленту ({len(channels)} каналов, всего в опросе {len(self._subscribers)}).")
+
+    def unsubscribe(self, user_id):
+        """
+        Отписывает пользователя. Каналы без подписчиков перестают опрашиваться.
+        """
+        for channel_username in self._user_channels.pop(user_id, set()):
+            subscribers = self._subscribers.get(channel_username)
+            if subscribers is None:
+                continue
+            subscribers.discard(user_id)
+            if not subscribers:
+                del self._subscribers[channel_username]
+                self._cursors.pop(channel_username, None)
+                self._due.pop(channel_username, None)
+                self._stats.pop(channel_username, None)
+                self._locks.pop(channel_username, None)
+                # Валидаторы страниц канала больше не нужны; при новой подписке первый запрос будет безусловным
+                get_fetcher().forget(channel_username)
+        self._feeds.pop(user_id, None)
+        event = self._events.pop(user_id, None)
+        if event is not None:
+            # Будим ожидающего потребителя, чтобы он мог завершиться
+            event.set()
+
+    def _schedule(self, channel_username, due):
+        """
+        Назначает время следующего опроса канала.
+        """
+        self._due[channel_username] = due
+        heapq.heappush(self._queue, (due, channel_username))
+        self._wakeup.set()
+
+    def _next_interval(self, channel_username, new_posts):
+        """
+        Пересчитывает интервал опроса канала по результату последнего опроса.
+        Средний промежуток между постами оценивается экспоненциальным сглаживанием;
+        если новых постов нет, интервал увеличивается в POLL_BACKOFF_FACTOR раз.
+        """
+        now = time.monotonic()
+        stats = self._stats.setdefault(
+            channel_username, {"interval": POLL_MIN_INTERVAL, "gap": None, "last_new_at": None}
+        )
+        if new_posts:
+            if stats["last_new_at"] is not None:
+                observed = (now - stats["last_new_at"]) / new_posts
+                stats["gap"] = observed if stats["gap"] is None else 0.3 * observed + 0.7 * stats["gap"]
+            stats["last_new_at"] = now
+            gap = stats["gap"] if stats["gap"] is not None else POLL_MIN_INTERVAL
+            stats["interval"] = gap * POLL_GAP_FACTOR
+        else:
+            stats["interval"] *= POLL_BACKOFF_FACTOR
+        stats["interval"] = min(POLL_MAX_INTERVAL, max(POLL_MIN_INTERVAL, stats["interval"]))
+        # Разброс, чтобы каналы с одинаковым интервалом не опрашивались одной пачкой
+        return stats["interval"] * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+
+    async def poll_channel(self, channel_username):
+        """
+        Загружает новые посты одного канала и раздает их всем подписчикам.
+        Возвращает количество новых постов.
+        """
+        lock = self._locks.setdefault(channel_username, asyncio.Lock())
+        async with lock:
+            return await self._poll_channel(channel_username)
+
+    async def _poll_channel(self, channel_username):
+        cursor = self._cursors.get(channel_username, 0)
+        if cursor:
+            posts = await get_posts_after(channel_username, cursor, conditional_key=channel_username)
+        else:
+            # Курсора нет (у канала есть новый подписчик) - берем последнюю страницу
+            posts = await get_last_posts(channel_username, limit=TG_PAGE_SIZE)
+
+        if not posts:
+            # Пустой первый опрос не отличить от ошибки загрузки: курсор не ставим и ничего не раздаем,
+            # чтобы канал остался новым и при следующем опросе снова получил последнюю страницу
+            return 0
+        self._cursors[channel_username] = max(cursor, get_post_number(posts[-1]['id']))
+
+        for user_id in self._subscribers.get(channel_username, ()):
+            feed = self._feeds.get(user_id)
+            if feed is None:
+                continue
+            feed.setdefault(channel_username, []).extend(posts)
+            self._events[user_id].set()
+        # Первая страница нового канала ничего не говорит о частоте публикаций
+        return len(posts) if cursor else 0
+
+    async def poll_channels(self, channel_usernames):
+        """
+        Опрашивает набор каналов с ограничением на число одновременных запросов.
+        """
+        semaphore = asyncio.Semaphore(POLLER_CONCURRENCY)
+
+        async def poll(channel_username):
+            async with semaphore:
+                try:
+                    await self.poll_channel(channel_username)
+                except Exception as e:
+                    logging.error(f"Ошибка при опросе канала @{channel_username}: {e}")
+
+        await asyncio.gather(*(poll(channel_username) for channel_username in channel_usernames))
+
+    async def poll_user_now(self, user_id):
+        """
+        Немедленно опрашивает каналы пользователя (например, сразу после включения бота).
+        """
+        await self.poll_channels(list(self._user_channels.get(user_id, ())))
+
+    def drain(self, user_id):
+        """
+        Забирает накопленные для пользователя посты: {channel_username: [posts]}.
+        """
+        feed = self._feeds.get(user_id)
+        if feed is None:
+            return {}
+        self._feeds[user_id] = {}
+        self._events[user_id].clear()
+        return feed
+
+    def requeue(self, user_id, feed):
+        """
+        Возвращает в ленту пользователя посты, забранные drain, но не обработанные из-за ошибки.
+        Они встают перед постами, которые успели прийти за это время.
+        """
+        current = self._feeds.get(user_id)
+        if current is None or not feed:
+            # Пользователь уже отписан - посты ему больше не нужны
+            return
+        for channel_username, posts in feed.items():
+            returned = {post['id'] for post in posts}
+            newer = [post for post in current.get(channel_username, []) if post['id'] not in returned]
+            current[channel_username] = posts + newer
+        self._events[user_id].set()
+
+    async def wait_for_posts(self, user_id, timeout=None):
+        """
+        Ждет появления новых постов в ленте пользователя (или истечения timeout).
+        """
+        event = self._events.get(user_id)
+        if event is None:
+            return
+        await wait_event(event, timeout)
+
+    async def _poll_scheduled(self, channel_username, semaphore):
+        async with semaphore:
+            new_posts = 0
+            try:
+                new_posts = await self.poll_channel(channel_username)
+            except Exception as e:
+                logging.error(f"Ошибка при опросе канала @{channel_username}: {e}")
+            if channel_username in self._subscribers:
+                due = time.monotonic() + self._next_interval(channel_username, new_posts)
+                # Не раньше, чем закроется предохранитель канала или кончится пауза после 429
+                self._schedule(channel_username, max(due, get_fetcher().retry_at(channel_username)))
+
+    async def run(self):
+        """
+        Бесконечный цикл опроса: берет из очереди каналы, которым пора обновиться,
+        и опрашивает их (частоту запросов ограничивает общий fetcher).
+        """
+        semaphore = asyncio.Semaphore(POLLER_CONCURRENCY)
+        tasks = set()
+        while True:
+            self._wakeup.clear()
+            if not self._queue:
+                await self._wakeup.wait()
+                continue
+
+            due, channel_username = self._queue[0]
+            if self._due.get(channel_username) != due:
+                # Канал отписан или перепланирован - запись устарела
+                heapq.heappop(self._queue)
+                continue
+
+            delay = due - time.monotonic()
+            if delay > 0:
+                # Ждем наступления срока или появления более срочного канала
+                await wait_event(self._wakeup, delay)
+                continue
+
+            heapq.heappop(self._queue)
+            del self._due[channel_username]
+            task = asyncio.create_task(self._poll_scheduled(channel_username, semaphore))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+
+_poller = None
+
+
+def get_poller():
+    """
+    Возвращает общий (единственный на процесс) экземпляр ChannelPoller.
+    """
+    global _poller
+    if _poller is None:
+        _poller = ChannelPoller()
+    return _poller
@@ -1,82 +1,214 @@
+import collections
+import glob
+import re
 import sqlite3
 import logging
+import metrics
+from CONFIG import DB_MAX_OPEN_CONNECTIONS, DB_SYNCHRONOUS, DB_CACHE_SIZE_KB, DB_CACHED_STATEMENTS, DB_BUSY_TIMEOUT_MS
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def create_user_tables(user_id):
+class ConnectionManager:
     """
-    Создает таблицы для пользователя, если они еще не существуют.
+    Долгоживущие соединения с базами: одно на файл, не больше max_open открытых одновременно
+    (при превышении закрывается давно не использованное). Соединения работают в режиме WAL
+    с настроенными synchronous и cache_size и кэшируют подготовленные запросы
+    (cached_statements), поэтому повторный запрос не разбирается заново.
+    Функция init, переданная в get(), выполняется при первом открытии базы в процессе
+    (создание таблиц и миграции), а не при каждом запросе.
+    Все функции модуля вызываются из одного потока (event loop бота).
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
-    cursor = conn.cursor()
-    try:
-        # Таблица для хранения каналов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS channels (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL UNIQUE,
-                is_new_channel INTEGER DEFAULT 1  -- 1 - новый канал, 0 - не новый
-            )
-        ''')
 
-        # Таблица для хранения постов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS posts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                post_id TEXT NOT NULL UNIQUE,
-                content TEXT NOT NULL,
-                summary TEXT,
-                post_number INTEGER,
-                channel_username TEXT NOT NULL,
-                is_read INTEGER DEFAULT 0
-            )
-        ''')
+    def __init__(self, max_open=DB_MAX_OPEN_CONNECTIONS):
+        self.max_open = max_open
+        self._connections = collections.OrderedDict()  # путь -> соединение, от давно использованных к недавним
+        self._initialized = set()  # пути баз, для которых init уже выполнен
 
-        # Таблица для хранения состояния пользователя
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_state (
-                id INTEGER PRIMARY KEY DEFAULT 1,
-                is_active INTEGER DEFAULT 0
-            )
-        ''')
+    def _open(self, path):
+        conn = sqlite3.connect(path, cached_statements=DB_CACHED_STATEMENTS)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={DB_SYNCHRONOUS}')
+        conn.execute(f'PRAGMA cache_size={-DB_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+        metrics.inc("db_connections_opened_total")
+        return conn
 
-        # Таблица для хранения описаний каналов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS channel_descriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL UNIQUE,
-                description TEXT
-            )
-        ''')
+    def get(self, path, init=None):
+        """
+        Возвращает открытое соединение с базой path, при необходимости открывая его.
+        """
+        conn = self._connections.get(path)
+        if conn is not None:
+            self._connections.move_to_end(path)
+            return conn
+        conn = self._open(path)
+        if init is not None and path not in self._initialized:
+            try:
+                init(conn)
+                self._initialized.add(path)
+            except Exception as e:
+                # Повторим при следующем открытии базы
+                conn.rollback()
+                logging.error(f"Ошибка при подготовке базы {path}: {e}")
+        self._connections[path] = conn
+        while len(self._connections) > self.max_open:
+            _, oldest = self._connections.popitem(last=False)
+            oldest.close()
+        metrics.set_gauge("db_open_connections", len(self._connections))
+        return conn
 
-        # Таблица для хранения подробных описаний каналов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS detailed_channel_descriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL UNIQUE,
-                description TEXT
-            )
-        ''')
+    def release(self, conn):
+        """
+        Завершает работу функции с соединением: незавершенная транзакция (ошибка до commit)
+        откатывается, как раньше при закрытии соединения. Само соединение остается открытым.
+        """
+        if conn.in_transaction:
+            conn.rollback()
+
+    def close_all(self):
+        for conn in self._connections.values():
+            conn.close()
+        self._connections.clear()
+        metrics.set_gauge("db_open_connections", 0)
+
+_manager = ConnectionManager()
+
+def connect_user_db(user_id):
+    """
+    Соединение с базой пользователя. После работы его нужно вернуть через release_connection().
+    При первом открытии базы в процессе создаются недостающие таблицы и столбцы,
+    поэтому база, созданная прежней версией бота, мигрирует до первого запроса к ней.
+    """
+    return _manager.get(f"user_{user_id}.db", init=_init_user_db)
+
+def connect_db(path):
+    """
+    Соединение с общей служебной базой path (кэш LLM, телеметрия, журнал предфильтра).
+    После работы его нужно вернуть через release_connection().
+    """
+    return _manager.get(path)
+
+def release_connection(conn):
+    _manager.release(conn)
+
+def close_all_connections():
+    """
+    Закрывает все соединения с базами при завершении работы.
+    """
+    _manager.close_all()
+
+def _add_missing_columns(cursor, table, columns):
+    """
+    Добавляет в существующую таблицу столбцы {имя: тип}, которых в ней еще нет.
+    """
+    cursor.execute(f'PRAGMA table_info({table})')
+    existing = {row[1] for row in cursor.fetchall()}
+    for name, column_type in columns.items():
+        if name not in existing:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+
+def _create_user_schema(cursor):
+    """
+    Создает недостающие таблицы базы пользователя и добавляет новые столбцы в старые таблицы.
+    """
+    # Таблица для хранения каналов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS channels (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            is_new_channel INTEGER DEFAULT 1  -- 1 - новый канал, 0 - не новый
+        )
+    ''')
+
+    # Таблица для хранения постов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id TEXT NOT NULL UNIQUE,
+            content TEXT NOT NULL,
+            summary TEXT,
+            post_number INTEGER,
+            channel_username TEXT NOT NULL,
+            is_read INTEGER DEFAULT 0,
+            summary_version INTEGER,  -- версия промпта, которым сделана summary
+            embedding BLOB            -- вектор текста поста (float32)
+        )
+    ''')
+
+    # Миграция баз, созданных до появления новых столбцов
+    _add_missing_columns(cursor, 'posts', {'summary_version': 'INTEGER', 'embedding': 'BLOB'})
+
+    # Таблица для хранения состояния пользователя
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_state (
+            id INTEGER PRIMARY KEY DEFAULT 1,
+            is_active INTEGER DEFAULT 0
+        )
+    ''')
 
+    # Таблица для хранения описаний каналов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS channel_descriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            description TEXT,
+            embedding BLOB,            -- вектор описания (float32), сбрасывается при смене описания
+            relevance_threshold REAL,  -- порог косинусной близости поста к описанию
+            keywords TEXT              -- ключевые слова тематики канала через запятую
+        )
+    ''')
+    _add_missing_columns(cursor, 'channel_descriptions', {'embedding': 'BLOB', 'relevance_threshold': 'REAL', 'keywords': 'TEXT'})
+
+    # Таблица для хранения подробных описаний каналов
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS detailed_channel_descriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            description TEXT
+        )
+    ''')
+
+    # Таблица для хранения курсоров каналов (номер последнего обработанного поста)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS channel_cursors (
+            username TEXT PRIMARY KEY,
+            last_post_id INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+def _init_user_db(conn):
+    _create_user_schema(conn.cursor())
+    conn.commit()
+
+def create_user_tables(user_id):
+    """
+    Создает таблицы для пользователя, если они еще не существуют.
+    """
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    try:
+        _create_user_schema(cursor)
         conn.commit()
         logging.info(f"Таблицы созданы для пользователя {user_id}.")
     except Exception as e:
         logging.error(f"Ошибка при создании таблиц для пользователя {user_id}: {e}")
     finally:
-        conn.close()
+        release_connection(conn)
 
-def add_post(user_id, post_id, content, summary, post_number, channel_username):
+def add_post(user_id, post_id, content, summary, post_number, channel_username, summary_version=None, embedding=None):
     """
     Добавляет пост в базу данных.
+    summary_version - версия промпта выжимки, чтобы дайджест мог переиспользовать summary.
+    embedding - вектор текста поста (bytes), чтобы не запрашивать его повторно.
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
         cursor.execute('''
-            INSERT INTO posts (post_id, content, summary, post_number, channel_username, is_read)
-            VALUES (?, ?, ?, ?, ?, 0)
-        ''', (post_id, content, summary, post_number, channel_username))
+            INSERT INTO posts (post_id, content, summary, post_number, channel_username, is_read, summary_version, embedding)
+            VALUES (?, ?, ?, ?, ?, 0, ?, ?)
+        ''', (post_id, content, summary, post_number, channel_username, summary_version, embedding))
         conn.commit()
         logging.info(f"Пост {post_id} добавлен в базу данных для пользователя {user_id}.")
     except sqlite3.IntegrityError:
@@ -84,13 +216,13 @@ def add_post(user_id, post_id, content, summary, post_number, channel_username):
     except Exception as e:
         logging.error(f"Ошибка при добавлении поста {post_id}: {e}")
     finally:
-        conn.close()
+        release_connection(conn)
 
 def get_last_post_number(user_id):
     """
     Возвращает номер последнего добавленного поста.
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
         cursor.execute('SELECT MAX(post_number) FROM posts')
@@ -101,13 +233,13 @@ def get_last_post_number(user_id):
         logging.error(f"Ошибка при получении последнего номера поста для пользователя {user_id}: {e}")
         return 0
     finally:
-        conn.close()
+        release_connection(conn)
 
 def is_post_processed(user_id, post_id):
     """
     Проверяет, был ли пост уже обработан (добавлен в базу).
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
         cursor.execute('SELECT 1 FROM posts WHERE post_id = ?', (post_id,))
@@ -117,13 +249,13 @@ def is_post_processed(user_id, post_id):
         logging.error(f"Ошибка при проверке поста {post_id} для пользователя {user_id}: {e}")
         return False
     finally:
-        conn.close()
+        release_connection(conn)
 
 def get_user_channels(user_id):
     """
     Возвращает список отслеживаемых каналов для пользователя и их статус (новый/не новый).
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
         cursor.execute('SELECT username, is_new_channel FROM channels')
@@ -134,25 +266,25 @@ def get_user_channels(user_id):
         logging.error(f"Ошибка при получении каналов для пользователя {user_id}: {e}")
         return []
     finally:
-        conn.close()
+        release_connection(conn)
 
 def get_unread_posts(user_id):
     """
     Возвращает список непрочитанных постов для пользователя.
     Переименовываем 'content' -> 'text', чтобы код работал с post['text'].
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
-    conn.row_factory = sqlite3.Row
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row  # Только у курсора: соединение общее для всех функций
     try:
-        cursor.execute('SELECT id, post_id, channel_username, content, summary FROM posts WHERE is_read = 0')
+        cursor.execute('SELECT id, post_id, channel_username, content, summary, summary_version, embedding FROM posts WHERE is_read = 0')
         posts = cursor.fetchall()
         logging.info(f"Найдено {len(posts)} непрочитанных постов для пользователя {user_id}.")
     except Exception as e:
         logging.error(f"Ошибка при получении непрочитанных постов для пользователя {user_id}: {e}")
         posts = []
     finally:
-        conn.close()
+        release_connection(conn)
 
     posts_list = []
     for row in posts:
@@ -162,11 +294,53 @@ def get_unread_posts(user_id):
 
     return posts_list
 
+def update_post_summary(user_id, post_id, summary, summary_version):
+    """
+    Сохраняет новую выжимку поста (по id строки) и версию промпта, которым она сделана.
+    """
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('UPDATE posts SET summary = ?, summary_version = ? WHERE id = ?', (summary, summary_version, post_id))
+        conn.commit()
+    except Exception as e:
+        logging.error(f"Ошибка при обновлении выжимки поста {post_id} для пользователя {user_id}: {e}")
+    finally:
+        release_connection(conn)
+
+def update_post_summary_by_post_id(user_id, post_id, summary, summary_version):
+    """
+    Сохраняет выжимку поста по его post_id ('channel/123'), например из результатов пакетной обработки.
+    """
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('UPDATE posts SET summary = ?, summary_version = ? WHERE post_id = ?', (summary, summary_version, post_id))
+        conn.commit()
+    except Exception as e:
+        logging.error(f"Ошибка при обновлении выжимки поста {post_id} для пользователя {user_id}: {e}")
+    finally:
+        release_connection(conn)
+
+def update_post_embedding(user_id, post_id, embedding):
+    """
+    Сохраняет вектор текста поста (по id строки).
+    """
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('UPDATE posts SET embedding = ? WHERE id = ?', (embedding, post_id))
+        conn.commit()
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении вектора поста {post_id} для пользователя {user_id}: {e}")
+    finally:
+        release_connection(conn)
+
 def mark_posts_as_read(user_id, post_id):
     """
     Помечает пост как прочитанный (is_read = 1), но не удаляет его из базы.
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
         cursor.execute('UPDATE posts SET is_read = 1 WHERE id = ?', (post_id,))
@@ -175,14 +349,14 @@ def mark_posts_as_read(user_id, post_id):
     except Exception as e:
         logging.error(f"Ошибка при пометке поста {post_id} как прочитанного: {e}")
     finally:
-        conn.close()
+        release_connection(conn)
 
 def add_user_channel(user_id, channel_username):
     """
     Добавляет канал в список отслеживаемых для пользователя.
     Если канал добавляется впервые, он считается новым.
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
         cursor.execute('INSERT INTO channels (username, is_new_channel) VALUES (?, 1)', (channel_username,))
@@ -193,7 +367,7 @@ def add_user_channel(user_id, channel_username):
     except Exception as e:
         logging.error(f"Ошибка при добавлении канала @{channel_username}: {e}")
     finally:
-        conn.close()
+        release_connection(conn)
 
 def remove_user_channel(user_id, channel_username):
     """
@@ -202,8 +376,9 @@ def remove_user_channel(user_id, channel_username):
     - Все посты из этого канала (posts)
     - Краткое описание (channel_descriptions)
     - Подробное описание (detailed_channel_descriptions)
+    - Курсор канала (channel_cursors)
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
         # Удаляем сам канал
@@ -214,18 +389,22 @@ def remove_user_channel(user_id, channel_username):
         cursor.execute('DELETE FROM channel_descriptions WHERE username = ?', (channel_username,))
         # Удаляем подробное описание
         cursor.execute('DELETE FROM detailed_channel_descriptions WHERE username = ?', (channel_username,))
+        # Удаляем курсор канала
+        cursor.execute('DELETE FROM channel_cursors WHERE username = ?', (channel_username,))
         conn.commit()
         logging.info(f"Канал @{channel_username} и все связанные посты/описания удалены для пользователя {user_id}.")
     except Exception as e:
         logging.error(f"Ошибка при удалении канала @{channel_username}: {e}")
+        # Обработчик в боте должен сообщить пользователю, что канал не удален
+        raise
     finally:
-        conn.close()
+        release_connection(conn)
 
 def is_active(user_id):
     """
     Проверяет, активно ли отслеживание для пользователя.
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
         cursor.execute('SELECT is_active FROM user_state WHERE id = 1')
@@ -235,13 +414,24 @@ def is_active(user_id):
         logging.error(f"Ошибка при проверке состояния пользователя {user_id}: {e}")
         return False
     finally:
-        conn.close()
+        release_connection(conn)
+
+def get_active_user_ids():
+    """
+    Возвращает id всех пользователей, у которых включено отслеживание (по файлам user_<id>.db).
+    """
+    user_ids = []
+    for path in glob.glob("user_*.db"):
+        match = re.fullmatch(r"user_(\d+)\.db", path)
+        if match and is_active(int(match.group(1))):
+            user_ids.append(int(match.group(1)))
+    return user_ids
 
 def activate_user(user_id):
     """
     Активирует отслеживание для пользователя.
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
         cursor.execute('INSERT OR REPLACE INTO user_state (id, is_active) VALUES (1, 1)')
@@ -250,13 +440,13 @@ def activate_user(user_id):
     except Exception as e:
         logging.error(f"Ошибка при активации отслеживания для пользователя {user_id}: {e}")
     finally:
-        conn.close()
+        release_connection(conn)
 
 def deactivate_user(user_id):
     """
     Деактивирует отслеживание для пользователя.
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
         cursor.execute('INSERT OR REPLACE INTO user_state (id, is_active) VALUES (1, 0)')
@@ -265,13 +455,13 @@ def deactivate_user(user_id):
     except Exception as e:
         logging.error(f"Ошибка при деактивации отслеживания для пользователя {user_id}: {e}")
     finally:
-        conn.close()
+        release_connection(conn)
 
 def mark_channel_as_old(user_id, channel_username):
     """
     Помечает канал как "не новый" после первого сканирования.
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
         cursor.execute('UPDATE channels SET is_new_channel = 0 WHERE username = ?', (channel_username,))
@@ -280,36 +470,30 @@ def mark_channel_as_old(user_id, channel_username):
     except Exception as e:
         logging.error(f"Ошибка при обновлении статуса канала @{channel_username}: {e}")
     finally:
-        conn.close()
+        release_connection(conn)
 
-def add_channel_description(user_id, channel_username, description):
+def add_channel_description(user_id, channel_username, description, keywords=None):
     """
-    Добавляет (или обновляет) краткое описание канала в базу данных.
+    Добавляет (или обновляет) краткое описание канала и ключевые слова его тематики в базу данных.
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS channel_descriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL UNIQUE,
-                description TEXT
-            )
-        ''')
-        cursor.execute('INSERT OR REPLACE INTO channel_descriptions (username, description) VALUES (?, ?)',
-                       (channel_username, description))
+        # REPLACE заменяет строку целиком, поэтому вектор и порог старого описания сбрасываются
+        cursor.execute('INSERT OR REPLACE INTO channel_descriptions (username, description, keywords) VALUES (?, ?, ?)',
+                       (channel_username, description, ", ".join(keywords) if keywords else None))
         conn.commit()
         logging.info(f"Краткое описание канала @{channel_username} добавлено/обновлено для пользователя {user_id}.")
     except Exception as e:
         logging.error(f"Ошибка при добавлении краткого описания канала @{channel_username}: {e}")
     finally:
-        conn.close()
+        release_connection(conn)
 
 def add_detailed_channel_description(user_id, channel_username, description):
     """
     Добавляет (или обновляет) подробное описание канала в базу данных.
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
         cursor.execute('''
@@ -326,13 +510,13 @@ def add_detailed_channel_description(user_id, channel_username, description):
     except Exception as e:
         logging.error(f"Ошибка при добавлении подробного описания канала @{channel_username}: {e}")
     finally:
-        conn.close()
+        release_connection(conn)
 
 def get_channel_description(user_id, channel_username):
     """
     Возвращает краткое описание канала из таблицы channel_descriptions.
     """
-    conn = sqlite3.connect(f"user_{user_id}.db")
+    conn = connect_user_db(user_id)
     cursor = conn.cursor()
     try:
         cursor.execute('SELECT description FROM channel_descriptions WHERE username = ?', (channel_username,))
@@ -342,4 +526,75 @@ def get_channel_description(user_id, channel_username):
         logging.error(f"Ошибка при получении описания канала @{channel_username}: {e}")
         return None
     finally:
-        conn.close()
\ No newline at end of file
+        release_connection(conn)
+
+def get_channel_embedding(user_id, channel_username):
+    """
+    Возвращает (вектор описания канала или None, порог релевантности или None).
+    """
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT embedding, relevance_threshold FROM channel_descriptions WHERE username = ?', (channel_username,))
+        result = cursor.fetchone()
+        return (result[0], result[1]) if result else (None, None)
+    except Exception as e:
+        logging.error(f"Ошибка при получении вектора описания канала @{channel_username}: {e}")
+        return None, None
+    finally:
+        release_connection(conn)
+
+def set_channel_embedding(user_id, channel_username, embedding, relevance_threshold):
+    """
+    Сохраняет вектор описания канала и порог релевантности постов.
+    """
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('UPDATE channel_descriptions SET embedding = ?, relevance_threshold = ? WHERE username = ?',
+                       (embedding, relevance_threshold, channel_username))
+        conn.commit()
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении вектора описания канала @{channel_username}: {e}")
+    finally:
+        release_connection(conn)
+
+def get_channel_cursor(user_id, channel_username):
+    """
+    Возвращает номер последнего обработанного поста канала (курсор).
+    Если курсор еще не сохранен, вычисляет его по уже сохраненным постам канала.
+    """
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT last_post_id FROM channel_cursors WHERE username = ?', (channel_username,))
+        result = cursor.fetchone()
+        if result:
+            return result[0]
+
+        # Курсора нет - берем максимальный номер среди постов канала (post_id вида 'channel/123')
+        cursor.execute('SELECT post_id FROM posts WHERE channel_username = ?', (channel_username,))
+        numbers = [int(row[0].rsplit('/', 1)[-1]) for row in cursor.fetchall() if row[0].rsplit('/', 1)[-1].isdigit()]
+        return max(numbers) if numbers else 0
+    except Exception as e:
+        logging.error(f"Ошибка при получении курсора канала @{channel_username} для пользователя {user_id}: {e}")
+        return 0
+    finally:
+        release_connection(conn)
+
+def set_channel_cursor(user_id, channel_username, last_post_id):
+    """
+    Сохраняет курсор канала. Курсор только растет: меньшее значение игнорируется.
+    """
+    conn = connect_user_db(user_id)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            INSERT INTO channel_cursors (username, last_post_id) VALUES (?, ?)
+            ON CONFLICT(username) DO UPDATE SET last_post_id = MAX(last_post_id, excluded.last_post_id)
+        ''', (channel_username, last_post_id))
+        conn.commit()
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении курсора канала @{channel_username} для пользователя {user_id}: {e}")
+    finally:
+        release_connection(conn)
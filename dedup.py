@@ -0,0 +1,122 @@
+"""
+Локальный поиск почти одинаковых текстов: MinHash по словесным шинглам и LSH с полосами.
+
+Каждый текст превращается в сигнатуру из DEDUP_NUM_PERM минимальных хэшей; сигнатура режется
+на DEDUP_BANDS полос, и тексты с совпадающей полосой становятся кандидатами в дубликаты.
+Поэтому добавление текста сравнивает его не со всеми, а только с кандидатами из своих корзин.
+Кандидаты подтверждаются оценкой сходства Жаккара не ниже DEDUP_THRESHOLD.
+"""
+import random
+import re
+import zlib
+from CONFIG import DEDUP_NUM_PERM, DEDUP_BANDS, DEDUP_THRESHOLD, DEDUP_SHINGLE_SIZE
+
+WORD_RE = re.compile(r"\w+")
+URL_RE = re.compile(r"https?://\S+|t\.me/\S+", re.IGNORECASE)
+
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# Параметры хэш-функций фиксированы, чтобы сигнатуры были воспроизводимы между запусками
+_rng = random.Random(20240101)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(DEDUP_NUM_PERM)]
+
+
+def shingles(text, size=DEDUP_SHINGLE_SIZE):
+    """
+    Множество хэшей словесных шинглов нормализованного текста (без ссылок и регистра).
+    """
+    words = WORD_RE.findall(URL_RE.sub(" ", text.lower()))
+    if len(words) <= size:
+        grams = [" ".join(words)] if words else []
+    else:
+        grams = [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+    return {zlib.crc32(gram.encode("utf-8")) for gram in grams}
+
+
+def minhash(text):
+    """
+    MinHash-сигнатура текста или None, если в тексте нет слов.
+    """
+    hashes = shingles(text)
+    if not hashes:
+        return None
+    return tuple(min((a * h + b) % _PRIME & _MAX_HASH for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def similarity(signature_a, signature_b):
+    """
+    Оценка сходства Жаккара по двум сигнатурам.
+    """
+    return sum(1 for x, y in zip(signature_a, signature_b) if x == y) / len(signature_a)
+
+
+class NearDuplicateIndex:
+    """
+    LSH-индекс MinHash-сигнатур, объединяющий почти одинаковые тексты в кластеры.
+    Одному элементу можно добавить несколько текстов (например, текст поста и его выжимку):
+    элементы считаются дубликатами, если похож хотя бы один их текст.
+    """
+
+    def __init__(self, bands=DEDUP_BANDS, threshold=DEDUP_THRESHOLD):
+        self.bands = bands
+        self.rows = DEDUP_NUM_PERM // bands
+        self.threshold = threshold
+        self._buckets = [{} for _ in range(bands)]  # полоса -> {значения полосы: [(элемент, сигнатура)]}
+        self._parent = {}
+        self._order = {}  # элемент -> порядковый номер добавления
+
+    def _find(self, item):
+        while self._parent[item] != item:
+            self._parent[item] = self._parent[self._parent[item]]
+            item = self._parent[item]
+        return item
+
+    def _union(self, a, b):
+        root_a, root_b = self._find(a), self._find(b)
+        if root_a != root_b:
+            # Корнем кластера остается элемент, добавленный раньше
+            if self._order[root_b] < self._order[root_a]:
+                root_a, root_b = root_b, root_a
+            self._parent[root_b] = root_a
+
+    def add(self, item, text):
+        """
+        Добавляет текст элемента и объединяет элемент с найденными почти-дубликатами.
+        """
+        if item not in self._parent:
+            self._parent[item] = item
+            self._order[item] = len(self._order)
+        signature = minhash(text or "")
+        if signature is None:
+            return
+        checked = set()
+        for band, buckets in enumerate(self._buckets):
+            key = signature[band * self.rows:(band + 1) * self.rows]
+            bucket = buckets.setdefault(key, [])
+            for other, other_signature in bucket:
+                if id(other_signature) in checked or self._find(other) == self._find(item):
+                    continue
+                checked.add(id(other_signature))
+                if similarity(signature, other_signature) >= self.threshold:
+                    self._union(item, other)
+            bucket.append((item, signature))
+
+    def clusters(self):
+        """
+        Кластеры элементов в порядке добавления; первый элемент кластера - его представитель.
+        """
+        groups = {}
+        for item in sorted(self._parent, key=self._order.get):
+            groups.setdefault(self._find(item), []).append(item)
+        return list(groups.values())
+
+
+def cluster_texts(texts):
+    """
+    Группирует почти одинаковые тексты. Возвращает списки индексов в порядке texts.
+    """
+    index = NearDuplicateIndex()
+    for i, text in enumerate(texts):
+        index.add(i, text)
+    return index.clusters()
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from CONFIG import (
+    EMBEDDINGS_ENABLED, EMBEDDING_MODEL, EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_CHARS,
+    RELEVANCE_THRESHOLD, RELEVANCE_TIEBREAK_MARGIN, RELEVANCE_THRESHOLD_STEP
+)
+from database import get_channel_description, get_channel_embedding, set_channel_embedding
+from channel_analyzer import classify_posts_relevance
+from prefilter import check_heuristics
+from llm_gateway import get_gateway, LLMError
+
+# Без numpy релевантность проверяется только через OpenAI
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Порог не должен уходить в крайности из-за череды одинаковых ответов
+MIN_THRESHOLD = 0.1
+MAX_THRESHOLD = 0.9
+
+
+def is_available():
+    """
+    Можно ли проверять релевантность по векторам.
+    """
+    return EMBEDDINGS_ENABLED and np is not None
+
+
+def to_blob(vector):
+    """
+    Вектор -> bytes (float32) для хранения в SQLite.
+    """
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def from_blob(blob):
+    return np.frombuffer(blob, dtype=np.float32)
+
+
+def cosine_similarities(vectors, vector):
+    """
+    Косинусная близость каждого из vectors к vector одним матричным умножением.
+    """
+    matrix = np.vstack(vectors)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+    norms[norms == 0] = 1.0
+    return (matrix @ vector) / norms
+
+
+async def _embed_batch(texts):
+    try:
+        response = await get_gateway().embed("embed_texts", EMBEDDING_MODEL, texts)
+    except LLMError as e:
+        logging.error(f"Ошибка при векторизации {len(texts)} текстов: {e}")
+        return [None] * len(texts)
+    return [to_blob(item.embedding) for item in sorted(response.data, key=lambda item: item.index)]
+
+
+async def embed_texts(texts):
+    """
+    Векторизует тексты пачками по EMBEDDING_BATCH_SIZE. Возвращает список bytes
+    (None для текстов, которые не удалось векторизовать) в том же порядке.
+    """
+    texts = [text[:EMBEDDING_MAX_CHARS] for text in texts]
+    batches = [texts[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+    results = await asyncio.gather(*(_embed_batch(batch) for batch in batches))
+    return [blob for batch in results for blob in batch]
+
+
+async def get_description_vector(user_id, channel_username, channel_description):
+    """
+    Возвращает (вектор описания канала или None, порог релевантности канала).
+    Описание векторизуется один раз и хранится рядом с ним в базе.
+    """
+    blob, threshold = get_channel_embedding(user_id, channel_username)
+    threshold = threshold if threshold is not None else RELEVANCE_THRESHOLD
+    if blob is None:
+        blob = (await embed_texts([channel_description]))[0]
+        if blob is None:
+            return None, threshold
+        set_channel_embedding(user_id, channel_username, blob, threshold)
+    return from_blob(blob), threshold
+
+
+def _adjust_threshold(threshold, scores, verdicts):
+    """
+    Сдвигает порог канала по пограничным постам: если пост ниже порога оказался релевантным,
+    порог опускается, если выше порога оказался нерелевантным - поднимается.
+    """
+    for score, relevant in zip(scores, verdicts):
+        if score is None or abs(score - threshold) >= RELEVANCE_TIEBREAK_MARGIN:
+            continue
+        if relevant and score < threshold:
+            threshold -= RELEVANCE_THRESHOLD_STEP
+        elif not relevant and score >= threshold:
+            threshold += RELEVANCE_THRESHOLD_STEP
+    return min(MAX_THRESHOLD, max(MIN_THRESHOLD, threshold))
+
+
+async def classify_channel_posts(user_id, channel_username, posts, channel_description=None):
+    """
+    Проверяет релевантность постов канала пользователя.
+    channel_description по умолчанию берется из базы.
+    posts - словари с 'text' и, возможно, уже сохраненным 'embedding'. Недостающие векторы
+    вычисляются и записываются в post['embedding'] - вызывающий код сохраняет их в базу.
+    Близость к описанию канала считается одним батчем; OpenAI решает только пограничные
+    посты и посты без вектора. Возвращает список bool в том же порядке, что и posts.
+    """
+    post_texts = [post['text'] for post in posts]
+    channel_description = channel_description or get_channel_description(user_id, channel_username)
+    if not posts or not channel_description or not is_available():
+        return await classify_posts_relevance(post_texts, channel_description)
+
+    # Явный мусор предфильтр отбросит и так, его не векторизуем
+    missing = [post for post in posts if not post.get('embedding') and check_heuristics(post['text']) is None]
+    if missing:
+        for post, blob in zip(missing, await embed_texts([post['text'] for post in missing])):
+            post['embedding'] = blob
+
+    description_vector, threshold = await get_description_vector(user_id, channel_username, channel_description)
+    if description_vector is None:
+        return await classify_posts_relevance(post_texts, channel_description)
+
+    scores = [None] * len(posts)
+    indexes = [i for i, post in enumerate(posts) if post.get('embedding')]
+    if indexes:
+        similarities = cosine_similarities([from_blob(posts[i]['embedding']) for i in indexes], description_vector)
+        for i, similarity in zip(indexes, similarities):
+            scores[i] = float(similarity)
+
+    verdicts = await classify_posts_relevance(post_texts, channel_description, scores=scores, threshold=threshold)
+
+    new_threshold = _adjust_threshold(threshold, scores, verdicts)
+    if new_threshold != threshold:
+        logging.info(f"Порог релевантности канала @{channel_username} для пользователя {user_id}: "
+                     f"{threshold:.2f} -> {new_threshold:.2f}")
+        set_channel_embedding(user_id, channel_username, to_blob(description_vector), new_threshold)
+    return verdicts
@@ -0,0 +1,138 @@
+import logging
+from bs4 import BeautifulSoup
+from CONFIG import HTML_EXTRACTOR
+
+# Быстрые парсеры необязательны: если библиотека не установлена, бэкенд просто недоступен
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Метки для постов без текста, в порядке проверки
+MEDIA_TYPES = {
+    'photo': "[Картинка]",
+    'video': "[Видео]",
+    'gif': "[GIF]",
+    'document': "[Файл]"
+}
+MEDIA_FALLBACK = "[Медиа]"
+
+
+def _xpath_class(class_name):
+    """
+    XPath-условие "у элемента есть класс class_name" (как class_ в BeautifulSoup).
+    """
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+def extract_posts_bs4(html):
+    """
+    Эталонный разбор страницы канала через BeautifulSoup.
+    Возвращает посты в порядке публикации: [{'id': ..., 'text': ...}, ...].
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    posts = []
+    for message in soup.find_all('div', class_='tgme_widget_message'):
+        post_content = {'id': message.get('data-post')}
+
+        # Проверяем наличие текста
+        text = message.find('div', class_='tgme_widget_message_text')
+        if text:
+            post_content['text'] = text.get_text(strip=True)
+        else:
+            # Если текста нет, проверяем наличие медиа
+            post_content['text'] = MEDIA_FALLBACK
+            for media_type, label in MEDIA_TYPES.items():
+                if message.find('div', class_=f'tgme_widget_message_{media_type}'):
+                    post_content['text'] = label
+                    break
+
+        posts.append(post_content)
+    return posts
+
+
+_LXML_MESSAGES = f"//div[{_xpath_class('tgme_widget_message')}]"
+_LXML_TEXT = f".//div[{_xpath_class('tgme_widget_message_text')}]"
+_LXML_MEDIA = {
+    media_type: f".//div[{_xpath_class(f'tgme_widget_message_{media_type}')}]"
+    for media_type in MEDIA_TYPES
+}
+
+
+def extract_posts_lxml(html):
+    """
+    Разбор страницы канала через lxml. Результат совпадает с extract_posts_bs4.
+    """
+    root = lxml.html.fromstring(html)
+    posts = []
+    for message in root.xpath(_LXML_MESSAGES):
+        post_content = {'id': message.get('data-post')}
+
+        text = message.xpath(_LXML_TEXT)
+        if text:
+            # text() не включает комментарии - так же, как get_text() в BeautifulSoup
+            post_content['text'] = "".join(part.strip() for part in text[0].xpath('.//text()'))
+        else:
+            post_content['text'] = MEDIA_FALLBACK
+            for media_type, label in MEDIA_TYPES.items():
+                if message.xpath(_LXML_MEDIA[media_type]):
+                    post_content['text'] = label
+                    break
+
+        posts.append(post_content)
+    return posts
+
+
+def extract_posts_selectolax(html):
+    """
+    Разбор страницы канала через selectolax (движок lexbor). Результат совпадает с extract_posts_bs4.
+    """
+    tree = LexborHTMLParser(html)
+    posts = []
+    for message in tree.css('div.tgme_widget_message'):
+        post_content = {'id': message.attributes.get('data-post')}
+
+        text = message.css_first('div.tgme_widget_message_text')
+        if text is not None:
+            post_content['text'] = text.text(deep=True, separator='', strip=True)
+        else:
+            post_content['text'] = MEDIA_FALLBACK
+            for media_type, label in MEDIA_TYPES.items():
+                if message.css_first(f'div.tgme_widget_message_{media_type}') is not None:
+                    post_content['text'] = label
+                    break
+
+        posts.append(post_content)
+    return posts
+
+
+EXTRACTORS = {'bs4': extract_posts_bs4}
+if lxml is not None:
+    EXTRACTORS['lxml'] = extract_posts_lxml
+if LexborHTMLParser is not None:
+    EXTRACTORS['selectolax'] = extract_posts_selectolax
+
+# Порядок выбора бэкенда при HTML_EXTRACTOR = "auto": от самого быстрого к эталонному
+AUTO_ORDER = ['selectolax', 'lxml', 'bs4']
+
+
+def get_extractor(name=HTML_EXTRACTOR):
+    """
+    Возвращает функцию разбора страницы канала по имени бэкенда.
+    Если запрошенный бэкенд недоступен, используется BeautifulSoup.
+    """
+    if name == "auto":
+        name = next(backend for backend in AUTO_ORDER if backend in EXTRACTORS)
+    extractor = EXTRACTORS.get(name)
+    if extractor is None:
+        logging.warning(f"Парсер HTML '{name}' недоступен, используется bs4.")
+        extractor = extract_posts_bs4
+    return extractor
@@ -0,0 +1,310 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from email.utils import parsedate_to_datetime
+import aiohttp
+import metrics
+from rate_limit import TokenBucket, CircuitBreaker
+from CONFIG import (
+    HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST, HTTP_DNS_CACHE_TTL, HTTP_KEEPALIVE_TIMEOUT,
+    HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_TOTAL_TIMEOUT, SCRAPE_MAX_RPS, SCRAPE_DEFAULT_RETRY_AFTER,
+    BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN, BREAKER_MAX_COOLDOWN
+)
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Идентификаторы постов на странице канала. По ним считается хэш "значимой" части страницы:
+# счетчики просмотров и прочие динамические элементы меняются постоянно и не должны
+# вызывать повторный разбор, а новые посты всегда добавляют новый data-post.
+POST_ID_RE = re.compile(r'data-post="([^"]+)"')
+
+class FetchError(Exception):
+    """
+    Ошибка при загрузке страницы канала.
+    """
+
+
+class RateLimitedError(FetchError):
+    """
+    t.me ответил 429: весь скрапинг приостановлен на retry_after секунд.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"t.me ограничил частоту запросов, пауза {retry_after:.0f} с")
+        self.retry_after = retry_after
+
+
+class ChannelUnavailableError(FetchError):
+    """
+    Канал не существует, переименован или закрыт (нет публичного превью /s/).
+    """
+
+
+class CircuitOpenError(FetchError):
+    """
+    Предохранитель канала открыт: канал временно не опрашивается.
+    """
+
+
+def parse_retry_after(value):
+    """
+    Разбирает заголовок Retry-After (секунды или HTTP-дата) в количество секунд.
+    """
+    if not value:
+        return SCRAPE_DEFAULT_RETRY_AFTER
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return SCRAPE_DEFAULT_RETRY_AFTER
+
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (compatible; tgDigestAI/1.0)",
+    "Accept": "text/html,application/xhtml+xml",
+}
+
+
+class ChannelFetcher:
+    """
+    Общий HTTP-клиент для скрапинга t.me.
+    Держит одну сессию aiohttp с пулом keep-alive соединений, кэшем DNS
+    и ограничением числа соединений на хост.
+    Все запросы проходят через общий token bucket; ответ 429 приостанавливает скрапинг
+    на время из Retry-After, а у каждого канала есть предохранитель, который временно
+    отключает опрос несуществующих или постоянно падающих каналов.
+    """
+
+    def __init__(self):
+        self._session = None
+        # Валидаторы последнего ответа по каждому ключу условного запроса:
+        # {conditional_key: {"params": ..., "etag": ..., "last_modified": ..., "hash": ...}}
+        self._validators = {}
+        self._bucket = TokenBucket(SCRAPE_MAX_RPS)
+        self._paused_until = 0.0   # time.monotonic(), до которого действует пауза после 429
+        self._breakers = {}        # channel_username -> CircuitBreaker
+
+    def _get_session(self):
+        """
+        Лениво создает сессию: она должна создаваться внутри работающего event loop.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=HTTP_TOTAL_TIMEOUT,
+                connect=HTTP_CONNECT_TIMEOUT,
+                sock_read=HTTP_READ_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=HEADERS)
+            logging.info("Создана общая HTTP-сессия для t.me.")
+        return self._session
+
+    async def fetch_channel_page(self, channel_username, after=None, before=None, conditional_key=None):
+        """
+        Асинхронно получает HTML-страницу канала через общий пул соединений.
+        after/before - номера постов для постраничной навигации (?after=/?before=).
+        Если передан conditional_key и страница не изменилась с прошлого запроса
+        с тем же ключом (ответ 304 или тот же хэш списка постов), возвращает None.
+        Ключ отделяет потребителей друг от друга, чтобы один из них не "съел" изменения другого.
+        """
+        url = f"https://t.me/s/{channel_username}"
+        params = {}
+        if after is not None:
+            params["after"] = str(after)
+        if before is not None:
+            params["before"] = str(before)
+
+        request_headers = {}
+        previous = self._validators.get(conditional_key) if conditional_key is not None else None
+        if previous and previous["params"] == params:
+            if previous["etag"]:
+                request_headers["If-None-Match"] = previous["etag"]
+            if previous["last_modified"]:
+                request_headers["If-Modified-Since"] = previous["last_modified"]
+        else:
+            previous = None
+
+        breaker = self._breakers.setdefault(
+            channel_username, CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN, BREAKER_MAX_COOLDOWN)
+        )
+        if not breaker.allow():
+            metrics.inc("channel_breaker_rejected_total")
+            raise CircuitOpenError(f"Канал @{channel_username} временно не опрашивается (предохранитель открыт)")
+
+        await self._wait_for_slot()
+        try:
+            session = self._get_session()
+            async with session.get(url, params=params or None, headers=request_headers or None) as response:
+                metrics.inc("channel_pages_fetched_total")
+                if response.status == 429:
+                    # Ограничение со стороны t.me - не вина канала, предохранитель не трогаем
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    self._pause(retry_after)
+                    raise RateLimitedError(retry_after)
+                if response.status == 304 and previous:
+                    self._record_skip("not_modified")
+                    self._record_success(channel_username, breaker)
+                    return None
+                if response.status == 404 or not response.url.path.startswith("/s/"):
+                    # Для несуществующего канала t.me отдает 404 или перенаправляет со /s/ на обычную страницу
+                    raise ChannelUnavailableError(f"Канал @{channel_username} недоступен")
+                if response.status != 200:
+                    raise FetchError(f"Ошибка при запросе к каналу: {response.status}")
+                html = await response.text()
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        except RateLimitedError:
+            raise
+        except (FetchError, aiohttp.ClientError, asyncio.TimeoutError):
+            self._record_failure(channel_username, breaker)
+            raise
+        self._record_success(channel_username, breaker)
+
+        if conditional_key is None:
+            self._update_skip_ratio()
+            return html
+
+        page_hash = hashlib.sha1("\n".join(POST_ID_RE.findall(html)).encode("utf-8")).hexdigest()
+        self._validators[conditional_key] = {
+            "params": params, "etag": etag, "last_modified": last_modified, "hash": page_hash
+        }
+        if previous and previous["hash"] == page_hash:
+            self._record_skip("same_hash")
+            return None
+        self._update_skip_ratio()
+        return html
+
+    async def _wait_for_slot(self):
+        """
+        Ждет окончания паузы после 429 и свободного жетона в общем token bucket.
+        """
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self._bucket.acquire()
+
+    def _pause(self, retry_after):
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        metrics.inc("scrape_throttled_total")
+        metrics.set_gauge("scrape_last_retry_after_seconds", retry_after)
+        logging.warning(f"t.me ограничил частоту запросов (429), скрапинг приостановлен на {retry_after:.0f} с.")
+
+    def _record_failure(self, channel_username, breaker):
+        if breaker.record_failure():
+            metrics.inc("channel_breaker_transitions_total", state=CircuitBreaker.OPEN)
+            logging.warning(f"Предохранитель канала @{channel_username} открыт на {breaker.cooldown:.0f} с "
+                            f"(ошибок подряд: {breaker.failures}).")
+        self._update_breaker_gauge()
+
+    def _record_success(self, channel_username, breaker):
+        if breaker.record_success():
+            metrics.inc("channel_breaker_transitions_total", state=CircuitBreaker.CLOSED)
+            logging.info(f"Предохранитель канала @{channel_username} закрыт, канал снова опрашивается.")
+            self._update_breaker_gauge()
+
+    def _update_breaker_gauge(self):
+        opened = sum(1 for breaker in self._breakers.values() if breaker.state != CircuitBreaker.CLOSED)
+        metrics.set_gauge("channel_breakers_open", opened)
+
+    def breaker_states(self):
+        """
+        Состояние предохранителей всех каналов, у которых были ошибки:
+        {channel_username: {"state", "failures", "retry_in"}}.
+        """
+        now = time.monotonic()
+        return {
+            channel_username: {
+                "state": breaker.state,
+                "failures": breaker.failures,
+                "retry_in": max(0.0, breaker.retry_at - now),
+            }
+            for channel_username, breaker in self._breakers.items()
+            if breaker.failures or breaker.state != CircuitBreaker.CLOSED
+        }
+
+    def retry_at(self, channel_username):
+        """
+        Момент (time.monotonic()), раньше которого канал опрашивать бессмысленно:
+        учитывает открытый предохранитель канала и общую паузу после 429.
+        """
+        breaker = self._breakers.get(channel_username)
+        breaker_retry = breaker.retry_at if breaker and breaker.state == CircuitBreaker.OPEN else 0.0
+        return max(breaker_retry, self._paused_until)
+
+    def _record_skip(self, reason):
+        metrics.inc("channel_pages_unchanged_total", reason=reason)
+        self._update_skip_ratio()
+
+    def _update_skip_ratio(self):
+        metrics.set_gauge("channel_pages_skip_ratio", self.skip_rate())
+
+    def skip_rate(self):
+        """
+        Доля загруженных страниц, разбор которых был пропущен, так как они не изменились.
+        """
+        fetched = metrics.total("channel_pages_fetched_total")
+        if not fetched:
+            return 0.0
+        return metrics.total("channel_pages_unchanged_total") / fetched
+
+    def forget(self, conditional_key):
+        """
+        Сбрасывает сохраненные валидаторы ключа (следующий запрос будет безусловным).
+        """
+        self._validators.pop(conditional_key, None)
+
+    async def close(self):
+        """
+        Закрывает сессию и все соединения пула.
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logging.info("Общая HTTP-сессия для t.me закрыта.")
+        self._session = None
+
+
+_fetcher = None
+
+
+def get_fetcher():
+    """
+    Возвращает общий (единственный на процесс) экземпляр ChannelFetcher.
+    """
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = ChannelFetcher()
+    return _fetcher
+
+
+async def close_fetcher():
+    """
+    Закрывает общий fetcher при завершении работы.
+    """
+    global _fetcher
+    if _fetcher is not None:
+        await _fetcher.close()
+        _fetcher = None
+
+
+def breakers_report():
+    """
+    Текстовый отчет о предохранителях каналов (для /breakers на сервере метрик).
+    """
+    states = get_fetcher().breaker_states()
+    if not states:
+        return "Ошибок при опросе каналов нет.\n"
+    lines = [f"{'канал':<34}{'состояние':<12}{'ошибок':>8}{'повтор через, с':>18}"]
+    for channel_username, state in sorted(states.items(), key=lambda item: -item[1]["failures"]):
+        lines.append(f"@{channel_username:<33}{state['state']:<12}{state['failures']:>8}{state['retry_in']:>18.0f}")
+    return "\n".join(lines) + "\n"
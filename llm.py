@@ -0,0 +1,123 @@
+import logging
+import math
+import time
+import metrics
+from CONFIG import LLM_MODEL_TIERS, LLM_TASK_TIERS, LLM_DEFAULT_TIER, LLM_ESCALATION
+from llm_cache import get_cache, make_key
+from llm_gateway import get_gateway, LLMError
+from prompts import TEMPLATES
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Версии шаблонов промптов. При изменении текста промпта версию нужно увеличить,
+# иначе из кэша будут возвращаться ответы на старый промпт.
+PROMPT_VERSIONS = {
+    "analyze_post_quality": 1,
+    "summarize_posts": 1,
+    "analyze_channel_content": 1,
+    "summarize_channel_chunk": 1,
+    "create_short_channel_description": 1,
+    "create_detailed_channel_description": 1,
+    "create_channel_profile": 1,
+}
+# Версии шаблонов с общим префиксом задаются в самих шаблонах (prompts.py)
+PROMPT_VERSIONS.update({name: template.version for name, template in TEMPLATES.items()})
+
+
+# Виды задач для маршрутизации по моделям (LLM_TASK_TIERS). Задачи, которых здесь нет,
+# выполняются на уровне LLM_DEFAULT_TIER.
+TASK_ROUTES = {
+    "is_post_relevant": "relevance",
+    "classify_posts_relevance": "relevance",
+    "is_summary_relevant": "relevance",
+    "filter_unrelated_posts": "relevance",
+    "analyze_post_quality": "post_summary",
+    "summarize_posts": "post_summary",
+    "analyze_channel_content": "channel_description",
+    "summarize_channel_chunk": "channel_description",
+    "create_short_channel_description": "channel_description",
+    "create_detailed_channel_description": "channel_description",
+    "create_channel_profile": "channel_description",
+    "rank_channel_summaries": "dedup_merge",
+}
+
+
+def task_tier(task):
+    return LLM_TASK_TIERS.get(TASK_ROUTES.get(task), LLM_DEFAULT_TIER)
+
+
+def route_model(task):
+    """
+    Модель, на которой выполняется задача.
+    """
+    return LLM_MODEL_TIERS[task_tier(task)]
+
+
+def answer_confidence(response):
+    """
+    Вероятность первого токена ответа или None, если вероятности не запрашивались.
+    """
+    logprobs = response.choices[0].logprobs
+    if logprobs is None or not logprobs.content:
+        return None
+    return math.exp(logprobs.content[0].logprob)
+
+
+async def _ask(task, model, messages, max_tokens, deadline, validate, min_confidence):
+    """
+    Один запрос к модели. Возвращает (ответ, причина для повтора на более сильной модели или None).
+    """
+    response = await get_gateway().chat(task, model, messages, max_tokens, deadline=deadline,
+                                        logprobs=min_confidence is not None)
+    content = response.choices[0].message.content
+    if content is None or (validate is not None and not validate(content)):
+        return content, "malformed"
+    confidence = answer_confidence(response) if min_confidence is not None else None
+    if confidence is not None and confidence < min_confidence:
+        return content, "low_confidence"
+    return content, None
+
+
+async def complete(task, messages, max_tokens, model=None, use_cache=True, deadline=None, validate=None,
+                   min_confidence=None):
+    """
+    Единая точка вызова chat completions: возвращает текст ответа модели.
+    Ответы кэшируются по модели, задаче, версии промпта и хэшу входа, поэтому
+    одинаковые запросы разных пользователей не отправляются в OpenAI повторно.
+    Запрос выполняется через общий шлюз (llm_gateway.py) с повторами временных ошибок;
+    если ответ получить не удалось, пробрасывается LLMError.
+
+    Если model не задана, она выбирается по виду задачи (route_model). Ответ, не прошедший
+    проверку validate(ответ), или ответ с вероятностью первого токена ниже min_confidence
+    повторяется на модели следующего уровня (LLM_ESCALATION), если он есть.
+    """
+    routed = model is None
+    model = model or route_model(task)
+    key = make_key(model, task, PROMPT_VERSIONS.get(task, 1), {"messages": messages, "max_tokens": max_tokens})
+    cache = get_cache()
+    if use_cache:
+        cached = cache.get(key, task)
+        if cached is not None:
+            logging.debug(f"Ответ для {task} взят из кэша LLM.")
+            return cached
+
+    started = time.monotonic()
+    answered_by = model
+    content, reason = await _ask(task, model, messages, max_tokens, deadline, validate, min_confidence)
+    stronger_tier = LLM_ESCALATION.get(task_tier(task)) if routed else None
+    if reason is not None and stronger_tier is not None:
+        answered_by = LLM_MODEL_TIERS[stronger_tier]
+        logging.info(f"{task}: ответ {model} не принят ({reason}), повторяем запрос на {answered_by}.")
+        content, reason = await _ask(task, answered_by, messages, max_tokens, deadline, validate, min_confidence)
+
+    metrics.inc("llm_route_total", task=task, route=TASK_ROUTES.get(task, "-"), model=answered_by,
+                escalated="yes" if answered_by != model else "no")
+    metrics.observe("llm_route_duration_seconds", time.monotonic() - started, task=task, model=answered_by)
+    if content is None:
+        raise LLMError(f"{task}: пустой ответ модели")
+    # Неразборчивый ответ не кэшируется: в следующий раз модель может ответить правильно.
+    # Ответ сильной модели сохраняется под ключом исходной, чтобы не повторять эскалацию.
+    if use_cache and reason != "malformed":
+        cache.set(key, task, content)
+    return content
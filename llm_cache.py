@@ -0,0 +1,135 @@
+import hashlib
+import json
+import logging
+import time
+import metrics
+from CONFIG import LLM_CACHE_PATH, LLM_CACHE_TTL, LLM_CACHE_MAX_ENTRIES
+from database import connect_db, release_connection
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def make_key(model, task, version, payload):
+    """
+    Ключ кэша: модель, задача и версия шаблона промпта плюс хэш входных данных.
+    """
+    digest = hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"{model}:{task}:v{version}:{digest}"
+
+
+class LLMCache:
+    """
+    Постоянный кэш ответов LLM в SQLite, общий для всех пользователей.
+    Соединение с базой долгоживущее (database.connect_db), а не открывается на каждый запрос.
+    Записи живут не дольше ttl секунд; при превышении max_entries вытесняются
+    давно не использованные (LRU).
+    """
+
+    def __init__(self, path=LLM_CACHE_PATH, ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._create_table()
+
+    def _create_table(self):
+        conn = connect_db(self.path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    task TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache (accessed_at)')
+            conn.commit()
+        except Exception as e:
+            logging.error(f"Ошибка при создании таблицы кэша LLM: {e}")
+        finally:
+            release_connection(conn)
+
+    def get(self, key, task):
+        """
+        Возвращает закэшированный ответ или None. Просроченная запись удаляется.
+        """
+        now = time.time()
+        conn = connect_db(self.path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT response, created_at FROM llm_cache WHERE key = ?', (key,))
+            row = cursor.fetchone()
+            if row and now - row[1] <= self.ttl:
+                cursor.execute('UPDATE llm_cache SET accessed_at = ? WHERE key = ?', (now, key))
+                conn.commit()
+                self._record(task, hit=True)
+                return row[0]
+            if row:
+                cursor.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                conn.commit()
+        except Exception as e:
+            logging.error(f"Ошибка при чтении кэша LLM: {e}")
+        finally:
+            release_connection(conn)
+        self._record(task, hit=False)
+        return None
+
+    def set(self, key, task, response):
+        """
+        Сохраняет ответ и при необходимости вытесняет самые давно использованные записи.
+        """
+        now = time.time()
+        conn = connect_db(self.path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                'INSERT OR REPLACE INTO llm_cache (key, task, response, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                (key, task, response, now, now)
+            )
+            cursor.execute('SELECT COUNT(*) FROM llm_cache')
+            overflow = cursor.fetchone()[0] - self.max_entries
+            if overflow > 0:
+                # Сначала выкидываем просроченные, затем самые давно использованные
+                cursor.execute('DELETE FROM llm_cache WHERE created_at < ?', (now - self.ttl,))
+                overflow -= cursor.rowcount
+            if overflow > 0:
+                cursor.execute('''
+                    DELETE FROM llm_cache WHERE key IN (
+                        SELECT key FROM llm_cache ORDER BY accessed_at LIMIT ?
+                    )
+                ''', (overflow,))
+            conn.commit()
+        except Exception as e:
+            logging.error(f"Ошибка при записи в кэш LLM: {e}")
+        finally:
+            release_connection(conn)
+
+    @staticmethod
+    def _record(task, hit):
+        metrics.inc("llm_cache_hits_total" if hit else "llm_cache_misses_total", task=task)
+        metrics.set_gauge("llm_cache_hit_ratio", LLMCache.hit_rate())
+
+    @staticmethod
+    def hit_rate():
+        """
+        Доля запросов к LLM, на которые ответ нашелся в кэше.
+        """
+        hits = metrics.total("llm_cache_hits_total")
+        requests = hits + metrics.total("llm_cache_misses_total")
+        return hits / requests if requests else 0.0
+
+
+_cache = None
+
+
+def get_cache():
+    """
+    Возвращает общий (единственный на процесс) экземпляр LLMCache.
+    """
+    global _cache
+    if _cache is None:
+        _cache = LLMCache()
+    return _cache
@@ -0,0 +1,294 @@
+"""
+Единый шлюз к OpenAI: все запросы chat completions и embeddings идут через один клиент
+AsyncOpenAI с общим пулом keep-alive соединений.
+
+Шлюз ограничивает число одновременных запросов на весь процесс (LLM_MAX_CONCURRENCY)
+и раздает слоты по полосам приоритета: интерактивные запросы (пользователь ждет ответа бота)
+обслуживаются раньше фоновых, а внутри полосы слоты делятся между пользователями
+по весам LLM_USER_WEIGHTS. Шлюз также дает каждому запросу общий срок (LLM_DEADLINE)
+и таймаут попытки (LLM_REQUEST_TIMEOUT), повторяет временные ошибки (таймаут, обрыв
+соединения, 429, 5xx) со случайной паузой и для задач из LLM_HEDGE_TASKS дублирует запросы,
+застрявшие в "хвосте" задержек.
+Через шлюз идут и запросы к Batch API (batch_jobs.py): у них свой клиент, если задан
+BATCH_API_BASE_URL, но те же повторы, сроки и полосы.
+Ошибка, которую не удалось пережить повторами, пробрасывается как LLMError.
+"""
+import asyncio
+import collections
+import logging
+import random
+import time
+import metrics
+from rate_limit import PriorityScheduler
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError, RateLimitError, InternalServerError
+from CONFIG import (
+    OPENAI_API, LLM_MAX_CONCURRENCY, LLM_INTERACTIVE_RESERVED, LLM_USER_WEIGHTS, LLM_REQUEST_TIMEOUT,
+    LLM_DEADLINE, LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY, LLM_HEDGE_TASKS,
+    LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_DELAY, LLM_HEDGE_MIN_SAMPLES, BATCH_API_BASE_URL, BATCH_REQUEST_TIMEOUT,
+    BATCH_REQUEST_DEADLINE
+)
+from llm_telemetry import record_call, current_user, current_lane, LANES
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Ошибки, после которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = (asyncio.TimeoutError, APITimeoutError, APIConnectionError, RateLimitError, InternalServerError)
+RETRYABLE_STATUS_CODES = {408, 409}
+
+# Сколько последних задержек задачи учитывается при выборе момента дублирования
+LATENCY_WINDOW = 200
+
+
+class LLMError(Exception):
+    """
+    Запрос к OpenAI не выполнен: ошибка не временная или повторы не помогли.
+    """
+
+
+class LLMDeadlineError(LLMError):
+    """
+    Запрос к OpenAI не уложился в отведенный срок.
+    """
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code in RETRYABLE_STATUS_CODES
+
+
+def retry_delay(attempt, error=None):
+    """
+    Пауза перед повтором: "полный джиттер" (случайная от 0 до экспоненциальной границы),
+    чтобы повторы многих запросов не приходили в OpenAI одновременно.
+    После 429 пауза не меньше присланного Retry-After.
+    """
+    delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+    if isinstance(error, RateLimitError):
+        try:
+            delay = max(delay, float(error.response.headers.get("retry-after", 0)))
+        except (TypeError, ValueError):
+            pass
+    return delay
+
+
+class LLMGateway:
+    """
+    Общий клиент OpenAI с приоритетным ограничением одновременных запросов, сроками,
+    повторами и дублированием.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._batch_client = None  # клиент заглушки Batch API (BATCH_API_BASE_URL)
+        self._scheduler = PriorityScheduler(
+            LLM_MAX_CONCURRENCY, LANES, reserved=LLM_INTERACTIVE_RESERVED, weights=LLM_USER_WEIGHTS
+        )
+        self._latencies = {}  # задача -> последние задержки успешных попыток
+
+    def _get_client(self):
+        """
+        Лениво создает клиент. Собственные повторы SDK отключены - их делает шлюз.
+        """
+        if self._client is None:
+            self._client = AsyncOpenAI(api_key=OPENAI_API, max_retries=0, timeout=LLM_REQUEST_TIMEOUT)
+            logging.info("Создан общий клиент OpenAI.")
+        return self._client
+
+    def _get_batch_client(self):
+        """
+        Клиент для Batch API: общий клиент OpenAI или, если задан BATCH_API_BASE_URL, отдельный
+        клиент заглушки (mock_batch_api.py).
+        """
+        if BATCH_API_BASE_URL is None:
+            return self._get_client()
+        if self._batch_client is None:
+            self._batch_client = AsyncOpenAI(api_key=OPENAI_API, base_url=BATCH_API_BASE_URL, max_retries=0,
+                                             timeout=BATCH_REQUEST_TIMEOUT)
+        return self._batch_client
+
+    def _update_gauges(self):
+        for lane in LANES:
+            metrics.set_gauge("llm_in_flight_requests", self._scheduler.in_flight[lane], lane=lane)
+            metrics.set_gauge("llm_queued_requests", self._scheduler.waiting(lane), lane=lane)
+
+    def _hedge_delay(self, function):
+        """
+        Через сколько секунд без ответа отправлять копию запроса (None - не дублировать).
+        """
+        latencies = self._latencies.get(function)
+        if function not in LLM_HEDGE_TASKS or not latencies or len(latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(latencies)
+        return max(LLM_HEDGE_MIN_DELAY, ordered[min(len(ordered) - 1, int(LLM_HEDGE_PERCENTILE * len(ordered)))])
+
+    async def _attempt(self, function, request, timeout):
+        """
+        Одна попытка: ждет слот в своей полосе и выполняет запрос не дольше timeout
+        (ожидание слота входит в timeout).
+        """
+        lane, user_id = current_lane.get(), current_user.get()
+
+        async def run():
+            queued = time.monotonic()
+            self._update_gauges()
+            try:
+                await self._scheduler.acquire(lane, user_id)
+            finally:
+                self._update_gauges()
+            metrics.observe("llm_queue_wait_seconds", time.monotonic() - queued, lane=lane)
+            started = time.monotonic()
+            try:
+                response = await request(self._get_client())
+            finally:
+                self._scheduler.release(lane)
+                self._update_gauges()
+            self._latencies.setdefault(function, collections.deque(maxlen=LATENCY_WINDOW)).append(
+                time.monotonic() - started
+            )
+            return response
+
+        return await asyncio.wait_for(run(), timeout)
+
+    async def _hedged_attempt(self, function, request, timeout):
+        """
+        Попытка с дублированием: если первый запрос не ответил за типичное для задачи время,
+        отправляется копия, и берется ответ, пришедший первым. Второй запрос отменяется.
+        """
+        hedge_delay = self._hedge_delay(function)
+        if hedge_delay is None or hedge_delay >= timeout:
+            return await self._attempt(function, request, timeout)
+
+        primary = asyncio.ensure_future(self._attempt(function, request, timeout))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=hedge_delay)
+            if done:
+                return primary.result()
+            metrics.inc("llm_hedged_requests_total", function=function)
+            hedge = asyncio.ensure_future(self._attempt(function, request, timeout - hedge_delay))
+            pending.add(hedge)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            metrics.inc("llm_hedge_wins_total", function=function)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _call(self, function, model, request, deadline=None, timeout=LLM_REQUEST_TIMEOUT):
+        """
+        Выполняет запрос с повторами временных ошибок в пределах срока deadline
+        (timeout - таймаут одной попытки) и записывает ошибку в телеметрию.
+        Возвращает (ответ, число повторов).
+        """
+        started = time.monotonic()
+        deadline_at = started + (deadline or LLM_DEADLINE)
+        attempt = 0
+        while True:
+            remaining = deadline_at - time.monotonic()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                response = await self._hedged_attempt(function, request, min(timeout, remaining))
+                return response, attempt
+            except Exception as e:
+                delay = retry_delay(attempt, e)
+                if not is_retryable(e) or attempt >= LLM_MAX_RETRIES or time.monotonic() + delay >= deadline_at:
+                    record_call(function, model, time.monotonic() - started, retries=attempt, error=e)
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise LLMDeadlineError(f"{function}: нет ответа от OpenAI за {deadline or LLM_DEADLINE} с") from e
+                    raise LLMError(f"{function}: {type(e).__name__}: {e}") from e
+                logging.warning(f"{function}: временная ошибка OpenAI ({type(e).__name__}), "
+                                f"повтор {attempt + 1} через {delay:.1f} с.")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def chat(self, function, model, messages, max_tokens, deadline=None, logprobs=False):
+        """
+        Запрос chat completions. Возвращает ответ модели (ChatCompletion).
+        logprobs=True запрашивает вероятности токенов ответа.
+        """
+        started = time.monotonic()
+        options = {"logprobs": True} if logprobs else {}
+
+        async def request(client):
+            return await client.chat.completions.create(model=model, messages=messages, max_tokens=max_tokens, **options)
+
+        response, retries = await self._call(function, model, request, deadline)
+        usage = response.usage
+        details = getattr(usage, "prompt_tokens_details", None)
+        record_call(
+            function, model, time.monotonic() - started,
+            prompt_tokens=usage.prompt_tokens if usage else 0,
+            completion_tokens=usage.completion_tokens if usage else 0,
+            cached_tokens=getattr(details, "cached_tokens", None) or 0,
+            retries=retries
+        )
+        return response
+
+    async def embed(self, function, model, texts, deadline=None):
+        """
+        Запрос embeddings. Возвращает ответ (CreateEmbeddingResponse).
+        """
+        started = time.monotonic()
+
+        async def request(client):
+            return await client.embeddings.create(model=model, input=texts)
+
+        response, retries = await self._call(function, model, request, deadline)
+        record_call(function, model, time.monotonic() - started,
+                    prompt_tokens=response.usage.prompt_tokens if response.usage else 0, retries=retries)
+        return response
+
+    async def batch(self, function, request):
+        """
+        Запрос к Batch API (загрузка файла, создание или проверка пакета, скачивание результатов).
+        request(client) - корутина с самим запросом; она может выполниться несколько раз.
+        """
+        client = self._get_batch_client()
+        response, _ = await self._call(function, "batch", lambda _: request(client), BATCH_REQUEST_DEADLINE,
+                                       timeout=BATCH_REQUEST_TIMEOUT)
+        return response
+
+    async def close(self):
+        """
+        Закрывает клиенты и их пулы соединений.
+        """
+        if self._client is not None:
+            await self._client.close()
+            logging.info("Общий клиент OpenAI закрыт.")
+        if self._batch_client is not None:
+            await self._batch_client.close()
+        self._client = None
+        self._batch_client = None
+
+
+_gateway = None
+
+
+def get_gateway():
+    """
+    Возвращает общий (единственный на процесс) экземпляр LLMGateway.
+    """
+    global _gateway
+    if _gateway is None:
+        _gateway = LLMGateway()
+    return _gateway
+
+
+async def close_gateway():
+    """
+    Закрывает общий шлюз при завершении работы.
+    """
+    global _gateway
+    if _gateway is not None:
+        await _gateway.close()
+        _gateway = None
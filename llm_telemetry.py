@@ -0,0 +1,225 @@
+"""
+Телеметрия запросов к OpenAI: токены (в том числе взятые из кэша промптов OpenAI, см. prompts.py),
+задержка, ошибки, повторы и оценка стоимости.
+
+Каждый запрос помечается функцией (задачей промпта), этапом (check_new_posts, digest, ...),
+пользователем и полосой приоритета - их задает llm_context() через contextvars, поэтому
+метки не нужно передавать через все вызовы. По пользователю и полосе шлюз (llm_gateway.py)
+также распределяет запросы между интерактивной и фоновой работой. Метрики доступны в формате Prometheus (metrics.py)
+по функциям и этапам, а каждый запрос (вместе с пользователем) дополнительно пишется в LLM_TELEMETRY_PATH
+для локального отчета:
+    python llm_telemetry.py [часов]
+"""
+import contextvars
+import functools
+import logging
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+import metrics
+from CONFIG import LLM_TELEMETRY_PATH, LLM_PRICES
+from database import connect_db, release_connection
+from llm_cache import LLMCache
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Полосы приоритета запросов: интерактивные (пользователь ждет ответа бота) и фоновые
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+LANES = (INTERACTIVE, BACKGROUND)
+
+current_user = contextvars.ContextVar("llm_user", default=None)
+current_stage = contextvars.ContextVar("llm_stage", default=None)
+current_lane = contextvars.ContextVar("llm_lane", default=BACKGROUND)
+
+
+@contextmanager
+def llm_context(user_id=None, stage=None, lane=None):
+    """
+    Помечает все запросы к OpenAI внутри блока пользователем, этапом и/или полосой приоритета
+    (по умолчанию запросы фоновые). Задачи, созданные внутри блока (asyncio.gather и т.п.),
+    наследуют метки.
+    """
+    tokens = []
+    if user_id is not None:
+        tokens.append((current_user, current_user.set(user_id)))
+    if stage is not None:
+        tokens.append((current_stage, current_stage.set(stage)))
+    if lane is not None:
+        tokens.append((current_lane, current_lane.set(lane)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def llm_stage(stage):
+    """
+    Декоратор асинхронной функции: все запросы к OpenAI внутри нее помечаются этапом stage.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with llm_context(stage=stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    """
+    Оценка стоимости запроса в долларах по LLM_PRICES (цена за миллион токенов).
+    cached_tokens - часть prompt_tokens, взятая из кэша промптов по сниженной цене.
+    """
+    prompt_price, cached_price, completion_price = LLM_PRICES.get(model, (0.0, 0.0, 0.0))
+    return ((prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_price
+            + completion_tokens * completion_price) / 1_000_000
+
+
+def _create_table():
+    conn = connect_db(LLM_TELEMETRY_PATH)
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS llm_calls (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL NOT NULL,
+                function TEXT NOT NULL,
+                stage TEXT,
+                user_id INTEGER,
+                model TEXT NOT NULL,
+                latency REAL NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                retries INTEGER NOT NULL,
+                cost REAL NOT NULL,
+                error TEXT
+            )
+        ''')
+        cursor.execute('PRAGMA table_info(llm_calls)')
+        if 'cached_tokens' not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute('ALTER TABLE llm_calls ADD COLUMN cached_tokens INTEGER NOT NULL DEFAULT 0')
+        conn.commit()
+    finally:
+        release_connection(conn)
+
+
+_table_ready = False
+
+
+def record_call(function, model, latency, prompt_tokens=0, completion_tokens=0, retries=0, error=None,
+                cached_tokens=0, price_factor=1.0):
+    """
+    Записывает один запрос к OpenAI в метрики и в журнал запросов.
+    price_factor - доля обычной цены (запросы Batch API дешевле, см. BATCH_PRICE_FACTOR).
+    """
+    global _table_ready
+    user_id, stage = current_user.get(), current_stage.get()
+    # Пользователь в метки Prometheus не входит (число рядов росло бы с числом пользователей):
+    # расходы по пользователям есть только в журнале llm_calls и в summary_report
+    labels = {"function": function, "stage": stage or "-"}
+    cost = estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens) * price_factor
+
+    metrics.inc("llm_requests_total", status="error" if error else "ok", **labels)
+    metrics.inc("llm_prompt_tokens_total", prompt_tokens, **labels)
+    metrics.inc("llm_cached_prompt_tokens_total", cached_tokens, **labels)
+    metrics.inc("llm_completion_tokens_total", completion_tokens, **labels)
+    metrics.inc("llm_cost_usd_total", cost, **labels)
+    metrics.observe("llm_request_duration_seconds", latency, function=function, lane=current_lane.get())
+    if retries:
+        metrics.inc("llm_retries_total", retries, function=function)
+    if error:
+        metrics.inc("llm_errors_total", function=function, error=type(error).__name__)
+
+    try:
+        if not _table_ready:
+            _create_table()
+            _table_ready = True
+        conn = connect_db(LLM_TELEMETRY_PATH)
+        try:
+            conn.execute('''
+                INSERT INTO llm_calls (created_at, function, stage, user_id, model, latency,
+                                       prompt_tokens, cached_tokens, completion_tokens, retries, cost, error)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (time.time(), function, stage, user_id, model, latency, prompt_tokens, cached_tokens,
+                  completion_tokens, retries, cost, type(error).__name__ if error else None))
+            conn.commit()
+        finally:
+            release_connection(conn)
+    except Exception as e:
+        logging.error(f"Ошибка при записи телеметрии LLM: {e}")
+
+
+def _percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _share(part, total):
+    return f"{100 * part / total:.0f}%" if total else "-"
+
+
+def summary_report(since_hours=24):
+    """
+    Текстовый отчет по запросам за последние since_hours часов: по функциям и по пользователям.
+    """
+    try:
+        conn = connect_db(LLM_TELEMETRY_PATH)
+        try:
+            rows = conn.execute('''
+                SELECT function, user_id, model, latency, prompt_tokens, cached_tokens, completion_tokens, retries, cost, error
+                FROM llm_calls WHERE created_at >= ?
+            ''', (time.time() - since_hours * 3600,)).fetchall()
+        finally:
+            release_connection(conn)
+    except sqlite3.OperationalError:
+        rows = []
+    if not rows:
+        return f"Запросов к OpenAI за последние {since_hours} ч не было.\n"
+
+    by_function = {}
+    by_user = {}
+    by_model = {}
+    for function, user_id, model, latency, prompt_tokens, cached_tokens, completion_tokens, retries, cost, error in rows:
+        stats = by_function.setdefault(function, {"latencies": [], "prompt": 0, "cached": 0, "completion": 0,
+                                                  "retries": 0, "errors": 0, "cost": 0.0})
+        stats["latencies"].append(latency)
+        stats["prompt"] += prompt_tokens
+        stats["cached"] += cached_tokens
+        stats["completion"] += completion_tokens
+        stats["retries"] += retries
+        stats["errors"] += 1 if error else 0
+        stats["cost"] += cost
+        by_user[user_id] = by_user.get(user_id, 0.0) + cost
+        by_model.setdefault((function, model), []).append(latency)
+
+    lines = [f"Запросы к OpenAI за последние {since_hours} ч:",
+             f"{'функция':<38}{'вызовов':>8}{'ошибок':>8}{'повторов':>9}{'p50, с':>8}{'p95, с':>8}"
+             f"{'вход':>10}{'кэш':>6}{'выход':>9}{'$':>10}"]
+    for function, stats in sorted(by_function.items(), key=lambda item: -item[1]["cost"]):
+        lines.append(f"{function:<38}{len(stats['latencies']):>8}{stats['errors']:>8}{stats['retries']:>9}"
+                     f"{_percentile(stats['latencies'], 0.5):>8.2f}{_percentile(stats['latencies'], 0.95):>8.2f}"
+                     f"{stats['prompt']:>10}{_share(stats['cached'], stats['prompt']):>6}"
+                     f"{stats['completion']:>9}{stats['cost']:>10.4f}")
+    total = sum(stats["cost"] for stats in by_function.values())
+    lines.append(f"Итого: ${total:.4f}")
+    lines.append(f"Ответов из кэша LLM с запуска процесса: {100 * LLMCache.hit_rate():.0f}%")
+    lines.append("")
+    lines.append("Модели по задачам (маршрутизация, llm.py):")
+    for (function, model), latencies in sorted(by_model.items()):
+        lines.append(f"  {function:<36}{model:<24}{len(latencies):>8}{_percentile(latencies, 0.5):>8.2f}"
+                     f"{_percentile(latencies, 0.95):>8.2f}")
+    lines.append("")
+    lines.append("Самые дорогие пользователи:")
+    for user_id, cost in sorted(by_user.items(), key=lambda item: -item[1])[:10]:
+        lines.append(f"  {user_id if user_id is not None else '-':<20}${cost:.4f}")
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    print(summary_report(float(sys.argv[1]) if len(sys.argv) > 1 else 24), end="")
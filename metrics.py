@@ -0,0 +1,153 @@
+import logging
+import threading
+from aiohttp import web
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Все метрики процесса: {(имя, ((метка, значение), ...)): число}
+_counters = {}
+_gauges = {}
+_histograms = {}  # {(имя, метки): [счетчики по корзинам, сумма, количество]}
+_lock = threading.Lock()
+
+# Границы корзин гистограмм по умолчанию (секунды)
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_buckets = {}     # имя гистограммы -> границы корзин
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """
+    Увеличивает счетчик name с метками labels на value.
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """
+    Устанавливает текущее значение показателя name с метками labels.
+    """
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    """
+    Добавляет наблюдение value в гистограмму name с метками labels.
+    """
+    key = _key(name, labels)
+    with _lock:
+        bounds = _buckets.setdefault(name, tuple(buckets))
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(bounds), 0.0, 0]
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def get(name, **labels):
+    """
+    Возвращает значение счетчика или показателя (0, если метрика еще не записывалась).
+    """
+    key = _key(name, labels)
+    with _lock:
+        if key in _counters:
+            return _counters[key]
+        return _gauges.get(key, 0)
+
+
+def total(name):
+    """
+    Возвращает сумму счетчика name по всем комбинациям меток.
+    """
+    with _lock:
+        return sum(value for (metric, _), value in _counters.items() if metric == name)
+
+
+def snapshot():
+    """
+    Возвращает копию всех метрик в виде {имя{метки}: значение}.
+    """
+    with _lock:
+        items = list(_counters.items()) + list(_gauges.items())
+    result = {}
+    for (name, labels), value in items:
+        label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+        result[f"{name}{{{label_str}}}" if label_str else name] = value
+    return result
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_str(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def render_prometheus():
+    """
+    Все метрики процесса в текстовом формате Prometheus.
+    """
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in _histograms.items())
+        buckets = dict(_buckets)
+
+    lines = []
+    typed = set()
+    for metric_type, items in (("counter", counters), ("gauge", gauges)):
+        for (name, labels), value in items:
+            if name not in typed:
+                lines.append(f"# TYPE {name} {metric_type}")
+                typed.add(name)
+            lines.append(f"{name}{_labels_str(labels)} {value}")
+    for (name, labels), (counts, total_sum, count) in histograms:
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        for bound, bucket_count in zip(buckets[name], counts):
+            lines.append(f"{name}_bucket{_labels_str(labels, [('le', str(bound))])} {bucket_count}")
+        lines.append(f"{name}_bucket{_labels_str(labels, [('le', '+Inf')])} {count}")
+        lines.append(f"{name}_sum{_labels_str(labels)} {total_sum}")
+        lines.append(f"{name}_count{_labels_str(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+async def start_http_server(port, extra_routes=None, host="127.0.0.1"):
+    """
+    Запускает HTTP-сервер с метриками в формате Prometheus на /metrics.
+    По умолчанию сервер слушает только локальный адрес: авторизации у него нет.
+    extra_routes - {путь: функция без аргументов, возвращающая текст}.
+    Возвращает web.AppRunner; для остановки вызовите await runner.cleanup().
+    """
+    async def handle_metrics(request):
+        return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    def text_handler(render):
+        async def handle(request):
+            return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+        return handle
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    for path, render in (extra_routes or {}).items():
+        app.router.add_get(path, text_handler(render))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,142 @@
+"""
+Локальная заглушка OpenAI Batch API для проверки пакетного режима (batch_jobs.py) без OpenAI.
+
+Поддерживает загрузку файлов, создание и получение пакетов и скачивание результатов.
+Пакет считается выполненным через --delay секунд после создания. На проверку релевантности
+заглушка отвечает "Да", на остальные запросы - началом последнего сообщения пользователя.
+
+Запуск:
+    python mock_batch_api.py [--port 8089] [--delay 5]
+"""
+import argparse
+import itertools
+import json
+import time
+from aiohttp import web
+
+_ids = itertools.count(1)
+
+
+def _new_id(prefix):
+    return f"{prefix}-{next(_ids)}"
+
+
+def _mock_answer(body):
+    user_content = body["messages"][-1]["content"]
+    if any("Ответь только 'Да' или 'Нет'" in message["content"] for message in body["messages"]):
+        return "Да"
+    return "Выжимка (заглушка): " + user_content.split("\n\n", 1)[-1][:200]
+
+
+def _output_line(request):
+    body = request["body"]
+    return {
+        "id": _new_id("batch_req"),
+        "custom_id": request["custom_id"],
+        "response": {
+            "status_code": 200,
+            "request_id": _new_id("req"),
+            "body": {
+                "id": _new_id("chatcmpl"),
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": _mock_answer(body)},
+                    "finish_reason": "stop"
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+            }
+        },
+        "error": None
+    }
+
+
+class MockBatchAPI:
+    def __init__(self, delay):
+        self.delay = delay
+        self.files = {}    # id -> (объект файла, содержимое)
+        self.batches = {}  # id -> объект пакета
+
+    def _store_file(self, content, filename, purpose):
+        file_object = {
+            "id": _new_id("file"),
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed"
+        }
+        self.files[file_object["id"]] = (file_object, content)
+        return file_object
+
+    async def create_file(self, request):
+        form = await request.post()
+        upload = form["file"]
+        content = upload.file.read()
+        return web.json_response(self._store_file(content, upload.filename, form.get("purpose", "batch")))
+
+    async def file_content(self, request):
+        file_object = self.files.get(request.match_info["file_id"])
+        if file_object is None:
+            return web.json_response({"error": {"message": "No such file"}}, status=404)
+        return web.Response(body=file_object[1], content_type="application/jsonl")
+
+    async def create_batch(self, request):
+        params = await request.json()
+        if params["input_file_id"] not in self.files:
+            return web.json_response({"error": {"message": "No such file"}}, status=404)
+        batch = {
+            "id": _new_id("batch"),
+            "object": "batch",
+            "endpoint": params["endpoint"],
+            "input_file_id": params["input_file_id"],
+            "completion_window": params["completion_window"],
+            "status": "in_progress",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": int(time.time()),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0}
+        }
+        self.batches[batch["id"]] = batch
+        return web.json_response(batch)
+
+    async def retrieve_batch(self, request):
+        batch = self.batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return web.json_response({"error": {"message": "No such batch"}}, status=404)
+        if batch["status"] == "in_progress" and time.time() - batch["created_at"] >= self.delay:
+            self._complete(batch)
+        return web.json_response(batch)
+
+    def _complete(self, batch):
+        content = self.files[batch["input_file_id"]][1].decode("utf-8")
+        requests = [json.loads(line) for line in content.splitlines() if line.strip()]
+        output = "".join(json.dumps(_output_line(r), ensure_ascii=False) + "\n" for r in requests)
+        output_file = self._store_file(output.encode("utf-8"), f"{batch['id']}_output.jsonl", "batch_output")
+        batch.update({
+            "status": "completed",
+            "output_file_id": output_file["id"],
+            "completed_at": int(time.time()),
+            "request_counts": {"total": len(requests), "completed": len(requests), "failed": 0}
+        })
+
+
+def create_app(delay=0):
+    api = MockBatchAPI(delay)
+    app = web.Application()
+    app.router.add_post("/v1/files", api.create_file)
+    app.router.add_get("/v1/files/{file_id}/content", api.file_content)
+    app.router.add_post("/v1/batches", api.create_batch)
+    app.router.add_get("/v1/batches/{batch_id}", api.retrieve_batch)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка OpenAI Batch API")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--delay", type=float, default=5)
+    args = parser.parse_args()
+    web.run_app(create_app(args.delay), host="127.0.0.1", port=args.port)
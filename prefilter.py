@@ -0,0 +1,357 @@
+"""
+Локальный предварительный фильтр постов перед запросами к OpenAI.
+
+Сначала срабатывают эвристики (медиа без текста, пустые посты, явная реклама,
+спам из ссылок), затем небольшая линейная модель (логистическая регрессия по
+хэшированным символьным n-граммам) оценивает вероятность того, что пост - мусор.
+Фильтр только отсеивает мусор: уверенно мусорные посты отбрасываются локально,
+все остальные проходят обычную проверку релевантности (по векторам или в OpenAI).
+
+Все решения пишутся в журнал (PREFILTER_LOG_PATH). Для части отброшенных постов
+(PREFILTER_AUDIT_RATE) ответ модели OpenAI тоже запрашивается и сохраняется - по ним
+считается точность фильтра. Модель учится отличать мусор (рекламу, спам) от обычных
+постов, а не тематику отдельных каналов: примеры мусора - посты, отброшенные эвристиками
+рекламы и спама, примеры обычных постов - посты, которые OpenAI признал релевантными:
+    python prefilter.py train [размеченные.jsonl]
+    python prefilter.py report
+"""
+import json
+import logging
+import math
+import os
+import random
+import re
+import sys
+import time
+import zlib
+import metrics
+from CONFIG import (
+    PREFILTER_MODEL_PATH, PREFILTER_LOG_PATH, PREFILTER_CONFIDENCE, PREFILTER_AUDIT_RATE, PREFILTER_LOG_MAX_ROWS,
+    PREFILTER_LOG_TEXT_CHARS
+)
+from extractors import MEDIA_TYPES, MEDIA_FALLBACK
+from database import connect_db, release_connection
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Решения фильтра
+DROP = "drop"    # мусор, в OpenAI не отправляется
+CHECK = "check"  # не мусор: релевантность решает обычная проверка
+
+# Причины отбрасывания эвристиками, которые служат примерами мусора для обучения модели
+JUNK_REASONS = ("ad", "links")
+
+# Метки постов без текста (см. extractors.MEDIA_TYPES)
+MEDIA_LABELS = set(MEDIA_TYPES.values()) | {MEDIA_FALLBACK}
+
+# Только явные пометки рекламы: розыгрыши и ссылки на ботов (?start=) бывают и в обычных постах,
+# такие посты решает проверка релевантности
+AD_RE = re.compile(
+    r"#реклам|\berid\b|на правах рекламы|рекламн\w* (?:пост|интеграци)|партн[её]рск\w* (?:пост|материал)"
+    r"|промокод|(?:^|\n)\s*реклама\b",
+    re.IGNORECASE
+)
+URL_RE = re.compile(r"https?://\S+|t\.me/\S+", re.IGNORECASE)
+WORD_RE = re.compile(r"\w{2,}")
+
+NGRAM_SIZES = (3, 4, 5)
+HASH_BUCKETS = 1 << 18
+MAX_FEATURE_CHARS = 2000
+
+
+def is_media_only(text):
+    """
+    Проверяет, что вместо текста у поста только метка медиа ("[Картинка]" и т.п.).
+    """
+    return text in MEDIA_LABELS
+
+
+def check_heuristics(text):
+    """
+    Возвращает причину, по которой пост точно мусор, или None.
+    """
+    if not text or not text.strip():
+        return "empty"
+    if is_media_only(text):
+        return "media"
+    if AD_RE.search(text):
+        return "ad"
+    links = len(URL_RE.findall(text))
+    if links >= 3 and len(WORD_RE.findall(URL_RE.sub(" ", text))) < 5 * links:
+        return "links"
+    return None
+
+
+def extract_features(text):
+    """
+    Хэшированные символьные n-граммы нормализованного текста.
+    """
+    text = URL_RE.sub(" U ", text.lower())
+    text = re.sub(r"\d", "0", text)
+    text = " " + " ".join(text.split())[:MAX_FEATURE_CHARS] + " "
+    features = set()
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            features.add(zlib.crc32(text[i:i + n].encode("utf-8")) % HASH_BUCKETS)
+    return features
+
+
+def _sigmoid(x):
+    if x < -30:
+        return 0.0
+    if x > 30:
+        return 1.0
+    return 1.0 / (1.0 + math.exp(-x))
+
+
+class NgramModel:
+    """
+    Логистическая регрессия по символьным n-граммам: predict() возвращает вероятность того,
+    что пост - мусор. Веса хранятся в JSON; необученная модель всегда возвращает None.
+    """
+
+    def __init__(self, weights=None, bias=0.0):
+        self.weights = weights or {}
+        self.bias = bias
+
+    @property
+    def trained(self):
+        return bool(self.weights)
+
+    @classmethod
+    def load(cls, path=PREFILTER_MODEL_PATH):
+        if not os.path.exists(path):
+            return cls()
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            return cls({int(k): v for k, v in data["weights"].items()}, data["bias"])
+        except Exception as e:
+            logging.error(f"Не удалось загрузить модель предфильтра {path}: {e}")
+            return cls()
+
+    def save(self, path=PREFILTER_MODEL_PATH):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"weights": self.weights, "bias": self.bias}, f)
+
+    def _score(self, features):
+        if not features:
+            return self.bias
+        scale = 1.0 / math.sqrt(len(features))
+        return self.bias + scale * sum(self.weights.get(f, 0.0) for f in features)
+
+    def predict(self, text):
+        if not self.trained:
+            return None
+        return _sigmoid(self._score(extract_features(text)))
+
+    def fit(self, samples, epochs=5, learning_rate=0.5, l2=1e-4):
+        """
+        Обучает модель стохастическим градиентным спуском.
+        samples - список пар (текст, 1 если мусор иначе 0).
+        """
+        data = [(extract_features(text), label) for text, label in samples]
+        for _ in range(epochs):
+            random.shuffle(data)
+            for features, label in data:
+                if not features:
+                    continue
+                scale = 1.0 / math.sqrt(len(features))
+                error = _sigmoid(self._score(features)) - label
+                for f in features:
+                    weight = self.weights.get(f, 0.0)
+                    self.weights[f] = weight - learning_rate * (error * scale + l2 * weight)
+                self.bias -= learning_rate * error
+        return self
+
+
+class Prefilter:
+    """
+    Эвристики + линейная модель с порогом уверенности и журналом решений в SQLite.
+    """
+
+    def __init__(self, model=None, log_path=PREFILTER_LOG_PATH, confidence=PREFILTER_CONFIDENCE,
+                 audit_rate=PREFILTER_AUDIT_RATE, max_rows=PREFILTER_LOG_MAX_ROWS):
+        self.model = model if model is not None else NgramModel.load()
+        self.log_path = log_path
+        self.confidence = confidence
+        self.audit_rate = audit_rate
+        self.max_rows = max_rows
+        self._create_table()
+
+    def _create_table(self):
+        conn = connect_db(self.log_path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS prefilter_log (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_at REAL NOT NULL,
+                    decision TEXT NOT NULL,
+                    reason TEXT NOT NULL,
+                    score REAL,
+                    llm_relevant INTEGER,  -- ответ OpenAI, если пост туда отправлялся
+                    text TEXT NOT NULL     -- начало поста (PREFILTER_LOG_TEXT_CHARS символов)
+                )
+            ''')
+            conn.commit()
+        except Exception as e:
+            logging.error(f"Ошибка при создании журнала предфильтра: {e}")
+        finally:
+            release_connection(conn)
+
+    def decide(self, text):
+        """
+        Возвращает (решение, причина, вероятность мусора или None).
+        """
+        reason = check_heuristics(text)
+        if reason:
+            return DROP, reason, None
+        score = self.model.predict(text)
+        if score is None:
+            return CHECK, "untrained", None
+        if score >= self.confidence:
+            return DROP, "model", score
+        return CHECK, "model", score
+
+    def classify(self, texts):
+        """
+        Принимает решения по списку текстов и записывает их в журнал.
+        Возвращает список словарей {'decision', 'reason', 'score', 'audit', 'log_id'}:
+        audit=True означает, что отброшенный пост нужно проверить в OpenAI для оценки точности фильтра.
+        """
+        decisions = []
+        for text in texts:
+            decision, reason, score = self.decide(text)
+            audit = (decision == DROP and reason not in ("empty", "media")
+                     and random.random() < self.audit_rate)
+            decisions.append({'decision': decision, 'reason': reason, 'score': score, 'audit': audit, 'log_id': None})
+            metrics.inc("prefilter_decisions_total", decision=decision, reason=reason)
+
+        conn = connect_db(self.log_path)
+        cursor = conn.cursor()
+        try:
+            now = time.time()
+            for text, d in zip(texts, decisions):
+                cursor.execute(
+                    'INSERT INTO prefilter_log (created_at, decision, reason, score, text) VALUES (?, ?, ?, ?, ?)',
+                    (now, d['decision'], d['reason'], d['score'], (text or "")[:PREFILTER_LOG_TEXT_CHARS])
+                )
+                d['log_id'] = cursor.lastrowid
+            cursor.execute('SELECT COUNT(*) FROM prefilter_log')
+            overflow = cursor.fetchone()[0] - self.max_rows
+            if overflow > 0:
+                cursor.execute('DELETE FROM prefilter_log WHERE id IN (SELECT id FROM prefilter_log ORDER BY id LIMIT ?)', (overflow,))
+            conn.commit()
+        except Exception as e:
+            logging.error(f"Ошибка при записи в журнал предфильтра: {e}")
+        finally:
+            release_connection(conn)
+
+        dropped = sum(1 for d in decisions if d['decision'] == DROP)
+        logging.info(f"Предфильтр: отброшено {dropped} из {len(decisions)} постов.")
+        return decisions
+
+    def record_llm_verdicts(self, decisions, verdicts):
+        """
+        Сохраняет ответы OpenAI по постам, которые туда отправлялись.
+        """
+        rows = [(int(relevant), d['log_id']) for d, relevant in zip(decisions, verdicts) if d['log_id'] is not None]
+        if not rows:
+            return
+        for d, relevant in zip(decisions, verdicts):
+            if d['audit']:
+                agreed = not relevant
+                metrics.inc("prefilter_audits_total", decision=d['decision'], agreed=agreed)
+        conn = connect_db(self.log_path)
+        cursor = conn.cursor()
+        try:
+            cursor.executemany('UPDATE prefilter_log SET llm_relevant = ? WHERE id = ?', rows)
+            conn.commit()
+        except Exception as e:
+            logging.error(f"Ошибка при записи ответов OpenAI в журнал предфильтра: {e}")
+        finally:
+            release_connection(conn)
+
+    def report(self):
+        """
+        Сводка по журналу: сколько решений какого типа принято и точность отбрасывания
+        по проверенным в OpenAI постам.
+        {решение: {'total': N, 'audited': M, 'precision': доля совпадений с OpenAI или None}}
+        """
+        conn = connect_db(self.log_path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                SELECT decision, COUNT(*), COUNT(llm_relevant),
+                       SUM(CASE WHEN decision = ? AND llm_relevant = 0 THEN 1 ELSE 0 END)
+                FROM prefilter_log GROUP BY decision
+            ''', (DROP,))
+            rows = cursor.fetchall()
+        finally:
+            release_connection(conn)
+        result = {}
+        for decision, total, audited, agreed in rows:
+            precision = agreed / audited if audited and decision == DROP else None
+            result[decision] = {'total': total, 'audited': audited, 'precision': precision}
+        return result
+
+    def training_samples(self):
+        """
+        Примеры для обучения из журнала: (начало текста поста, 1 если мусор иначе 0).
+        Мусор - посты, отброшенные эвристиками рекламы и спама (JUNK_REASONS), обычные посты -
+        те, что OpenAI признал релевантными. Ответ "нерелевантно" говорит о тематике конкретного
+        канала, а не о мусоре, поэтому такие посты в обучение не идут.
+        """
+        placeholders = ", ".join("?" * len(JUNK_REASONS))
+        conn = connect_db(self.log_path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f'''
+                SELECT text, CASE WHEN reason IN ({placeholders}) THEN 1 ELSE 0 END FROM prefilter_log
+                WHERE reason IN ({placeholders}) OR (decision = ? AND llm_relevant = 1)
+            ''', (*JUNK_REASONS, *JUNK_REASONS, CHECK))
+            return cursor.fetchall()
+        finally:
+            release_connection(conn)
+
+
+_prefilter = None
+
+
+def get_prefilter():
+    """
+    Возвращает общий (единственный на процесс) экземпляр Prefilter.
+    """
+    global _prefilter
+    if _prefilter is None:
+        _prefilter = Prefilter()
+    return _prefilter
+
+
+def main(argv):
+    if argv[:1] == ["train"]:
+        samples = get_prefilter().training_samples()
+        for path in argv[1:]:
+            # Строки вида {"text": "...", "junk": true}
+            with open(path, encoding="utf-8") as f:
+                samples.extend((row["text"], int(row["junk"])) for row in map(json.loads, f) if row.get("text"))
+        if not samples:
+            print("Нет размеченных постов для обучения.")
+            return 1
+        model = NgramModel().fit(samples)
+        model.save()
+        print(f"Модель обучена на {len(samples)} постах и сохранена в {PREFILTER_MODEL_PATH}.")
+        return 0
+    if argv[:1] == ["report"]:
+        for decision, row in sorted(get_prefilter().report().items()):
+            precision = f"{row['precision']:.1%}" if row['precision'] is not None else "-"
+            print(f"{decision:<10}всего {row['total']:>7}  проверено {row['audited']:>6}  точность {precision}")
+        return 0
+    print("Использование: python prefilter.py train [размеченные.jsonl ...] | report")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,85 @@
+"""
+Шаблоны промптов, которые задают модели вопрос о посте (или выжимках) в контексте канала.
+
+OpenAI кэширует совпадающее начало запроса (от 1024 токенов): кэшированные входные токены
+дешевле и обрабатываются быстрее. Поэтому все шаблоны устроены одинаково: сначала неизменные
+инструкции задачи, затем описание канала (одно и то же для всех постов канала) - это системное
+сообщение, и только в конце, отдельным сообщением, переменная часть (пост, выжимки).
+Так запросы одной задачи по одному каналу совпадают во всем, кроме последнего сообщения.
+
+Версия шаблона входит в ключ кэша LLM (llm.py): при изменении текста шаблона ее нужно увеличить.
+Доля кэшированных токенов видна в отчете llm_telemetry.py.
+"""
+
+
+class PromptTemplate:
+    """
+    Шаблон запроса: инструкции + описание канала (стабильный префикс) и переменное содержимое.
+    content - строка формата для последнего сообщения.
+    """
+
+    def __init__(self, name, version, instructions, content):
+        self.name = name
+        self.version = version
+        self.instructions = instructions
+        self.content = content
+
+    def messages(self, channel_description, **fields):
+        return [
+            {"role": "system", "content": f"{self.instructions}\n\nОписание канала:\n{channel_description}"},
+            {"role": "user", "content": self.content.format(**fields)}
+        ]
+
+
+IS_POST_RELEVANT = PromptTemplate(
+    "is_post_relevant", 2,
+    "Ты — помощник, который анализирует, соответствует ли пост тематике канала. "
+    "Тебе дано описание канала, следующим сообщением придет пост. "
+    "Ответь только 'Да' или 'Нет'. "
+    "Если ты замечаешь, что пост - это реклама чего-либо (сервиса, приложения, другого канала), то сразу пиши 'Нет'. "
+    "Ни в коем случае не добавляй разметку заголовков и подзаголовков.",
+    "Пост: {post}"
+)
+
+CLASSIFY_POSTS_RELEVANCE = PromptTemplate(
+    "classify_posts_relevance", 2,
+    "Ты — помощник, который анализирует, соответствуют ли посты тематике канала, и отвечает строго в JSON. "
+    "Тебе дано описание канала, следующим сообщением придут пронумерованные посты. "
+    "Для каждого поста определи, соответствует ли он тематике канала. "
+    "Если пост - это реклама чего-либо (сервиса, приложения, другого канала), он не соответствует. "
+    "Ответь только JSON без пояснений в формате "
+    '{"verdicts": [{"id": <номер поста>, "relevant": true или false}, ...]} '
+    "с одним элементом на каждый пост.",
+    "{posts}\n\nВсего постов: {count}."
+)
+
+IS_SUMMARY_RELEVANT = PromptTemplate(
+    "is_summary_relevant", 2,
+    "Ты — помощник, который анализирует, соответствует ли summary описанию канала. "
+    "Тебе дано описание канала, следующим сообщением придет summary. "
+    "Ответь только 'Да' или 'Нет'.",
+    "Summary: {summary}"
+)
+
+RANK_CHANNEL_SUMMARIES = PromptTemplate(
+    "rank_channel_summaries", 2,
+    "Ты — редактор дайджеста. Отвечай строго в формате JSON без пояснений. "
+    "Тебе дано описание канала, следующим сообщением придут пронумерованные выжимки постов. "
+    "Упорядочи выжимки от самой важной и полезной для читателя к наименее важной. "
+    'Верни JSON вида {"order": [номера выжимок]}, где каждый номер выжимки встречается ровно один раз.',
+    "{summaries}\n\nВсего выжимок: {count}."
+)
+
+FILTER_UNRELATED_POSTS = PromptTemplate(
+    "filter_unrelated_posts", 2,
+    "Ты — помощник, который фильтрует посты на основе тематики канала. Будь менее строг при отборе. "
+    "Тебе дано описание канала, следующим сообщением придут посты. Отфильтруй их и оставь только те, "
+    "которые хотя бы частично связаны с тематикой канала, без жёсткого отсечения.",
+    "{posts}"
+)
+
+TEMPLATES = {
+    template.name: template
+    for template in (IS_POST_RELEVANT, CLASSIFY_POSTS_RELEVANCE, IS_SUMMARY_RELEVANT, RANK_CHANNEL_SUMMARIES,
+                     FILTER_UNRELATED_POSTS)
+}
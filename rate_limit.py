@@ -0,0 +1,211 @@
+import asyncio
+import collections
+import time
+from contextlib import asynccontextmanager
+
+
+class TokenBucket:
+    """
+    Асинхронный token bucket: не больше rate операций в секунду
+    с допустимым всплеском до capacity операций.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens=1):
+        """
+        Ждет, пока в ведре накопится tokens жетонов, и забирает их.
+        Ожидающие обслуживаются по очереди.
+        """
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для одного ресурса (например, канала).
+    closed - запросы идут как обычно; после failure_threshold ошибок подряд переходит в open
+    и отклоняет запросы cooldown секунд; затем half_open - пропускает один пробный запрос.
+    Успех пробного запроса закрывает предохранитель, ошибка снова открывает его
+    с удвоенной (до max_cooldown) паузой.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold, cooldown, max_cooldown):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._state = self.CLOSED
+
+    @property
+    def state(self):
+        if self._state == self.OPEN and time.monotonic() >= self.retry_at:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    @property
+    def retry_at(self):
+        """
+        Момент (time.monotonic()), после которого разрешен пробный запрос.
+        """
+        if self.opened_at is None:
+            return 0.0
+        return self.opened_at + self.cooldown
+
+    def allow(self):
+        """
+        Можно ли сейчас выполнить запрос. В состоянии half_open пропускает только один запрос.
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN:
+            # Пока пробный запрос не завершился, остальные ждут
+            self._state = self.OPEN
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        """
+        Возвращает True, если предохранитель при этом закрылся.
+        """
+        was_open = self._state != self.CLOSED
+        self._state = self.CLOSED
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+        self.opened_at = None
+        return was_open
+
+    def record_failure(self):
+        """
+        Возвращает True, если предохранитель при этом открылся.
+        """
+        self.failures += 1
+        if self._state == self.OPEN:
+            # Неудачный пробный запрос - открываем снова с увеличенной паузой
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            self.opened_at = time.monotonic()
+            return True
+        if self.failures >= self.failure_threshold:
+            self._state = self.OPEN
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+
+class PriorityScheduler:
+    """
+    Ограничивает число одновременных операций capacity слотами и раздает освободившиеся
+    слоты по приоритету полос и справедливо между владельцами (например, пользователями).
+
+    lanes - полосы по убыванию приоритета. Операция младшей полосы не начинается, пока в старших
+    есть ожидающие, и не занимает последние reserved слотов - они всегда свободны для первой полосы.
+    Внутри полосы владельцы обслуживаются по очереди пропорционально весам weights
+    (по умолчанию 1): выбирается владелец с наименьшим "виртуальным временем",
+    которое растет на 1 / вес при каждом выданном слоте.
+    """
+
+    def __init__(self, capacity, lanes, reserved=0, weights=None):
+        self.capacity = capacity
+        self.lanes = tuple(lanes)
+        self.reserved = min(reserved, capacity - 1)
+        self.weights = weights or {}
+        self.in_flight = {lane: 0 for lane in self.lanes}
+        self._waiters = {lane: {} for lane in self.lanes}  # полоса -> {владелец: deque[Future]}
+        self._virtual_time = {}                            # владелец -> виртуальное время
+        self._clock = 0.0                                  # виртуальное время последнего выданного слота
+
+    def waiting(self, lane):
+        """
+        Сколько операций полосы ждут слота.
+        """
+        return sum(len(queue) for queue in self._waiters[lane].values())
+
+    def _can_start(self, lane):
+        total = sum(self.in_flight.values())
+        if lane == self.lanes[0]:
+            return total < self.capacity
+        return total < self.capacity - self.reserved
+
+    def _next_owner(self, lane):
+        waiters = self._waiters[lane]
+        return min(waiters, key=lambda owner: self._virtual_time[owner])
+
+    def _dispatch(self):
+        for lane in self.lanes:
+            waiters = self._waiters[lane]
+            while waiters and self._can_start(lane):
+                owner = self._next_owner(lane)
+                queue = waiters[owner]
+                future = queue.popleft()
+                if not queue:
+                    del waiters[owner]
+                if future.done():
+                    continue
+                self._clock = self._virtual_time[owner]
+                self._virtual_time[owner] += 1 / self.weights.get(owner, 1)
+                self.in_flight[lane] += 1
+                future.set_result(None)
+            if waiters:
+                # Пока в этой полосе есть ожидающие, младшие полосы не обслуживаются
+                return
+
+    async def acquire(self, lane, owner=None):
+        """
+        Ждет свободный слот для операции полосы lane от владельца owner.
+        """
+        future = asyncio.get_running_loop().create_future()
+        # Владелец, долго не пользовавшийся слотами, не накапливает права на внеочередное обслуживание
+        self._virtual_time[owner] = max(self._virtual_time.get(owner, 0.0), self._clock)
+        self._waiters[lane].setdefault(owner, collections.deque()).append(future)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот уже выдан, но ожидающий отменен - возвращаем слот
+                self.release(lane)
+            else:
+                queue = self._waiters[lane].get(owner)
+                if queue is not None and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del self._waiters[lane][owner]
+            raise
+
+    def release(self, lane):
+        """
+        Освобождает слот и отдает его следующему ожидающему.
+        """
+        self.in_flight[lane] -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, lane, owner=None):
+        await self.acquire(lane, owner)
+        try:
+            yield
+        finally:
+            self.release(lane)
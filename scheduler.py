@@ -0,0 +1,129 @@
+import logging
+import asyncio
+import metrics
+from CONFIG import CHECK_INTERVAL, BATCH_MODE
+from database import get_active_user_ids
+from channel_poller import get_poller
+from AI_main import start_ai_main
+from batch_jobs import get_batch_processor
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class PollingScheduler:
+    """
+    Единый планировщик фоновой работы для всех пользователей.
+    Владеет задачей центрального опроса каналов и не более чем одним обработчиком
+    на каждого активного пользователя. Регистрация подписывает пользователя на общую ленту
+    (читает его каналы из базы), отмена только снимает подписку и задачу обработчика.
+    """
+
+    def __init__(self):
+        self._workers = {}         # user_id -> asyncio.Task обработчика новых постов
+        self._poller_task = None
+        self._batch_task = None    # Фоновая пакетная обработка (только в BATCH_MODE)
+
+    @property
+    def running_workers(self):
+        """
+        Количество работающих обработчиков пользователей.
+        """
+        return sum(1 for task in self._workers.values() if not task.done())
+
+    def is_registered(self, user_id):
+        """
+        Проверяет, есть ли у пользователя работающий обработчик.
+        """
+        task = self._workers.get(user_id)
+        return task is not None and not task.done()
+
+    def register(self, user_id):
+        """
+        Запускает обработчик пользователя. Повторная регистрация ничего не делает,
+        поэтому у пользователя никогда не бывает двух обработчиков.
+        """
+        if self.is_registered(user_id):
+            return
+        poller = get_poller()
+        if not poller.is_subscribed(user_id):
+            poller.subscribe(user_id)
+        self._workers[user_id] = asyncio.create_task(self._run_worker(user_id))
+        self._update_gauge()
+        logging.info(f"Обработчик пользователя {user_id} запущен (всего: {self.running_workers}).")
+
+    def unregister(self, user_id):
+        """
+        Останавливает обработчик пользователя и отписывает его от общей ленты.
+        """
+        get_poller().unsubscribe(user_id)
+        task = self._workers.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+        self._update_gauge()
+        logging.info(f"Обработчик пользователя {user_id} остановлен (всего: {self.running_workers}).")
+
+    async def _run_worker(self, user_id):
+        """
+        Обработчик пользователя под надзором: при неожиданной ошибке перезапускается.
+        """
+        try:
+            while True:
+                try:
+                    # start_ai_main заодно создает и мигрирует таблицы пользователя
+                    await start_ai_main(user_id)
+                    return
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.error(f"Обработчик пользователя {user_id} упал, перезапуск через {CHECK_INTERVAL} с: {e}")
+                    await asyncio.sleep(CHECK_INTERVAL)
+        finally:
+            if self._workers.get(user_id) is asyncio.current_task():
+                del self._workers[user_id]
+                self._update_gauge()
+
+    def _update_gauge(self):
+        metrics.set_gauge("scheduler_running_workers", self.running_workers)
+
+    async def start(self):
+        """
+        Запускает центральный опрос каналов и обработчики всех пользователей,
+        у которых отслеживание было включено до перезапуска.
+        """
+        if self._poller_task is None or self._poller_task.done():
+            self._poller_task = asyncio.create_task(get_poller().run())
+        if BATCH_MODE and (self._batch_task is None or self._batch_task.done()):
+            self._batch_task = asyncio.create_task(get_batch_processor().run())
+        for user_id in get_active_user_ids():
+            self.register(user_id)
+
+    async def stop(self):
+        """
+        Корректно отменяет все задачи планировщика и дожидается их завершения.
+        """
+        tasks = list(self._workers.values())
+        if self._poller_task is not None:
+            tasks.append(self._poller_task)
+        if self._batch_task is not None:
+            tasks.append(self._batch_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers.clear()
+        self._poller_task = None
+        self._batch_task = None
+        self._update_gauge()
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    """
+    Возвращает общий (единственный на процесс) экземпляр PollingScheduler.
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = PollingScheduler()
+    return _scheduler
@@ -0,0 +1,90 @@
+import logging
+import math
+from CONFIG import OPENAI_MODEL, LLM_CONTEXT_TOKENS, LLM_CHUNK_TOKENS, CHARS_PER_TOKEN
+
+# Без tiktoken число токенов оценивается по длине текста
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Запас на служебные токены разметки сообщений chat completions
+MESSAGE_OVERHEAD_TOKENS = 20
+
+_encodings = {}
+
+
+def _get_encoding(model):
+    if tiktoken is None:
+        return None
+    if model not in _encodings:
+        try:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            # tiktoken скачивает словарь при первом использовании - без сети считаем по длине текста
+            logging.warning(f"Не удалось загрузить токенизатор для {model}, используем оценку по длине текста: {e}")
+            _encodings[model] = None
+    return _encodings[model]
+
+
+def count_tokens(text, model=OPENAI_MODEL):
+    """
+    Количество токенов текста для модели (точное с tiktoken, иначе оценка с запасом).
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, max_tokens, model=OPENAI_MODEL):
+    """
+    Обрезает текст до max_tokens токенов.
+    """
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return text[:int(max_tokens * CHARS_PER_TOKEN)]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+def prompt_budget(messages, max_tokens, model=OPENAI_MODEL):
+    """
+    Сколько токенов входных данных можно добавить к messages, чтобы запрос с ответом
+    до max_tokens поместился в контекст модели и не превысил LLM_CHUNK_TOKENS.
+    """
+    used = sum(count_tokens(message["content"], model) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+    return max(0, min(LLM_CHUNK_TOKENS, LLM_CONTEXT_TOKENS - max_tokens) - used)
+
+
+def pack_texts(texts, budget, separator="\n\n", model=OPENAI_MODEL):
+    """
+    Раскладывает тексты по порядку в куски, каждый не длиннее budget токенов
+    (вместе с разделителями). Слишком длинный текст обрезается до budget.
+    Возвращает список строк.
+    """
+    separator_tokens = count_tokens(separator, model)
+    chunks = []
+    current, current_tokens = [], 0
+    for text in texts:
+        tokens = count_tokens(text, model)
+        if tokens > budget:
+            text, tokens = truncate_to_tokens(text, budget, model), budget
+        extra = tokens + (separator_tokens if current else 0)
+        if current and current_tokens + extra > budget:
+            chunks.append(separator.join(current))
+            current, current_tokens = [], 0
+            extra = tokens
+        current.append(text)
+        current_tokens += extra
+    if current:
+        chunks.append(separator.join(current))
+    return chunks